@@ -242,6 +242,9 @@ def cli():
     parser.add_argument('--summarize',
                         help="show summary of a .gamut file",
                         type=str)
+    parser.add_argument('--benchmark',
+                        action='store_true',
+                        help="compare the nearest neighbor indices on a corpus, given with --source as audio file(s) or a .gamut file, and an optional --target")
     parser.add_argument('-p', '--play',
                         action='store_true',
                         help="enable audio playback after script runs")
@@ -321,6 +324,17 @@ def cli():
         print_success("Done")
         rmtree(TEST_DIR)
 
+    # ------------------------------------- #
+    # BENCHMARK NEAREST NEIGHBOR INDICES
+    # ------------------------------------- #
+    elif args.benchmark:
+        if not args.source:
+            print_error("You must provide a corpus source to benchmark")
+        from .benchmarks import benchmark_indices
+        source = [clean_path(s) for s in args.source]
+        benchmark_indices(source[0] if len(source) == 1 else source,
+                          target=clean_path(args.target) if args.target else None)
+
     # ------------------------------------- #
     # PROCESS RAW INPUT
     # ------------------------------------- #
@@ -404,14 +418,9 @@ def cli():
         if splitext(gamut_file)[1] != '.gamut':
             print_error(f'{gamut_file} is not a .gamut file')
 
-        from .features import Corpus, Mosaic
+        from .features import read_metadata, print_summary
 
-        for obj in [Corpus(), Mosaic()]:
-            try:
-                obj.read(gamut_file).summarize()
-            except:
-                continue
-            break
+        print_summary(read_metadata(gamut_file))
 
     # ------------------------------------- #
     # PROCESS SCRIPT
@@ -0,0 +1,407 @@
+from __future__ import annotations
+# librosa
+from librosa import magphase, stft, samples_like, estimate_tuning, piptrack, pitch_tuning
+from librosa.feature import mfcc, chroma_stft, rms, zero_crossing_rate
+from librosa.filters import chroma as chroma_filterbank
+from librosa.util import normalize
+from librosa.onset import onset_detect
+
+# gamut
+from .config import CONSOLE, MEMORY_BUDGET, SEGMENTATION_TYPES
+
+# misc
+import soundfile
+from functools import lru_cache
+from scipy.fft import rfft
+from scipy.signal import get_window
+
+# typing
+from collections.abc import Iterable, Iterator, Callable
+
+# numpy
+import numpy as np
+
+
+class AnalysisEngine:
+    """
+    Audio feature extractor that computes all descriptors of many signals from a single batched magnitude spectrogram.
+
+    Frames from all signals are windowed and stacked into one ``float32`` matrix, transformed with a single real FFT,
+    and every descriptor is then derived from the magnitudes with matrix products against matrices that are built once
+    and reused: the DCT matrix of the cepstral coefficients, and the chroma filterbank of each sampling rate and tuning.
+    The output matches that of calling librosa's ``stft``, ``mfcc``, ``chroma_stft``, ``rms`` and ``zero_crossing_rate``
+    separately (see ``librosa_analysis``), up to ``float32`` rounding.
+
+    n_mfcc: int = 13
+        Number of cepstral coefficients (i.e., the DCT-II of the magnitude spectrum, as computed by ``librosa.feature.mfcc``).
+
+    hop_length: int = 512
+        Size in audio samples of space between windowing frames.
+
+    win_length: int = 1024
+        Size in audio samples of windowing frames.
+
+    n_fft: int = 1024
+        Number of FFT bins
+
+    memory_budget: int | None = None
+        Approximate maximum size in bytes of the frames analyzed at once. Defaults to ``config.MEMORY_BUDGET``.
+    """
+
+    # maximum number of spectral peaks sampled to estimate the tuning of streamed signals
+    TUNING_MAX_PEAKS = 2**20
+
+    def __init__(self,
+                 n_mfcc: int = 13,
+                 hop_length: int = 512,
+                 win_length: int = 1024,
+                 n_fft: int = 1024,
+                 memory_budget: int | None = None) -> None:
+        self.n_mfcc = n_mfcc
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.n_fft = n_fft
+        self.memory_budget = memory_budget or MEMORY_BUDGET
+
+        # hann window, centered and zero-padded to n_fft
+        window = get_window('hann', win_length, fftbins=True)
+        offset = (n_fft - win_length) // 2
+        self.window = np.zeros(n_fft, dtype='float32')
+        self.window[offset:offset + win_length] = window
+
+        # first n_mfcc rows of the orthonormal DCT-II matrix, over the n_fft // 2 + 1 frequency bins
+        n_bins = n_fft // 2 + 1
+        bins = np.arange(n_bins)
+        dct = np.cos(np.pi * np.arange(n_mfcc)[:, np.newaxis] * (2 * bins + 1) / (2 * n_bins)) * np.sqrt(2 / n_bins)
+        dct[0] /= np.sqrt(2)
+        self.dct = dct.astype('float32')
+
+        self.__chroma_filterbanks = {}
+
+    def __chroma_filterbank(self, sr: int, tuning: float) -> np.ndarray:
+        """ chroma filterbank for a sampling rate and tuning, built on first use """
+        key = (sr, tuning)
+        if key not in self.__chroma_filterbanks:
+            self.__chroma_filterbanks[key] = chroma_filterbank(sr=sr, n_fft=self.n_fft, tuning=tuning, n_chroma=12, dtype='float32')
+        return self.__chroma_filterbanks[key]
+
+    def num_frames(self, num_samples: int) -> int:
+        """ Number of analysis frames of a signal with ``num_samples`` samples, before dropping the last one """
+        return 1 + (num_samples + 2 * (self.n_fft // 2) - self.n_fft) // self.hop_length
+
+    def magnitudes(self, signals: Iterable) -> np.ndarray:
+        """ Returns the stacked ``(frames, n_fft // 2 + 1)`` magnitude spectrogram of all ``signals``, framed as a centered STFT """
+        padding = self.n_fft // 2
+        return self.__magnitude(np.concatenate([
+            np.lib.stride_tricks.sliding_window_view(np.pad(y, padding), self.n_fft)[::self.hop_length]
+            for y in signals
+        ]))
+
+    def __magnitude(self, frames: np.ndarray) -> np.ndarray:
+        """ magnitude spectrum of each row of ``frames`` """
+        frames = frames.astype('float32')
+        frames *= self.window
+        return np.abs(rfft(frames, axis=1, workers=-1))
+
+    def __loudness(self, S: np.ndarray) -> np.ndarray:
+        """ RMS of each frame, from its magnitude spectrum """
+        power = S ** 2
+        power[:, 0] *= 0.5
+        if self.win_length % 2 == 0:
+            power[:, -1] *= 0.5
+        return np.sqrt(2 * np.sum(power, axis=1) / np.float32(self.win_length)**2)
+
+    def __chroma(self, S: np.ndarray, sr: int, tuning: float) -> np.ndarray:
+        """ chromagram of each frame, from its magnitude spectrum, normalized by its maximum """
+        return normalize(self.__chroma_filterbank(sr, tuning) @ S.T, norm=np.inf, axis=-2).T
+
+    def __zero_crossing_rate(self, y: np.ndarray, num_frames: int) -> np.ndarray:
+        """ fraction of sign changes within each frame of ``y``, where values within ``1e-10`` of zero count as positive """
+        padding = self.win_length // 2
+        negative = np.pad(y, padding, mode='edge') < -np.float32(1e-10)
+        crossings = np.concatenate([[0], np.cumsum(negative[1:] != negative[:-1])])
+        starts = np.arange(num_frames) * self.hop_length
+        return (crossings[starts + self.win_length - 1] - crossings[starts]).astype('float32') / self.win_length
+
+    def __onset_envelope(self, S: np.ndarray, previous: np.ndarray | None = None) -> tuple:
+        """
+        spectral flux of each frame (i.e., the mean increase of its decibel magnitudes over those of the previous frame),
+        returned along with the decibel magnitudes of the last frame, to be passed as ``previous`` for the next frames of a stream
+        """
+        decibels = 20 * np.log10(np.maximum(S, 1e-5))
+        previous = decibels[:1] if previous is None else previous
+        flux = np.maximum(0, np.diff(decibels, axis=0, prepend=previous)).mean(axis=1)
+        return flux, decibels[-1:]
+
+    def __check_features(self, features: Iterable, segmentation: str = 'frame') -> None:
+        if segmentation not in SEGMENTATION_TYPES:
+            CONSOLE.error(ValueError, f'"{segmentation}" is not a valid segmentation. Choose one of the following: {SEGMENTATION_TYPES}')
+        if 'pitch' in features and self.n_fft // 2 + 1 != self.win_length // 2 + 1:
+            CONSOLE.error(ValueError, f'Pitch analysis requires win_length to match n_fft ({self.n_fft}), but found {self.win_length}')
+
+    def analyze(self, y: np.ndarray, features: Iterable, sr: int | None = None, segmentation: str = 'frame') -> tuple:
+        """
+        Extracts audio features from an ``ndarray`` of audio samples, returning a matrix of analysis frames and their sample markers.
+        If ``segmentation`` is ``"onset"``, frames are grouped into segments that start at detected onsets, and their features averaged,
+        returning a matrix of analysis segments and the sample markers of their first frames.
+        """
+        return self.analyze_batch([(y, sr)], features, segmentation=segmentation)[0]
+
+    def analyze_batch(self, signals: Iterable, features: Iterable, segmentation: str = 'frame') -> list:
+        """
+        Extracts audio features from a list of ``(y, sr)`` tuples, where ``y`` is an ``ndarray`` of audio samples and ``sr`` its sampling rate,
+        returning an ``(analysis, markers)`` tuple for each of them, as ``analyze`` does. Signals are batched so that their frames fit in ``memory_budget``.
+        """
+        signals = list(signals)
+        self.__check_features(features, segmentation)
+
+        # group signals into batches of bounded size
+        frame_size = self.n_fft * 4 * 3
+        batches, batch, batch_size = [], [], 0
+        for i, (y, _) in enumerate(signals):
+            size = self.num_frames(len(y)) * frame_size
+            if batch and batch_size + size > self.memory_budget:
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(i)
+            batch_size += size
+        if batch:
+            batches.append(batch)
+
+        results = [None] * len(signals)
+        for batch in batches:
+            S = self.magnitudes([signals[i][0] for i in batch])
+            if 'timbre' in features:
+                cepstra = S @ self.dct.T
+            if 'pitch' in features:
+                loudness = self.__loudness(S)
+
+            start = 0
+            for i in batch:
+                y, sr = signals[i]
+                num_frames = self.num_frames(len(y))
+                frames = slice(start, start + num_frames)
+                start += num_frames
+
+                analysis = []
+                if 'timbre' in features:
+                    analysis.append(cepstra[frames])
+                if 'pitch' in features:
+                    tuning = estimate_tuning(S=S[frames].T, sr=sr, bins_per_octave=12)
+                    analysis.extend([self.__chroma(S[frames], sr, tuning), loudness[frames, np.newaxis],
+                                     self.__zero_crossing_rate(y, num_frames)[:, np.newaxis]])
+                envelope = self.__onset_envelope(S[frames])[0] if segmentation == 'onset' else None
+                results[i] = self.__assemble(analysis, envelope, sr)
+        return results
+
+    def analyze_blocks(self, blocks: Callable, features: Iterable, sr: int | None = None, segmentation: str = 'frame') -> tuple:
+        """
+        Extracts audio features from a signal read as a stream of consecutive blocks of audio samples (see ``read_blocks``),
+        returning the same matrix of analysis frames and sample markers as ``analyze`` would for the whole signal.
+        Frames that straddle block edges are carried over to the next block, so that memory use depends on the block size rather than on the signal length.
+
+        blocks: Callable
+            Function that returns a new iterator over the blocks of the signal. It is called twice if ``features`` include ``"pitch"``,
+            since the chroma tuning of the whole signal must be estimated before computing any chromagram.
+
+        features: Iterable
+            Audio features to extract.
+
+        sr: int | None = None
+            Sampling rate of the signal.
+
+        segmentation: str = 'frame'
+            Either ``"frame"`` or ``"onset"`` (see ``analyze``).
+        """
+        self.__check_features(features, segmentation)
+        tuning = self.__estimate_tuning(blocks(), sr) if 'pitch' in features else None
+        spectrum = Framer(self.n_fft, self.hop_length, pad='constant')
+        samples = Framer(self.win_length, self.hop_length, pad='edge')
+        columns = {'timbre': [], 'chroma': [], 'loudness': [], 'zerox': []}
+        envelope, previous = [], None
+
+        def describe(frames: np.ndarray, zerox_frames: np.ndarray | None) -> None:
+            if not len(frames):
+                return
+            nonlocal previous
+            S = self.__magnitude(frames)
+            if segmentation == 'onset':
+                flux, previous = self.__onset_envelope(S, previous)
+                envelope.append(flux)
+            if 'timbre' in features:
+                columns['timbre'].append(S @ self.dct.T)
+            if 'pitch' in features:
+                columns['chroma'].append(self.__chroma(S, sr, tuning))
+                columns['loudness'].append(self.__loudness(S)[:, np.newaxis])
+                negative = zerox_frames < -np.float32(1e-10)
+                columns['zerox'].append((np.sum(negative[:, 1:] != negative[:, :-1], axis=1, dtype='float32') / self.win_length)[:, np.newaxis])
+
+        for block in blocks():
+            describe(spectrum.push(block), samples.push(block) if 'pitch' in features else None)
+        describe(spectrum.flush(), samples.flush() if 'pitch' in features else None)
+
+        analysis = [np.concatenate(columns[column]) for column in columns if columns[column]]
+        return self.__assemble(analysis, np.concatenate(envelope) if envelope else None, sr)
+
+    def __estimate_tuning(self, blocks: Iterator, sr: int) -> float:
+        """
+        ``librosa.estimate_tuning`` over a stream of blocks, estimated from a random sample of at most ``TUNING_MAX_PEAKS`` spectral peaks,
+        which is exact for signals with fewer peaks than that
+        """
+        rng = np.random.default_rng(0)
+        pitches, magnitudes, keys = np.empty(0, dtype='float32'), np.empty(0, dtype='float32'), np.empty(0)
+        spectrum = Framer(self.n_fft, self.hop_length, pad='constant')
+
+        def sample(frames: np.ndarray) -> None:
+            nonlocal pitches, magnitudes, keys
+            if not len(frames):
+                return
+            pitch, magnitude = piptrack(S=self.__magnitude(frames).T, sr=sr)
+            peaks = pitch > 0
+            pitches = np.concatenate([pitches, pitch[peaks]])
+            magnitudes = np.concatenate([magnitudes, magnitude[peaks]])
+            keys = np.concatenate([keys, rng.random(np.count_nonzero(peaks))])
+            if len(keys) > self.TUNING_MAX_PEAKS:
+                kept = np.argpartition(keys, self.TUNING_MAX_PEAKS)[:self.TUNING_MAX_PEAKS]
+                pitches, magnitudes, keys = pitches[kept], magnitudes[kept], keys[kept]
+
+        for block in blocks:
+            sample(spectrum.push(block))
+        sample(spectrum.flush())
+
+        threshold = np.median(magnitudes) if len(magnitudes) else 0.0
+        return pitch_tuning(pitches[magnitudes >= threshold], bins_per_octave=12)
+
+    def __assemble(self, analysis: list, envelope: np.ndarray | None = None, sr: int | None = None) -> tuple:
+        """
+        concatenates feature columns into a matrix of analysis frames, dropping the last frame, and computes their sample markers.
+        If an onset ``envelope`` is given, frames are averaged over the segments between its onsets
+        """
+        analysis = np.concatenate(analysis, axis=1)[:-1]
+        markers = np.arange(len(analysis)) * self.hop_length + self.n_fft // 2
+        if envelope is None or not len(analysis):
+            return analysis, markers
+
+        envelope = envelope[:len(analysis)]
+        onsets = onset_detect(onset_envelope=envelope, sr=sr, hop_length=self.hop_length, backtrack=True, units='frames')
+        starts = np.unique(np.concatenate([[0], onsets])).astype('int64')
+        lengths = np.diff(starts, append=len(analysis))
+        segments = np.add.reduceat(analysis, starts, axis=0) / lengths[:, np.newaxis].astype(analysis.dtype)
+        return segments, markers[starts]
+
+
+class Framer:
+    """
+    Splits a stream of audio blocks into overlapping frames, as if the whole stream were padded with ``frame_length // 2`` samples
+    on each side and then framed, carrying the samples of incomplete frames over to the next block.
+
+    frame_length: int
+        Size in audio samples of frames.
+
+    hop_length: int
+        Size in audio samples of space between frames.
+
+    pad: str = 'constant'
+        Padding of the stream, either with zeros (``"constant"``) or with its first and last samples (``"edge"``).
+    """
+
+    def __init__(self, frame_length: int, hop_length: int, pad: str = 'constant') -> None:
+        self.frame_length = frame_length
+        self.hop_length = hop_length
+        self.pad = pad
+        self.buffer = None
+
+    def __padding(self, sample: float) -> np.ndarray:
+        return np.full(self.frame_length // 2, sample if self.pad == 'edge' else 0, dtype='float32')
+
+    def __frames(self) -> np.ndarray:
+        if len(self.buffer) < self.frame_length:
+            return np.empty((0, self.frame_length), dtype='float32')
+        num_frames = 1 + (len(self.buffer) - self.frame_length) // self.hop_length
+        frames = np.lib.stride_tricks.sliding_window_view(self.buffer, self.frame_length)[::self.hop_length][:num_frames]
+        self.buffer = self.buffer[num_frames * self.hop_length:]
+        return frames
+
+    def push(self, block: np.ndarray) -> np.ndarray:
+        """ Adds a block of samples to the stream, returning a ``(frames, frame_length)`` array with the frames it completes """
+        if not len(block):
+            return np.empty((0, self.frame_length), dtype='float32')
+        if self.buffer is None:
+            self.buffer = self.__padding(block[0])
+        self.buffer = np.concatenate([self.buffer, block])
+        return self.__frames()
+
+    def flush(self) -> np.ndarray:
+        """ Ends the stream, returning the frames that remain """
+        if self.buffer is None:
+            self.buffer = self.__padding(0)
+        self.buffer = np.concatenate([self.buffer, self.__padding(self.buffer[-1] if len(self.buffer) else 0)])
+        frames = self.__frames()
+        self.buffer = None
+        return frames
+
+
+def read_blocks(file: str, block_size: int, max_duration: float | None = None) -> Iterator:
+    """
+    Reads an audio file with ``soundfile`` as consecutive mono blocks of ``block_size`` samples, at its own sampling rate,
+    yielding the same samples as ``librosa.load(file, sr=None, mono=True, duration=max_duration)``.
+    """
+    sr = soundfile.info(file).samplerate
+    frames = -1 if max_duration is None else int(max_duration * sr)
+    for block in soundfile.blocks(file, blocksize=block_size, frames=frames, dtype='float32', always_2d=True):
+        yield block.mean(axis=1, dtype='float32') if block.shape[1] > 1 else block[:, 0]
+
+
+@lru_cache(maxsize=8)
+def get_engine(n_mfcc: int = 13, hop_length: int = 512, win_length: int = 1024, n_fft: int = 1024) -> AnalysisEngine:
+    """ Returns a shared ``AnalysisEngine`` for the given analysis parameters, so that its matrices are reused across calls """
+    return AnalysisEngine(n_mfcc=n_mfcc, hop_length=hop_length, win_length=win_length, n_fft=n_fft)
+
+
+def librosa_analysis(y: np.ndarray,
+                     features: Iterable,
+                     sr: int | None = None,
+                     n_mfcc: int = 13,
+                     hop_length: int = 512,
+                     win_length: int = 1024,
+                     n_fft: int = 1024) -> tuple:
+    """
+    Reference implementation of ``AnalysisEngine.analyze``, which calls librosa's feature extractors one by one.
+    It is used to validate and benchmark the engine.
+    """
+    S = magphase(stft(y=y,
+                      n_fft=n_fft,
+                      win_length=win_length,
+                      hop_length=hop_length))[0]
+
+    analysis = []
+    if 'timbre' in features:
+        mfcc_features = mfcc(S=S,
+                             sr=sr,
+                             n_mfcc=n_mfcc,
+                             hop_length=hop_length)
+
+        analysis.extend(mfcc_features)
+
+    if 'pitch' in features:
+        zerox = zero_crossing_rate(y=y,
+                                   frame_length=win_length,
+                                   hop_length=hop_length)
+        loudness = rms(S=S,
+                       frame_length=win_length,
+                       hop_length=hop_length)
+        chroma_features = chroma_stft(S=S,
+                                      sr=sr,
+                                      n_fft=n_fft,
+                                      win_length=win_length,
+                                      hop_length=hop_length)
+        analysis.extend(np.concatenate([chroma_features, loudness, zerox]))
+
+    analysis = np.array(analysis).T[:-1]
+
+    markers = samples_like(X=analysis,
+                           hop_length=hop_length,
+                           n_fft=n_fft,
+                           axis=0)
+
+    return analysis, markers
@@ -1,14 +1,18 @@
 from __future__ import annotations
 import sounddevice as sd
 import numpy as np
-from librosa import load
+from librosa import load, get_samplerate
+import soundfile
 from soundfile import write
 from os.path import splitext, basename
 from scipy import signal
 from typing_extensions import Self
 from collections.abc import Iterable
+import zlib
+import io
 
-from .config import AUDIO_FORMATS, CONSOLE, get_elapsed_time
+from .config import AUDIO_FORMATS, STREAMABLE_FORMATS, AUDIO_CODECS, AUDIO_CODEC_BLOCK_SIZE, CONSOLE, get_elapsed_time
+from .cache import SampleCache
 from .utils import resample_array
 from .controls import Envelope
 from .controls import Points
@@ -52,7 +56,7 @@ class AudioBuffer:
     def set_sampling_rate(self, sr: int) -> None:
         """ Sampling rate setter method """
         if self.sr != sr:
-            self.y = resample_array(self.y, int(round(len(self.y) * sr/self.sr)))
+            self.y = resample_array(self.y, int(round(len(self.y) * sr/self.sr)), dtype=self.y.dtype)
         self.sr = sr
 
     def read(self, input_dir: str, sr: int | None = None, mono: bool = False) -> Self:
@@ -85,37 +89,301 @@ class AudioBuffer:
         self.y = (self.y.sum(axis=1)[: np.newaxis] / self.chans).reshape((self.samps, 1))
 
     def convolve(self, impulse_response: Self | str, mix: int | float | Iterable | Envelope = 0.125, normalize: bool = True) -> None:
-        """ Applies impulse response convolution to audio """
+        """ Applies impulse response convolution to audio, keeping the ``dtype`` of the audio samples """
+        dtype = self.y.dtype
+
         def parse_mix_param(mix, N):
             if isinstance(mix, Envelope):
                 mix_param = mix.get_points(N)
             elif isinstance(mix, Iterable):
                 mix_param = Envelope(mix).get_points(N)
             else:
-                mix_param = Points().fill(N, mix)
-            return mix_param[:, np.newaxis]
+                mix_param = Points().fill(N, mix, dtype=dtype)
+            return mix_param[:, np.newaxis].astype(dtype, copy=False)
 
         y_samps = self.samps
 
         # prepare impulse response and generate convolved signal
         ir = impulse_response if isinstance(impulse_response, AudioBuffer) else AudioBuffer().read(impulse_response, mono=True)
         ir.to_mono()
-        y_wet = signal.convolve(in1=self.y, in2=ir.y, method='auto')
+        y_wet = signal.convolve(in1=self.y, in2=ir.y.astype(dtype, copy=False), method='auto')
 
         # reshape to match convolved signal
-        y_dry = np.zeros(shape=y_wet.shape)
+        y_dry = np.zeros(shape=y_wet.shape, dtype=dtype)
         y_dry[:self.samps] = self.y
         self.y = y_dry
 
         # normalize
         if normalize:
-            y_wet = (y_wet / np.max(np.abs(y_wet))) * np.sqrt(0.5)
+            y_wet = ((y_wet / np.max(np.abs(y_wet))) * np.sqrt(0.5)).astype(dtype, copy=False)
 
         # parse wet/dry mix control parameter
-        mix_param = np.zeros(shape=(y_wet.shape[0], 1))
+        mix_param = np.zeros(shape=(y_wet.shape[0], 1), dtype=dtype)
         tmp = parse_mix_param(mix, y_samps)
         mix_param[:y_samps] = tmp
         mix_param[y_samps:] = tmp[-1]
 
         # mix both signals
         self.y = y_dry * (1 - mix_param) + y_wet * mix_param
+
+
+class AudioFile:
+    """
+    Read-only mono samples of an audio file, loaded on demand. It can be measured and sliced like the ``ndarray`` returned by
+    ``librosa.load(file, sr=sr, mono=True, duration=max_duration)``, but only the requested sample ranges are read, so that
+    corpora larger than the available memory can be used.
+
+    Uncompressed and FLAC files at their own sampling rate are read directly from disk, by sample ranges.
+    Other files (e.g., MP3 or resampled files) are decoded once and stored in a ``gamut.cache.SampleCache``, from which they are memory-mapped.
+
+    file: str
+        Path to the audio file.
+
+    sr: int | None = None
+        Sampling rate of the samples. If ``None``, the file is read at its own sampling rate.
+
+    max_duration: float | None = None
+        Maximum duration in seconds to read from the file.
+
+    length: int | None = None
+        Number of samples of the file, if known, so that it can be measured without opening it.
+
+    in_memory: bool = False
+        If ``True``, the file is decoded whole and kept in memory when it is first read, rather than read by sample ranges,
+        so that samples are only loaded once needed (e.g., for the cached sources of a corpus that is not ``lazy``).
+    """
+
+    def __init__(self, file: str, sr: int | None = None, max_duration: float | None = None, length: int | None = None, in_memory: bool = False) -> None:
+        self.file = file
+        self.sr = sr
+        self.max_duration = max_duration
+        self.length = length
+        self.in_memory = in_memory
+        self.__direct = False
+        self.__samples = None
+
+    def open(self) -> Self:
+        """ Opens the file for reading, or memory-maps its decoded samples, which resolves its sampling rate and length """
+        if self.__direct or self.__samples is not None:
+            return self
+        if self.in_memory:
+            self.__samples, self.sr = load(self.file, sr=self.sr, mono=True, duration=self.max_duration)
+            self.length = len(self.__samples)
+            return self
+        try:
+            info = soundfile.info(self.file)
+        except (soundfile.LibsndfileError, RuntimeError):
+            info = None
+        if info is not None and info.format in STREAMABLE_FORMATS and self.sr in [None, info.samplerate]:
+            self.sr = info.samplerate
+            self.length = info.frames if self.max_duration is None else min(info.frames, int(self.max_duration * self.sr))
+            self.__direct = True
+            return self
+
+        cache = SampleCache()
+        key = cache.key(self.file, sr=self.sr, max_duration=self.max_duration)
+        samples = cache.get(key)
+        if self.sr is None and samples is not None:
+            self.sr = info.samplerate if info is not None else get_samplerate(self.file)
+        if samples is None:
+            y, self.sr = load(self.file, sr=self.sr, mono=True, duration=self.max_duration)
+            cache.put(key, y)
+            samples = cache.get(key)
+        self.__samples = samples if samples is not None else y
+        self.length = len(self.__samples)
+        return self
+
+    def __len__(self) -> int:
+        if self.length is None:
+            self.open()
+        return self.length
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self),)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype('float32')
+
+    def __getitem__(self, key: int | slice) -> np.ndarray | float:
+        self.open()
+        if self.__samples is not None:
+            return np.asarray(self.__samples[key])
+        indices = range(self.length)[key]
+        if isinstance(indices, int):
+            return self.__read(indices, indices + 1)[0]
+        if indices.step == 1:
+            return self.__read(indices.start, max(indices.start, indices.stop))
+        if not indices:
+            return np.empty(0, dtype='float32')
+        start = min(indices[0], indices[-1])
+        return self.__read(start, max(indices[0], indices[-1]) + 1)[np.array(indices) - start]
+
+    def __read(self, start: int, stop: int) -> np.ndarray:
+        """ reads samples from ``start`` to ``stop``, mixed down to mono """
+        y = soundfile.read(self.file, frames=stop - start, start=start, dtype='float32', always_2d=True)[0]
+        return y.mean(axis=1, dtype='float32') if y.shape[1] > 1 else y[:, 0]
+
+    def __array__(self, dtype: np.dtype | None = None, copy: bool | None = None) -> np.ndarray:
+        y = self[:]
+        return y if dtype is None else y.astype(dtype)
+
+    def __getstate__(self) -> dict:
+        # open files and memory maps are not copied, but reopened on demand
+        return {'file': self.file, 'sr': self.sr, 'max_duration': self.max_duration, 'length': self.length, 'in_memory': self.in_memory}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['file'], sr=state['sr'], max_duration=state['max_duration'], length=state['length'], in_memory=state.get('in_memory', False))
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({basename(self.file)!r}, sr={self.sr}, length={self.length})'
+
+
+class EncodedAudio:
+    """
+    Mono ``float32`` samples stored with one of ``config.AUDIO_CODECS``, as embedded in portable ``.gamut`` files written with an ``audio_codec``.
+    It can be measured and sliced like an ``ndarray``, decoding only the requested sample ranges.
+
+    With ``"pcm16"`` and ``"pcm24"``, samples are clipped to [-1, 1] and stored as 16 or 24-bit integers, which can be read by sample ranges.
+    With ``"flac"`` (24-bit FLAC, through ``soundfile``), ``"zlib"`` and ``"zstd"`` (lossless, which requires the ``zstandard`` package),
+    samples are compressed in blocks of ``block_size`` samples, so that reading a range of samples only decompresses the blocks it spans.
+    The last decoded block is kept, since consecutive reads (e.g., grains) often fall in the same block.
+
+    codec: str
+        Audio codec, as one of ``config.AUDIO_CODECS``.
+
+    length: int
+        Number of samples.
+
+    data: np.ndarray
+        Encoded samples: an ``int16`` array for ``"pcm16"``, an ``(N, 3)`` ``uint8`` array for ``"pcm24"``,
+        or the concatenated compressed blocks, as an ``uint8`` array.
+
+    offsets: np.ndarray | None = None
+        Start of each compressed block in ``data``, followed by the size of ``data``.
+
+    block_size: int = config.AUDIO_CODEC_BLOCK_SIZE
+        Number of samples per compressed block.
+
+    sr: int | None = None
+        Sampling rate of the samples, stored in FLAC blocks.
+    """
+
+    def __init__(self,
+                 codec: str,
+                 length: int,
+                 data: np.ndarray,
+                 offsets: np.ndarray | None = None,
+                 block_size: int = AUDIO_CODEC_BLOCK_SIZE,
+                 sr: int | None = None) -> None:
+        if codec not in AUDIO_CODECS:
+            CONSOLE.error(ValueError, f'"{codec}" is not a valid audio codec. Choose one of the following: {AUDIO_CODECS}')
+        self.codec = codec
+        self.length = length
+        self.data = data
+        self.offsets = offsets
+        self.block_size = block_size
+        self.sr = sr
+        self.__block = (None, None)
+
+    @classmethod
+    def encode(cls, y: np.ndarray | AudioFile, codec: str, block_size: int = AUDIO_CODEC_BLOCK_SIZE, sr: int | None = None) -> Self:
+        """ Encodes the samples of a 1D ``ndarray`` (or array-like, such as an ``AudioFile``) with ``codec``, reading them in blocks """
+        encoded = cls(codec, len(y), None, block_size=block_size, sr=sr)
+        blocks = [encoded.__encode_block(np.asarray(y[i:i+block_size], dtype='float32')) for i in range(0, len(y), block_size)]
+        if codec in ['pcm16', 'pcm24']:
+            encoded.data = np.concatenate(blocks) if blocks else encoded.__encode_block(np.empty(0, dtype='float32'))
+            return encoded
+        encoded.offsets = np.cumsum([0] + [len(block) for block in blocks], dtype='int64')
+        encoded.data = np.frombuffer(b''.join(blocks), dtype='uint8')
+        return encoded
+
+    def serialize(self) -> dict:
+        """ Returns the state of the encoded samples as a ``dict`` of arrays and numbers, which can be restored with ``EncodedAudio(**state)`` """
+        return {'codec': self.codec, 'length': self.length, 'data': self.data, 'offsets': self.offsets, 'block_size': self.block_size, 'sr': self.sr}
+
+    @staticmethod
+    def __zstd():
+        try:
+            import zstandard
+        except ImportError:
+            CONSOLE.error(ImportError, 'The "zstd" audio codec requires the zstandard package. Install it with: pip install zstandard')
+        return zstandard
+
+    def __encode_block(self, y: np.ndarray) -> np.ndarray | bytes:
+        if self.codec == 'pcm16':
+            return np.round(np.clip(y, -1.0, 1.0) * (2**15 - 1)).astype('int16')
+        if self.codec == 'pcm24':
+            samples = np.round(np.clip(y, -1.0, 1.0) * (2**23 - 1)).astype('<i4')
+            return samples.view('uint8').reshape(-1, 4)[:, :3]
+        if self.codec == 'flac':
+            buffer = io.BytesIO()
+            soundfile.write(buffer, np.clip(y, -1.0, 1.0), self.sr or 44100, subtype='PCM_24', format='FLAC')
+            return buffer.getvalue()
+        if self.codec == 'zlib':
+            return zlib.compress(y.tobytes())
+        return self.__zstd().ZstdCompressor().compress(y.tobytes())
+
+    def __decode_block(self, index: int) -> np.ndarray:
+        if self.__block[0] == index:
+            return self.__block[1]
+        data = self.data[self.offsets[index]:self.offsets[index+1]]
+        if self.codec == 'flac':
+            y = soundfile.read(io.BytesIO(data.tobytes()), dtype='float32')[0]
+        elif self.codec == 'zlib':
+            y = np.frombuffer(zlib.decompress(data), dtype='float32')
+        else:
+            y = np.frombuffer(self.__zstd().ZstdDecompressor().decompress(data.tobytes()), dtype='float32')
+        self.__block = (index, y)
+        return y
+
+    def __read(self, start: int, stop: int) -> np.ndarray:
+        """ decodes samples from ``start`` to ``stop`` """
+        if self.codec == 'pcm16':
+            return self.data[start:stop].astype('float32') / np.float32(2**15 - 1)
+        if self.codec == 'pcm24':
+            data = self.data[start:stop].astype('int32')
+            samples = (data[:, 0] | (data[:, 1] << 8) | (data[:, 2] << 16)) << 8 >> 8
+            return samples.astype('float32') / np.float32(2**23 - 1)
+        if stop <= start:
+            return np.empty(0, dtype='float32')
+        first, last = start // self.block_size, (stop - 1) // self.block_size
+        blocks = [self.__decode_block(i) for i in range(first, last + 1)]
+        y = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+        offset = first * self.block_size
+        return y[start - offset:stop - offset]
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def shape(self) -> tuple:
+        return (self.length,)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype('float32')
+
+    @property
+    def nbytes(self) -> int:
+        """ size of the encoded samples, in bytes """
+        return self.data.nbytes + (0 if self.offsets is None else self.offsets.nbytes)
+
+    def __getitem__(self, key: int | slice) -> np.ndarray | float:
+        indices = range(self.length)[key]
+        if isinstance(indices, int):
+            return self.__read(indices, indices + 1)[0]
+        if indices.step == 1:
+            return self.__read(indices.start, max(indices.start, indices.stop))
+        if not indices:
+            return np.empty(0, dtype='float32')
+        start = min(indices[0], indices[-1])
+        return self.__read(start, max(indices[0], indices[-1]) + 1)[np.array(indices) - start]
+
+    def __array__(self, dtype: np.dtype | None = None, copy: bool | None = None) -> np.ndarray:
+        y = self[:]
+        return y if dtype is None else y.astype(dtype)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(codec={self.codec!r}, length={self.length}, nbytes={self.nbytes})'
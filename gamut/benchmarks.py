@@ -0,0 +1,236 @@
+from __future__ import annotations
+# gamut
+from .features import Corpus, Mosaic
+from .data import INDICES, BruteForce, compute_recall
+from .analysis import AnalysisEngine, librosa_analysis
+from .config import CONSOLE, INDEX_TYPES, FILE_EXT, AUDIO_DTYPES
+
+# misc
+from librosa import load
+from os.path import splitext
+from time import perf_counter
+import tracemalloc
+import random
+
+# typing
+from collections.abc import Iterable
+
+# numpy
+import numpy as np
+
+
+def benchmark_indices(corpus: Corpus | str | list,
+                      target: str | None = None,
+                      indices: Iterable | None = None,
+                      k: int | None = None,
+                      num_queries: int = 1000,
+                      options: dict | None = None,
+                      verbose: bool = True,
+                      **kwargs) -> dict:
+    """
+    Compares the nearest neighbor indices of ``gamut.data`` on the grains of a real corpus, measuring their build time,
+    query throughput, memory and recall against an exact brute force search, so that the best index for a corpus can be picked with data.
+    Returns a ``dict`` mapping each index type to its measurements, which are also printed as a table if ``verbose`` is ``True``.
+
+    corpus: Corpus | str | list
+        ``Corpus`` instance, path to a ``.gamut`` corpus file, or audio source(s) from which to build a corpus.
+        The corpus must be indexed with a ``"kdtree"``, ``"balltree"`` or ``"brute"`` index without projection,
+        since other indices do not keep the original grain features.
+
+    target: str | None = None
+        Optional audio file whose segments are used as queries, as when building a ``Mosaic``.
+        Otherwise, queries are randomly sampled from the corpus grains.
+
+    indices: Iterable | None = None
+        Index types to compare. Defaults to all of them.
+
+    k: int | None = None
+        Number of nearest neighbors per query. Defaults to the leaf size of the corpus.
+
+    num_queries: int = 1000
+        Maximum number of queries.
+
+    options: dict | None = None
+        Extra arguments for each index type, as a ``dict`` mapping index types to ``dict`` objects (e.g., ``{'ivfpq': {'nprobe': 16}}``).
+
+    kwargs
+        Search options passed to the ``knn_batch`` method of every index (e.g., ``search="exact"`` or ``max_leaves=4``).
+    """
+    if isinstance(corpus, str) and splitext(corpus)[1] == FILE_EXT:
+        corpus = Corpus().read(corpus)
+    elif not isinstance(corpus, Corpus):
+        corpus = Corpus(source=corpus, index='brute')
+    if not corpus.tree.mergeable:
+        CONSOLE.error(ValueError, f'Corpora indexed with "{corpus.index}" and/or a projection cannot be benchmarked, since their original features are not kept')
+
+    indices = list(indices or [kind for kind in INDEX_TYPES if kind in INDICES])
+    for kind in indices:
+        if kind not in INDICES:
+            CONSOLE.error(ValueError, f'"{kind}" is not a valid index type. Choose one of the following: {list(INDICES)}')
+    options = options or {}
+    k = k or corpus.leaf_size
+
+    # original features of the corpus grains
+    features = corpus.tree._denormalize(corpus.tree.features)
+    columns = {'sources': corpus.tree.sources, 'markers': corpus.tree.markers}
+
+    if target:
+        y, sr = load(target, sr=None)
+        queries = corpus._analyze_audio_file(y=y, features=corpus.features, sr=sr)[0]
+    else:
+        queries = features
+    queries = queries[np.random.default_rng().choice(len(queries), min(num_queries, len(queries)), replace=False)]
+
+    CONSOLE.log_process(f'\N{stopwatch} Benchmarking {len(indices)} indices on {len(features)} grains...').print()
+    reference = BruteForce()
+    reference.fit(features, **columns)
+    reference_distances = reference.knn_batch(queries, k)[1]
+
+    results = {}
+    for kind in indices:
+        CONSOLE.log_subprocess(f'Benchmarking {kind} index...').print()
+        kind_options = dict(options.get(kind, {}))
+        if kind in ['kdtree', 'balltree']:
+            kind_options.setdefault('leaf_size', corpus.leaf_size)
+        index = INDICES[kind](**kind_options)
+
+        start = perf_counter()
+        index.fit(features, **columns)
+        build_time = perf_counter() - start
+
+        start = perf_counter()
+        found = index.knn_batch(queries, k, **kwargs)[0]
+        query_time = perf_counter() - start
+
+        results[kind] = {
+            'build time': build_time,
+            'queries per second': len(queries) / query_time,
+            'memory': index.nbytes,
+            'bytes per grain': index.nbytes / len(index),
+            'recall': compute_recall(index, found, reference, queries, reference_distances),
+        }
+
+    if verbose:
+        print_benchmark(results, k)
+    return results
+
+
+def print_benchmark(results: dict, k: int) -> None:
+    """ Prints the results of ``benchmark_indices`` as a table """
+    header = f'{"index":<10}{"build (s)":>12}{"queries/s":>14}{"memory (MB)":>14}{"bytes/grain":>14}{f"recall@{k}":>12}'
+    line = "".join("-" for _ in range(len(header)))
+    print(f'{CONSOLE.c4}{header}{CONSOLE.reset}\n{CONSOLE.c3}{line}{CONSOLE.reset}')
+    for kind, result in results.items():
+        print(f'{kind:<10}{result["build time"]:>12.3f}{result["queries per second"]:>14.0f}'
+              f'{result["memory"] / 2**20:>14.1f}{result["bytes per grain"]:>14.1f}{result["recall"]:>12.1%}')
+
+
+def benchmark_analysis(corpus: Corpus | str | list,
+                       features: Iterable | None = None,
+                       verbose: bool = True,
+                       **params) -> dict:
+    """
+    Compares the throughput of ``AnalysisEngine`` with that of calling librosa's feature extractors one by one (i.e., ``librosa_analysis``),
+    on the audio sources of a corpus, and measures the largest difference between their outputs, relative to the range of each feature.
+    Returns a ``dict`` with the measurements, which are also printed if ``verbose`` is ``True``.
+
+    corpus: Corpus | str | list
+        ``Corpus`` instance, path to a ``.gamut`` corpus file, or audio source(s) from which to build a corpus.
+
+    features: Iterable | None = None
+        Audio features to extract. Defaults to those of the corpus.
+
+    params
+        Analysis parameters (i.e., ``n_mfcc``, ``hop_length``, ``win_length`` and ``n_fft``). Default to those of the corpus.
+    """
+    if isinstance(corpus, str) and splitext(corpus)[1] == FILE_EXT:
+        corpus = Corpus().read(corpus)
+    elif not isinstance(corpus, Corpus):
+        corpus = Corpus(source=corpus, index='brute', cache=False)
+    features = features or corpus.features
+    params = {**corpus._analysis_params(), **params}
+    signals = [(np.asarray(sf['y']), sf['sr']) for sf in corpus.soundfiles]
+    CONSOLE.log_process(f'\N{stopwatch} Benchmarking audio analysis on {len(signals)} files...').print()
+
+    start = perf_counter()
+    reference = [librosa_analysis(y, features, sr=sr, **params) for y, sr in signals]
+    librosa_time = perf_counter() - start
+
+    start = perf_counter()
+    results = AnalysisEngine(**params).analyze_batch(signals, features)
+    engine_time = perf_counter() - start
+
+    num_frames = sum(len(analysis) for analysis, _ in reference)
+    error = max(np.max(np.abs(expected - analysis) / np.maximum(np.ptp(expected, axis=0), np.finfo('float32').eps))
+                for (expected, _), (analysis, _) in zip(reference, results) if len(expected))
+    benchmark = {
+        'frames': num_frames,
+        'librosa frames per second': num_frames / librosa_time,
+        'engine frames per second': num_frames / engine_time,
+        'speedup': librosa_time / engine_time,
+        'max relative error': float(error),
+    }
+    if verbose:
+        for key, value in benchmark.items():
+            CONSOLE.log_subprocess(f'{key}: {value:.3g}' if isinstance(value, float) else f'{key}: {value}').print()
+    return benchmark
+
+
+def benchmark_memory(mosaic: Mosaic | str,
+                     dtypes: Iterable = AUDIO_DTYPES,
+                     verbose: bool = True,
+                     **params) -> dict:
+    """
+    Compares the peak memory and run time of ``Mosaic.to_audio`` for each audio ``dtype``, as traced by ``tracemalloc``,
+    along with the size of the output buffer and its largest difference from the ``float64`` output.
+    Every ``dtype`` is rendered with the same random seed, and the state of the random number generators is restored afterwards.
+    Returns a ``dict`` mapping each ``dtype`` to its measurements, which are also printed as a table if ``verbose`` is ``True``.
+
+    mosaic: Mosaic | str
+        ``Mosaic`` instance or path to a ``.gamut`` mosaic file.
+
+    dtypes: Iterable = config.AUDIO_DTYPES
+        Data types to compare.
+
+    params
+        Audio parameters passed to ``Mosaic.to_audio`` (e.g., ``grain_dur=0.2`` or ``n_chans=4``).
+    """
+    if isinstance(mosaic, str):
+        mosaic = Mosaic().read(mosaic)
+    dtypes = list(dtypes)
+    for dtype in dtypes:
+        if dtype not in AUDIO_DTYPES:
+            CONSOLE.error(ValueError, f'"{dtype}" is not a valid audio dtype. Choose one of the following: {AUDIO_DTYPES}')
+
+    CONSOLE.log_process(f'\N{stopwatch} Benchmarking memory of {len(dtypes)} audio data types...').print()
+    states = random.getstate(), np.random.get_state()
+    outputs = {}
+    results = {}
+    for dtype in sorted(dtypes, key=lambda x: x != 'float64'):
+        random.seed(0)
+        np.random.seed(0)
+        tracemalloc.start()
+        start = perf_counter()
+        y = mosaic.to_audio(dtype=dtype, **params).y
+        render_time = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        outputs[dtype] = y
+        results[dtype] = {
+            'render time': render_time,
+            'peak memory': peak,
+            'output memory': y.nbytes,
+            'max difference': float(np.max(np.abs(y - outputs['float64']))) if 'float64' in outputs else None,
+        }
+    random.setstate(states[0])
+    np.random.set_state(states[1])
+
+    if verbose:
+        header = f'{"dtype":<10}{"render (s)":>12}{"peak (MB)":>12}{"output (MB)":>14}{"max diff":>12}'
+        line = "".join("-" for _ in range(len(header)))
+        print(f'{CONSOLE.c4}{header}{CONSOLE.reset}\n{CONSOLE.c3}{line}{CONSOLE.reset}')
+        for dtype, result in results.items():
+            diff = "-" if result["max difference"] is None else f'{result["max difference"]:.2e}'
+            print(f'{dtype:<10}{result["render time"]:>12.3f}{result["peak memory"] / 2**20:>12.1f}'
+                  f'{result["output memory"] / 2**20:>14.1f}{diff:>12}')
+    return {dtype: results[dtype] for dtype in dtypes}
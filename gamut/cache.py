@@ -0,0 +1,142 @@
+from __future__ import annotations
+# gamut
+from .config import CACHE_DIR, CACHE_MAX_SIZE, SAMPLE_CACHE_DIR, SAMPLE_CACHE_MAX_SIZE
+
+# misc
+from librosa import __version__ as librosa_version
+from os.path import join, realpath
+from zipfile import BadZipFile
+import hashlib
+import json
+import os
+
+# numpy
+import numpy as np
+
+
+class FeatureCache:
+    """
+    On-disk cache of audio analysis results, stored as one ``.npz`` file per entry.
+
+    Entries are keyed by the identity of the analyzed file (real path, size and modification time) and the analysis parameters,
+    so that editing a file or changing any parameter invalidates them. Reading an entry updates its modification time,
+    and once the cache exceeds ``max_size`` bytes, the least recently used entries are deleted by ``evict``.
+    Entries are written atomically, so the cache can be shared by several processes.
+
+    directory: str = config.CACHE_DIR
+        Directory where entries are stored (``~/.gamut/cache`` by default).
+
+    max_size: int = config.CACHE_MAX_SIZE
+        Maximum size of the cache in bytes.
+    """
+
+    # bump to invalidate entries when the analysis pipeline changes
+    VERSION = 2
+    EXTENSION = '.npz'
+
+    def __init__(self, directory: str = CACHE_DIR, max_size: int = CACHE_MAX_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, file: str, **params) -> str:
+        """ Returns the cache key of the analysis of ``file`` with the given analysis parameters """
+        stat = os.stat(file)
+        identity = {
+            'file': realpath(file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'params': params,
+            'version': self.VERSION,
+            'librosa': librosa_version,
+        }
+        return hashlib.sha1(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return join(self.directory, f'{key}{self.EXTENSION}')
+
+    def get(self, key: str) -> dict | None:
+        """ Returns the arrays stored under ``key`` as a ``dict``, or ``None`` if there is no such entry """
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            # mark entry as recently used
+            os.utime(path)
+        except (OSError, ValueError, EOFError, BadZipFile):
+            return None
+        return arrays
+
+    def put(self, key: str, **arrays) -> None:
+        """ Stores ``arrays`` under ``key`` """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)
+
+    def evict(self) -> None:
+        """ Deletes the least recently used entries until the cache fits in ``max_size`` bytes """
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.EXTENSION):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+
+    def clear(self) -> None:
+        """ Deletes all entries """
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.EXTENSION) or entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+
+
+class SampleCache(FeatureCache):
+    """
+    On-disk cache of decoded audio samples, stored as one ``.npy`` file per entry, so that they can be memory-mapped.
+    It holds the samples of compressed audio files (e.g., MP3) read through ``gamut.audio.AudioFile``, which cannot be read by sample ranges.
+    Keys and eviction work as in ``FeatureCache``.
+
+    directory: str = config.SAMPLE_CACHE_DIR
+        Directory where entries are stored (``~/.gamut/samples`` by default).
+
+    max_size: int = config.SAMPLE_CACHE_MAX_SIZE
+        Maximum size of the cache in bytes.
+    """
+
+    EXTENSION = '.npy'
+
+    def __init__(self, directory: str = SAMPLE_CACHE_DIR, max_size: int = SAMPLE_CACHE_MAX_SIZE) -> None:
+        super().__init__(directory=directory, max_size=max_size)
+
+    def get(self, key: str) -> np.ndarray | None:
+        """ Returns the samples stored under ``key`` as a read-only memory-mapped ``ndarray``, or ``None`` if there is no such entry """
+        path = self._path(key)
+        try:
+            samples = np.load(path, mmap_mode='r')
+            # mark entry as recently used
+            os.utime(path)
+        except (OSError, ValueError, EOFError):
+            return None
+        return samples
+
+    def put(self, key: str, samples: np.ndarray) -> None:
+        """ Stores ``samples`` under ``key`` """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, samples)
+        os.replace(temp_path, path)
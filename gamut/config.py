@@ -5,11 +5,36 @@ from typing import Any, Callable
 import os
 
 FILE_EXT = '.gamut'
+FILE_MAGIC = b'\x93GAMUT'
+FILE_VERSION = 2
+FILE_ALIGNMENT = 64
+FILE_BLOCK_SIZE = 16 * 2**20
+AUDIO_CODECS = ['pcm16', 'pcm24', 'flac', 'zlib', 'zstd']
+AUDIO_CODEC_BLOCK_SIZE = 2**16
 AUDIO_FORMATS = ['.wav', '.aif', '.aiff', '.mp3']
 MIME_TYPES = ['audio/x-wav', 'audio/x-aiff', 'audio/mpeg']
 AUDIO_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'gui/data/audio/')
 CONSOLE = Console()
 ANALYSIS_TYPES = ['timbre', 'pitch']
+SEARCH_MODES = ['exact', 'approx']
+SEGMENTATION_TYPES = ['frame', 'onset']
+INDEX_TYPES = ['auto', 'kdtree', 'balltree', 'brute', 'ivfpq']
+PROJECTIONS = ['pca', 'random']
+BRUTE_FORCE_MAX_SIZE = 2**19
+BRUTE_FORCE_CELL_SIZE = 1024
+MERGED_INDEX_CACHE_SIZE = 4
+MEMORY_BUDGET = 256 * 2**20
+ANALYSIS_BATCH_SIZE = 16
+SCAN_WORKERS = 32
+TARGET_CACHE_SIZE = 8
+AUDIO_DTYPES = ['float32', 'float64']
+AUDIO_DTYPE = 'float64'
+STREAMABLE_FORMATS = ['WAV', 'AIFF', 'FLAC', 'W64', 'RF64', 'CAF']
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.gamut', 'cache')
+CACHE_MAX_SIZE = 2 * 2**30
+SAMPLE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.gamut', 'samples')
+SAMPLE_CACHE_MAX_SIZE = 16 * 2**30
+OBJECTS_DIR = os.path.join(os.path.expanduser('~'), '.gamut', 'objects')
 ENVELOPE_TYPES = [
     'barthann',
     'bartlett',
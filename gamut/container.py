@@ -0,0 +1,170 @@
+from __future__ import annotations
+# gamut
+from .config import CONSOLE, FILE_MAGIC, FILE_VERSION, FILE_ALIGNMENT, FILE_BLOCK_SIZE
+
+# misc
+import json
+import os
+import pickle
+import struct
+
+# numpy
+import numpy as np
+
+# legacy .gamut files are pickled dicts saved with np.save
+NPY_MAGIC = b'\x93NUMPY'
+
+# keys of tagged JSON objects, for values without a JSON equivalent
+ARRAY_TAG = '__array__'
+DICT_TAG = '__dict__'
+TUPLE_TAG = '__tuple__'
+PICKLE_TAG = '__pickle__'
+TAGS = {ARRAY_TAG, DICT_TAG, TUPLE_TAG, PICKLE_TAG}
+
+# Version 2 .gamut files are laid out as:
+#
+#   magic (6 bytes) | version (uint16) | header size (uint64) | JSON header | padding | array sections
+#
+# The JSON header holds the object tree, with every array replaced by a reference to an entry of its "arrays" list,
+# which stores the dtype, shape and offset (from the first array section) of the raw, C-ordered bytes of the array.
+# Array sections start at multiples of config.FILE_ALIGNMENT bytes, so that they can be memory-mapped as they are.
+
+
+def _align(n: int) -> int:
+    return -(-n // FILE_ALIGNMENT) * FILE_ALIGNMENT
+
+
+def _encode(value: object, arrays: list) -> object:
+    """ encodes ``value`` as a JSON-compatible object, appending its arrays to ``arrays`` """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        arrays.append(value)
+        return {ARRAY_TAG: len(arrays) - 1}
+    if isinstance(value, np.generic) and not isinstance(value, np.object_):
+        return value.item()
+    if not isinstance(value, (np.ndarray, np.generic)) and hasattr(value, '__array__') and hasattr(value, 'shape') and hasattr(value, 'dtype'):
+        # array-likes that are read on demand (e.g., gamut.audio.AudioFile) are written in blocks
+        arrays.append(value)
+        return {ARRAY_TAG: len(arrays) - 1}
+    if isinstance(value, list):
+        return [_encode(v, arrays) for v in value]
+    if isinstance(value, tuple):
+        return {TUPLE_TAG: [_encode(v, arrays) for v in value]}
+    if isinstance(value, dict):
+        if all(isinstance(k, str) for k in value) and not (len(value) == 1 and TAGS.intersection(value)):
+            return {k: _encode(v, arrays) for k, v in value.items()}
+        # keep non-string keys (e.g., corpus ids of mosaic soundfiles) as key-value pairs
+        return {DICT_TAG: [[_encode(k, arrays), _encode(v, arrays)] for k, v in value.items()]}
+    # fall back to pickling anything else, such as arrays of objects
+    arrays.append(np.frombuffer(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), dtype='uint8'))
+    return {PICKLE_TAG: len(arrays) - 1}
+
+
+def _descr_to_dtype(descr: str | list) -> np.dtype:
+    """ JSON turns the field tuples of structured dtype descriptions into lists, which numpy does not accept """
+    def to_fields(descr: str | list) -> str | list:
+        if not isinstance(descr, list):
+            return descr
+        return [(name, to_fields(fmt), *(tuple(shape) for shape in rest)) for name, fmt, *rest in descr]
+    return np.lib.format.descr_to_dtype(to_fields(descr))
+
+
+def _decode(value: object, arrays: list) -> object:
+    """ inverse of ``_encode``, given the decoded ``arrays`` """
+    if isinstance(value, list):
+        return [_decode(v, arrays) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        tag, content = next(iter(value.items()))
+        if tag == ARRAY_TAG:
+            return arrays[content]
+        if tag == TUPLE_TAG:
+            return tuple(_decode(v, arrays) for v in content)
+        if tag == DICT_TAG:
+            return {_decode(k, arrays): _decode(v, arrays) for k, v in content}
+        if tag == PICKLE_TAG:
+            return pickle.loads(arrays[content].tobytes())
+    return {k: _decode(v, arrays) for k, v in value.items()}
+
+
+def _write_array(f, array: np.ndarray | object) -> None:
+    """ writes the raw bytes of an array without copying it (unless it is not contiguous), or of an array-like in blocks of rows """
+    if isinstance(array, np.ndarray):
+        f.write(np.ascontiguousarray(array).reshape(-1).view('uint8').data)
+        return
+    row_size = max(1, int(np.prod(array.shape[1:])) * array.dtype.itemsize)
+    block_size = max(1, FILE_BLOCK_SIZE // row_size)
+    for start in range(0, array.shape[0], block_size):
+        block = np.asarray(array[start:start + block_size], dtype=array.dtype)
+        f.write(np.ascontiguousarray(block).reshape(-1).view('uint8').data)
+
+
+def write_container(file: str, obj: dict, metadata: dict | None = None) -> None:
+    """
+    Writes a ``dict`` to ``file`` as a version 2 ``.gamut`` container, where arrays are stored as raw, aligned sections after a JSON header.
+    ``metadata`` is stored in the header as it is (values that JSON cannot encode are stored as strings), so that it can be read with ``read_header`` alone.
+    Arrays are written straight from the objects in ``obj``, and array-likes with ``shape`` and ``dtype`` attributes are read and written in blocks.
+    The file is written next to ``file`` and then moved in place, so that containers memory-mapped by ``read_container`` are left intact.
+    """
+    arrays = []
+    tree = _encode(obj, arrays)
+    entries = []
+    offset = 0
+    for array in arrays:
+        entries.append({'dtype': np.lib.format.dtype_to_descr(array.dtype), 'shape': tuple(array.shape), 'offset': offset})
+        offset = _align(offset + int(np.prod(array.shape)) * array.dtype.itemsize)
+    header = json.dumps({'version': FILE_VERSION, 'metadata': metadata, 'object': tree, 'arrays': entries}, default=str).encode()
+    prefix = FILE_MAGIC + struct.pack('<HQ', FILE_VERSION, len(header))
+    padding = _align(len(prefix) + len(header)) - len(prefix) - len(header)
+
+    temp_file = f'{file}.{os.getpid()}.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(prefix + header + b' ' * padding)
+        start = f.tell()
+        for array, entry in zip(arrays, entries):
+            f.write(b'\0' * (start + entry['offset'] - f.tell()))
+            _write_array(f, array)
+    os.replace(temp_file, file)
+
+
+def read_header(file: str) -> tuple:
+    """ Returns the version of a ``.gamut`` file along with its JSON header and the offset of its first array section (``None`` for version 1 files) """
+    with open(file, 'rb') as f:
+        magic = f.read(len(FILE_MAGIC))
+        if magic == NPY_MAGIC:
+            return 1, None, None
+        if magic != FILE_MAGIC:
+            CONSOLE.error(ValueError, f'{file} is not a .gamut file')
+        version, size = struct.unpack('<HQ', f.read(struct.calcsize('<HQ')))
+        if version > FILE_VERSION:
+            CONSOLE.error(ValueError, f'{file} was written with a newer version of gamut (file format version {version})')
+        header = json.loads(f.read(size))
+        return version, header, _align(f.tell())
+
+
+def read_container(file: str, mmap: bool = True) -> dict:
+    """
+    Reads a ``dict`` written by ``write_container``, or by ``np.save`` for version 1 ``.gamut`` files.
+    If ``mmap`` is ``True``, arrays are copy-on-write views of a memory map of the file, so that they are only read from disk when used
+    and can be modified without changing the file. Otherwise, they are read into memory.
+    """
+    version, header, start = read_header(file)
+    if version == 1:
+        return np.load(file, allow_pickle=True).item()
+
+    if mmap and header['arrays']:
+        buffer = np.memmap(file, dtype='uint8', mode='c').view(np.ndarray)
+    else:
+        buffer = np.empty(os.path.getsize(file), dtype='uint8')
+        with open(file, 'rb') as f:
+            f.readinto(buffer)
+    arrays = []
+    for entry in header['arrays']:
+        dtype = _descr_to_dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        offset = start + entry['offset']
+        size = int(np.prod(shape)) * dtype.itemsize
+        arrays.append(buffer[offset:offset + size].view(dtype).reshape(shape))
+    return _decode(header['object'], arrays)
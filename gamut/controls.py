@@ -19,8 +19,8 @@ class Points(np.ndarray):
     def __new__(cls, array: np.ndarray | list = []) -> Self:
         return np.asarray(array).view(cls)
 
-    def fill(self, shape: Iterable, value: int | float) -> Self:
-        tmp = np.empty(shape=shape)
+    def fill(self, shape: Iterable, value: int | float, dtype: np.dtype | str | None = None) -> Self:
+        tmp = np.empty(shape=shape, dtype=dtype)
         tmp.fill(value)
         return Points(tmp)
 
@@ -127,14 +127,15 @@ class Envelope:
         return self._points.resample(N)
 
 
-def object_to_points(param, N: int) -> Points:
-    """ resolve parameter into a ``Points`` instance based on type """
+def object_to_points(param, N: int, dtype: np.dtype | str | None = None) -> Points:
+    """ resolve parameter into a ``Points`` instance based on type, of ``float64`` values unless another ``dtype`` is given """
     if isinstance(param, Envelope):
-        return param.get_points(N)
+        points = param.get_points(N)
     elif isinstance(param, Iterable):
-        return Envelope(shape=param).get_points(N)
+        points = Envelope(shape=param).get_points(N)
     else:
-        return Points().fill(N, param)
+        return Points().fill(N, param, dtype=dtype)
+    return points if dtype is None else points.astype(dtype, copy=False)
 
 
 def plot_envelope_list(env_list: Iterable, rows: int = 1) -> None:
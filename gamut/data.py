@@ -1,113 +1,1276 @@
 from __future__ import annotations
 import numpy as np
-from .utils import get_nested_value, set_nested_value
-from .config import CONSOLE
+from .utils import get_nested_value
+from .config import CONSOLE, SEARCH_MODES, PROJECTIONS, MEMORY_BUDGET, BRUTE_FORCE_MAX_SIZE, BRUTE_FORCE_CELL_SIZE, MERGED_INDEX_CACHE_SIZE
 from random import randint
+from scipy.cluster.vq import kmeans2, vq
+from heapq import heappush, heappop
+from time import perf_counter
+import warnings
+from collections import OrderedDict
 from collections.abc import Iterable
+from abc import ABC, abstractmethod
+from threading import Lock
 
+# most recently merged indices (see merge_indices)
+MERGED_INDICES = OrderedDict()
+MERGED_INDICES_LOCK = Lock()
 
-class KDTree:
+# maximum number of grains per block of exhaustive searches, and of entries of the distance matrix of a block of queries,
+# past which blocks no longer fit in cache and searches get slower, however large their memory budget
+BLOCK_COLUMNS = 4096
+BLOCK_SIZE = 2**20
+
+
+class GrainTable:
     """
-    k-dimensional binary search tree
+    Columnar table of the grains of a ``Corpus``: an ``int32`` array of source ids, an ``int64`` array of sample markers,
+    and a ``(N, k)`` ``float32`` matrix of (non-normalized) features, with a row per grain.
+    Indices are fitted on it with ``index.fit(table.features, **table.columns)``.
 
     Attributes
     ----------
-    leaf_size: int = 10
-        Maximum number of data items per leaf.
+    features: np.ndarray
+        ``(N, k)`` feature matrix.
+
+    sources: np.ndarray
+        Source id of each grain.
+
+    markers: np.ndarray
+        Sample marker of each grain in its source.
     """
 
-    def __init__(self, leaf_size: int = 10) -> None:
-        self.leaf_size = leaf_size
+    def __init__(self, features: np.ndarray | None = None, sources: np.ndarray | None = None, markers: np.ndarray | None = None) -> None:
+        self.features = np.empty((0, 0), dtype='float32') if features is None else np.asarray(features, dtype='float32')
+        self.sources = np.empty(0, dtype='int32') if sources is None else np.asarray(sources, dtype='int32')
+        self.markers = np.empty(0, dtype='int64') if markers is None else np.asarray(markers, dtype='int64')
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
+    @property
+    def columns(self) -> dict:
+        """ data columns of the grains, as keyword arguments of ``NeighborIndex.fit`` and ``NeighborIndex.insert`` """
+        return {'sources': self.sources, 'markers': self.markers}
+
+    @property
+    def nbytes(self) -> int:
+        """ memory taken by the table, in bytes """
+        return self.features.nbytes + self.sources.nbytes + self.markers.nbytes
+
+    @classmethod
+    def from_analyses(cls, analyses: Iterable, path: str | None = None) -> GrainTable:
+        """
+        Builds a table from ``(source_id, analysis, markers)`` tuples, concatenating their arrays in a single copy.
+        If ``path`` is given, features are written to a ``.npy`` file there, and memory-mapped from it rather than kept in memory.
+        """
+        analyses = [(source_id, analysis, markers) for source_id, analysis, markers in analyses if len(analysis)]
+        if not analyses:
+            return cls()
+        shape = (sum(len(analysis) for _, analysis, _ in analyses), analyses[0][1].shape[1])
+        if path is None:
+            features = np.empty(shape, dtype='float32')
+        else:
+            features = np.lib.format.open_memmap(path, mode='w+', dtype='float32', shape=shape)
+        offsets = np.cumsum([0] + [len(analysis) for _, analysis, _ in analyses])
+        for (_, analysis, _), start, end in zip(analyses, offsets[:-1], offsets[1:]):
+            features[start:end] = analysis
+        if path is not None:
+            features.flush()
+            features = np.load(path, mmap_mode='r')
+        return cls(features=features,
+                   sources=np.concatenate([np.full(len(analysis), source_id, dtype='int32') for source_id, analysis, _ in analyses]),
+                   markers=np.concatenate([markers for _, _, markers in analyses]))
+
+    @classmethod
+    def from_records(cls, data: Iterable, vector_path: str = 'features') -> GrainTable:
+        """ Builds a table from a list of ``dict`` objects with ``source`` and ``marker`` keys, and features at ``vector_path`` """
+        return cls(features=np.array([get_nested_value(d, vector_path) for d in data], dtype='float32'),
+                   sources=np.array([d['source'] for d in data], dtype='int32'),
+                   markers=np.array([d['marker'] for d in data], dtype='int64'))
+
+
+class NeighborIndex(ABC):
+    """
+    Abstract base class for nearest neighbor indices over the grains of a ``Corpus``.
+    Indices are built with ``fit``, searched with ``knn_batch``, and stored with ``serialize`` and ``read``
+    (see ``load_index``), so that any subclass registered in ``INDICES`` can be used by a ``Corpus``.
+
+    It min-max normalizes the grain features and keeps them in a contiguous ``float32`` matrix,
+    along with parallel ``sources`` and ``markers`` columns (and a ``corpora`` column, for indices merged from several corpora).
+    Subclasses implement the search structure over them.
+
+    Optionally, normalized features can be projected onto fewer dimensions before indexing, which makes search faster
+    (especially for k-d trees, which degrade toward a linear scan in high dimensions) at the cost of approximate results.
+    The projection is fitted along with the normalization, and applied to every query.
+
+    Attributes
+    ----------
+    projection: str | None = None
+        Type of projection: ``"pca"`` (principal component analysis), ``"random"`` (gaussian random projection) or ``None``.
+
+    n_components: int | float | None = None
+        Number of dimensions to project onto. For ``"pca"``, a ``float`` between 0 and 1 keeps the fewest components
+        that explain at least that fraction of the variance, and defaults to ``0.95``.
+        For ``"random"``, a ``float`` is taken as a fraction of the number of features, and defaults to ``0.5``.
+
+    seed: int | None = None
+        Seed of the random number generator used to build the index (e.g., for ``"random"`` projections). If ``None``,
+        a seed is drawn when it is first needed, and kept with the index, so that every build can be reproduced.
+    """
+
+    def __init__(self, projection: str | None = None, n_components: int | float | None = None, seed: int | None = None) -> None:
+        if projection not in [None, *PROJECTIONS]:
+            CONSOLE.error(ValueError, f'"{projection}" is not a valid projection. Choose one of the following: {PROJECTIONS}')
         self.k = None
         self.min = None
-        self.min = None
+        self.max = None
         self.norm = None
-        self.data = None
 
-    def __update_minmax(self, vector: np.ndarray) -> None:
-        self.min = np.min(np.array([self.min, vector]), axis=0)
-        self.max = np.max(np.array([self.max, vector]), axis=0)
+        # projection of normalized features
+        self.projection = projection
+        self.n_components = n_components
+        self.seed = seed
+        self.mean = None
+        self.components = None
+        self.explained_variance = None
+
+        # data columns
+        self.features = None
+        self.sources = None
+        self.markers = None
+        self.corpora = None
+
+    def __len__(self) -> int:
+        return 0 if self.sources is None else len(self.sources)
+
+    @property
+    def mergeable(self) -> bool:
+        """ whether the index can be merged with others by ``merge_indices`` """
+        return self.components is None
+
+    @property
+    def nbytes(self) -> int:
+        """ memory taken by the arrays of the index, in bytes """
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+    @abstractmethod
+    def _build(self, features: np.ndarray, columns: dict) -> None:
+        """ builds the index over already normalized ``features``, storing each array in ``columns`` as an attribute """
+        raise NotImplementedError
+
+    @abstractmethod
+    def knn_batch(self, X: np.ndarray, k: int = 10, **kwargs) -> tuple:
+        """
+        Finds the ``k`` nearest neighbors of every row in ``X``.
+        Returns an ``(indices, distances)`` tuple of arrays of shape ``(len(X), k)``, sorted by distance,
+        where ``indices`` point to rows of the ``features``, ``sources`` and ``markers`` arrays.
+        """
+        raise NotImplementedError
+
+    def build(self, data: list | GrainTable, vector_path: str = 'features') -> None:
+        """ Builds the index from a ``GrainTable``, or from a list of ``dict`` objects (see ``GrainTable.from_records``) """
+        table = data if isinstance(data, GrainTable) else GrainTable.from_records(data, vector_path)
+        self.fit(table.features, **table.columns)
+
+    def fit(self, features: np.ndarray, **columns) -> None:
+        """ Normalizes a ``(N, k)`` feature matrix and builds the index over it, along with ``N``-sized data columns """
+        features = np.asarray(features, dtype='float32')
+        self._fit_normalization(features)
+        self._build(self._normalize_input(features), columns)
+
+    def _fit_normalization(self, features: np.ndarray) -> None:
+        """ fits the min-max normalization (and projection, if any) of a ``(N, k)`` feature matrix, without copying it whole """
+        # get data dimensions
+        self.k = features.shape[1]
+
+        # compute min, max, and norm arrays in a single pass
+        self.min = features.min(axis=0)
+        self.max = features.max(axis=0)
+        self.norm = self.max - self.min
+        self.norm[self.norm == 0] = 1.0
+
+        if self.projection:
+            self.__fit_projection(features)
+
+    def __fit_projection(self, features: np.ndarray) -> None:
+        """ fits a projection matrix onto ``n_components`` dimensions over ``features``, min-max normalized a chunk of rows at a time """
+        total = np.zeros(self.k)
+        scatter = np.zeros((self.k, self.k))
+        for chunk in row_chunks(len(features), self.k):
+            normalized = ((features[chunk] - self.min) / self.norm).astype('float64')
+            total += normalized.sum(axis=0)
+            if self.projection == 'pca':
+                scatter += normalized.T @ normalized
+        mean = total / len(features)
+        self.mean = mean.astype('float32')
+        self.components = None
+        n_components = self.n_components
+        if self.projection == 'pca':
+            variances, vectors = np.linalg.eigh(scatter / len(features) - np.outer(mean, mean))
+            # eigh sorts eigenvalues in ascending order
+            variances = np.maximum(variances[::-1], 0)
+            vectors = vectors[:, ::-1]
+            ratios = np.cumsum(variances) / max(np.sum(variances), np.finfo('float32').tiny)
+            if n_components is None or isinstance(n_components, float):
+                n_components = int(np.searchsorted(ratios, (n_components or 0.95) - 1e-6)) + 1
+            n_components = min(max(1, n_components), self.k)
+            self.components = vectors[:, :n_components].astype('float32')
+            self.explained_variance = float(ratios[n_components - 1])
+        else:
+            if n_components is None or isinstance(n_components, float):
+                n_components = int(np.ceil((n_components or 0.5) * self.k))
+            n_components = min(max(1, n_components), self.k)
+            # scaled so that distances are preserved in expectation
+            rng = self._rng()
+            self.components = (rng.standard_normal((self.k, n_components)) / np.sqrt(n_components)).astype('float32')
+            self.explained_variance = None
+
+    def _normalize_input(self, x: np.ndarray) -> np.ndarray:
+        x = (x - self.min) / self.norm
+        if self.components is not None:
+            x = (x - self.mean) @ self.components
+        return x.astype('float32')
+
+    def _denormalize(self, x: np.ndarray) -> np.ndarray:
+        if self.components is not None:
+            CONSOLE.error(ValueError, 'Projected features cannot be mapped back to their original scale')
+        return x * self.norm + self.min
+
+    def knn(self, x: np.ndarray, vector_path: str | None = None, first_n: int = 10, **kwargs) -> Iterable:
+        """
+        Finds the ``first_n`` nearest neighbors of a single vector ``x``, sorted by distance. See ``knn_batch`` for search options.
+        ``vector_path`` is deprecated and ignored, since features are no longer read from the items of the index (see ``build``).
+        """
+        if vector_path is not None:
+            warnings.warn('The vector_path argument of knn is deprecated and ignored', DeprecationWarning, stacklevel=2)
+        indices, costs = self.knn_batch(x[np.newaxis, :], first_n, **kwargs)
+        return [
+            {
+                'cost': cost,
+                'value': {
+                    'source': int(self.sources[i]),
+                    'marker': int(self.markers[i]),
+                }
+            } for cost, i in zip(costs[0], indices[0])
+        ]
+
+    def _columns(self) -> dict:
+        """ data columns held by the index """
+        return {name: getattr(self, name) for name in ['sources', 'markers', 'corpora'] if getattr(self, name) is not None}
+
+    def insert(self, features: np.ndarray, **columns) -> None:
+        """ Adds a ``(N, k)`` feature matrix to the index, along with ``N``-sized data columns """
+        self._update(np.asarray(features, dtype='float32'), columns, np.ones(len(self), dtype='bool'))
+
+    def remove(self, mask: np.ndarray) -> None:
+        """ Removes the rows of the index where ``mask`` is ``True`` """
+        self._update(np.empty((0, self.k), dtype='float32'),
+                     {name: column[:0] for name, column in self._columns().items()}, ~mask)
+
+    def _update(self, features: np.ndarray, columns: dict, keep: np.ndarray) -> None:
+        """ replaces the index contents with its ``keep`` rows plus new (non-normalized) ``features``, refitting from scratch """
+        columns = {name: np.concatenate([column[keep], columns[name]]) for name, column in self._columns().items()}
+        if self.components is not None:
+            # projected features cannot be mapped back to refit the normalization, so the fitted projection is kept
+            self._build(np.concatenate([self.features[keep], self._normalize_input(features)]), columns)
+            return
+        self.fit(np.concatenate([self._denormalize(self.features[keep]), features]), **columns)
+
+    def _rng(self) -> np.random.Generator:
+        """ random number generator seeded with ``seed``, which is drawn first if not set """
+        if self.seed is None:
+            self.seed = int(np.random.default_rng().integers(2**32))
+        return np.random.default_rng(self.seed)
+
+    def serialize(self) -> dict:
+        """ Returns the state of the index as a ``dict``, which can be restored with ``read`` """
+        return dict(vars(self))
+
+    def read(self, index: dict) -> None:
+        """ Restores the state of the index from a ``dict`` returned by ``serialize`` """
+        for attr in index:
+            hasattr(self, attr) and setattr(self, attr, index[attr])
+
+
+def row_chunks(num_rows: int, num_columns: int, memory_budget: int = MEMORY_BUDGET) -> list:
+    """ slices of the rows of a ``(num_rows, num_columns)`` ``float32`` matrix, of which a few copies of each fit in a quarter of ``memory_budget`` """
+    chunk_size = max(1, memory_budget // (16 * num_columns))
+    return [slice(i, i + chunk_size) for i in range(0, num_rows, chunk_size)]
+
+
+def _top_k(candidates: list, num_rows: int, k: int) -> tuple:
+    """ reduces ``(rows, indices, costs)`` candidate arrays, holding at least ``k`` candidates per row, to the ``k`` best of each row """
+    rows, index, costs = (np.concatenate(column) for column in zip(*candidates))
+    order = np.lexsort((index, costs, rows))
+    best = order[np.searchsorted(rows[order], np.arange(num_rows))[:, np.newaxis] + np.arange(k)]
+    return costs[best], index[best]
+
+
+def exhaustive_knn(X: np.ndarray, features: np.ndarray, sq_norms: np.ndarray, k: int, memory_budget: int = MEMORY_BUDGET) -> tuple:
+    """
+    Finds the exact ``k`` nearest rows of ``features`` to every row of ``X``, given the squared norms of ``features``.
+    Returns a ``(costs, indices)`` tuple of arrays of shape ``(len(X), k)``, sorted by squared distance.
+
+    Grains are ranked by ``||b||² - 2ab`` (the squared distance ``||a||² + ||b||² - 2ab`` without the constant ``||a||²`` term of each query),
+    computed with matrix products between blocks of queries and blocks of rows of ``features``. The ``k`` best rows of the first block set a threshold,
+    and only rows below the current threshold of their query are kept as candidates from then on, so that most of each block
+    is discarded with a single comparison instead of being partitioned. Candidates are reduced to the ``k`` best of each query
+    (which tightens thresholds) once they outnumber them 4 to 1, or once they would exceed the budget.
+
+    A quarter of ``memory_budget`` (in bytes) goes to the distance matrix of a block, up to ``BLOCK_SIZE`` entries
+    of at most ``BLOCK_COLUMNS`` grains each, and the rest to the candidates of its queries.
+    """
+    costs = np.empty((len(X), k), dtype='float32')
+    indices = np.empty((len(X), k), dtype='int64')
+    # each entry of a block takes 4 bytes for its cost, and 1 byte for its comparison with the threshold
+    block_size = min(BLOCK_SIZE, memory_budget // 4 // 5)
+    block_columns = max(k, min(BLOCK_COLUMNS, block_size))
+    block_rows = max(1, block_size // block_columns)
+    # each candidate takes 8 bytes for its row, 8 for its index and 4 for its cost
+    max_candidates = max(block_rows * k, min(4 * block_rows * k, (memory_budget - 5 * block_rows * block_columns) // 20))
+    for i in range(0, len(X), block_rows):
+        rows = slice(i, i + block_rows)
+        queries = -2 * X[rows]
+        num_rows = len(queries)
+        for j in range(0, len(features), block_columns):
+            block_costs = queries @ features[j:j + block_columns].T
+            block_costs += sq_norms[j:j + block_columns]
+            if j == 0:
+                first = np.argpartition(block_costs, k - 1, axis=1)[:, :k]
+                candidates = [(np.repeat(np.arange(num_rows), k), first.reshape(-1),
+                               np.take_along_axis(block_costs, first, axis=1).reshape(-1))]
+                threshold = candidates[0][2].reshape(num_rows, k).max(axis=1, keepdims=True)
+                num_candidates = num_rows * k
+                continue
+            hit_rows, hit_index = np.nonzero(block_costs < threshold)
+            candidates.append((hit_rows, hit_index + j, block_costs[hit_rows, hit_index]))
+            num_candidates += len(hit_index)
+            if num_candidates > max_candidates:
+                best_costs, best_index = _top_k(candidates, num_rows, k)
+                candidates = [(np.repeat(np.arange(num_rows), k), best_index.reshape(-1), best_costs.reshape(-1))]
+                threshold = best_costs[:, -1:]
+                num_candidates = num_rows * k
+        best_costs, indices[rows] = _top_k(candidates, num_rows, k)
+        costs[rows] = np.maximum(best_costs + np.einsum('ij,ij->i', X[rows], X[rows])[:, np.newaxis], 0)
+    return costs, indices
+
+
+class BruteForce(NeighborIndex):
+    """
+    Exhaustive nearest neighbor search, with blocked matrix products over the normalized feature matrix (see ``exhaustive_knn``).
+    Results are exact, and for small corpora this is faster than traversing a tree.
+
+    Attributes
+    ----------
+    memory_budget: int | None = None
+        Maximum size in bytes of the blocks of the distance matrix and of the candidates kept for a block of queries
+        (see ``exhaustive_knn``). Defaults to ``config.MEMORY_BUDGET``.
+    """
+
+    def __init__(self, memory_budget: int | None = None, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.memory_budget = memory_budget or MEMORY_BUDGET
+        self.sq_norms = None
+
+    def _build(self, features: np.ndarray, columns: dict) -> None:
+        self.features = np.ascontiguousarray(features, dtype='float32')
+        for name, column in columns.items():
+            setattr(self, name, np.ascontiguousarray(column))
+        self.sq_norms = np.einsum('ij,ij->i', self.features, self.features)
+
+    def knn_batch(self, X: np.ndarray, k: int = 10, **kwargs) -> tuple:
+        """
+        Finds the exact ``k`` nearest neighbors of every row in ``X``.
+        Search options meant for other indices (e.g., ``search`` or ``max_leaves``) are ignored.
+        """
+        X = self._normalize_input(np.atleast_2d(X))
+        costs, indices = exhaustive_knn(X, self.features, self.sq_norms, min(k, len(self)), self.memory_budget)
+        return indices, np.sqrt(costs)
+
+
+class BinaryTree(NeighborIndex):
+    """
+    Abstract base class for binary space partitioning trees.
+
+    Trees are stored as flat node arrays (child indices and data ranges) over a single contiguous ``float32`` feature matrix,
+    whose rows are ordered so that each leaf is a contiguous slice, and nodes are stored in pre-order.
+    Subclasses define how data is split, and the region bounding the data of each node, which is used to prune branches during search.
+
+    Attributes
+    ----------
+    leaf_size: int = 10
+        Maximum number of data items per leaf.
+    """
+
+    # number of items around each vector that exact search starts from, and fraction of the items it compares each vector against
+    # over which it switches to an exhaustive search (which is about 25 times faster per item)
+    EXACT_SEED_SIZE = 1024
+    EXHAUSTIVE_RATIO = 0.04
+
+    def __init__(self, leaf_size: int = 10, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.leaf_size = leaf_size
+
+        # node arrays
+        self.children = None
+        self.bounds = None
+
+    @abstractmethod
+    def _sides(self, X: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+        """ picks the child (``0`` or ``1``) of each internal node in ``nodes`` that each row of ``X`` descends into """
+        raise NotImplementedError
+
+    @abstractmethod
+    def _node_bounds(self, X: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+        """ lower bounds of the squared distance from each row of ``X`` to any item of the corresponding node in ``nodes`` """
+        raise NotImplementedError
+
+    def _split(self, order: np.ndarray, features: np.ndarray, start: int, end: int, k: int) -> int:
+        """ partitions ``order[start:end]`` around its median along dimension ``k``, returning the median position """
+        segment = order[start:end]
+        middle = (end - start) // 2
+        order[start:end] = segment[np.argpartition(features[segment, k], middle)]
+        return start + middle
+
+    def _find_seeds(self, X: np.ndarray, k: int) -> np.ndarray:
+        """
+        descends the tree for all rows of ``X`` at once, returning the smallest node
+        around the leaf each row falls into that contains at least ``k`` items
+        """
+        nodes = np.zeros(len(X), dtype='int64')
+        active = np.flatnonzero(self.children[nodes, 0] >= 0)
+        while len(active):
+            current = nodes[active]
+            nodes[active] = self.children[current, self._sides(X[active], current)]
+            active = active[self.children[nodes[active], 0] >= 0]
+
+        # climb back up from leaves holding fewer than k items
+        internal = np.flatnonzero(self.children[:, 0] >= 0)
+        parents = np.zeros(len(self.children), dtype='int64')
+        parents[self.children[internal]] = internal[:, np.newaxis]
+        sizes = self.bounds[:, 1] - self.bounds[:, 0]
+        active = np.flatnonzero(sizes[nodes] < k)
+        while len(active):
+            nodes[active] = parents[nodes[active]]
+            active = active[sizes[nodes[active]] < k]
+        return nodes
+
+    def _search_nodes(self, X: np.ndarray, nodes: np.ndarray, k: int) -> tuple:
+        """ squared distances and indices of the ``k`` nearest items within the node range of each row of ``X`` """
+        sizes = self.bounds[nodes, 1] - self.bounds[nodes, 0]
+        offsets = np.arange(int(sizes.max()))
+        index = np.minimum(self.bounds[nodes, :1] + offsets, len(self) - 1)
+        costs = np.sum((self.features[index] - X[:, np.newaxis, :])**2, axis=2)
+        costs[offsets >= sizes[:, np.newaxis]] = np.inf
+        order = np.argsort(costs, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(costs, order, axis=1), np.take_along_axis(index, order, axis=1)
+
+    def _descend(self, X: np.ndarray, thresholds: np.ndarray, seeds: np.ndarray) -> tuple:
+        """
+        descends the tree breadth-first for all rows of ``X`` at once, with arrays of (row, node) pairs, dropping nodes whose bounding region
+        is farther than the threshold of their row. Returns the (row, leaf) pairs reached outside the seed node of each row.
+        """
+        rows = np.arange(len(X))
+        nodes = np.zeros(len(X), dtype='int64')
+        leaf_rows, leaf_nodes = [], []
+        while len(rows):
+            near = self._node_bounds(X[rows], nodes) <= thresholds[rows]
+            # the items of seed nodes were already compared
+            near &= (self.bounds[nodes, 0] < self.bounds[seeds[rows], 0]) | (self.bounds[nodes, 1] > self.bounds[seeds[rows], 1])
+            rows, nodes = rows[near], nodes[near]
+            is_leaf = self.children[nodes, 0] < 0
+            leaf_rows.append(rows[is_leaf])
+            leaf_nodes.append(nodes[is_leaf])
+            rows, nodes = np.repeat(rows[~is_leaf], 2), self.children[nodes[~is_leaf]].reshape(-1)
+        return np.concatenate(leaf_rows), np.concatenate(leaf_nodes)
+
+    def _search_leaves(self, X: np.ndarray, best_costs: np.ndarray, best_index: np.ndarray, leaf_rows: np.ndarray, leaf_nodes: np.ndarray) -> tuple:
+        """ compares the rows of ``X`` against the items of their leaves, in chunks of bounded size, updating their ``k`` best candidates """
+        if not len(leaf_rows):
+            return best_costs, best_index
+        k = best_costs.shape[1]
+        sizes = self.bounds[leaf_nodes, 1] - self.bounds[leaf_nodes, 0]
+        ends = np.cumsum(sizes)
+        starts = ends - sizes
+        # each compared item takes 4 bytes per feature for its difference, plus 8 bytes for its row, 8 for its index and 4 for its cost
+        chunk_size = max(int(sizes.max()), MEMORY_BUDGET // (4 * X.shape[1] + 20))
+        candidates = [(np.repeat(np.arange(len(X)), k), best_index.reshape(-1), best_costs.reshape(-1))]
+        start = 0
+        while start < len(leaf_rows):
+            end = int(np.searchsorted(ends, starts[start] + chunk_size, side='right'))
+            chunk_sizes = sizes[start:end]
+            item_rows = np.repeat(leaf_rows[start:end], chunk_sizes)
+            # items run from the first row of each leaf, offset by their position in the chunk
+            items = np.repeat(self.bounds[leaf_nodes[start:end], 0] - starts[start:end], chunk_sizes) + np.arange(starts[start], ends[end - 1])
+            delta = self.features[items] - X[item_rows]
+            costs = np.einsum('ij,ij->i', delta, delta)
+            closer = costs < best_costs[item_rows, -1]
+            candidates.append((item_rows[closer], items[closer], costs[closer]))
+            start = end
+        return _top_k(candidates, len(X), k)
+
+    def _search_exact(self, X: np.ndarray, best_costs: np.ndarray, best_index: np.ndarray, seeds: np.ndarray) -> tuple:
+        """
+        exact search for all rows of ``X``, given the squared distances and indices of ``k`` candidates found in the seed node of each row.
+        Each row is compared against the items of every leaf closer than its ``k``-th candidate. Rows are searched in chunks,
+        and once a chunk has to compare against more than ``EXHAUSTIVE_RATIO`` of the items (which happens when there are too few items
+        for the number of features to prune much), the remaining rows are searched exhaustively, which is faster per item.
+        """
+        k = best_costs.shape[1]
+        # each (row, node) pair of a descent takes 4 bytes per feature for its row, plus its node, bounds and flags
+        max_chunk_size = max(1, MEMORY_BUDGET // (len(self.children) * (4 * X.shape[1] + 48)))
+        i = 0
+        while i < len(X):
+            # start with small chunks, so that ineffective pruning is detected early
+            rows = slice(i, i + min(max_chunk_size, max(64, i)))
+            i = rows.stop
+            leaf_rows, leaf_nodes = self._descend(X[rows], best_costs[rows, -1], seeds[rows])
+            if np.sum(self.bounds[leaf_nodes, 1] - self.bounds[leaf_nodes, 0]) > self.EXHAUSTIVE_RATIO * len(self) * len(X[rows]):
+                sq_norms = np.einsum('ij,ij->i', self.features, self.features)
+                best_costs[rows.start:], best_index[rows.start:] = exhaustive_knn(X[rows.start:], self.features, sq_norms, k)
+                break
+            best_costs[rows], best_index[rows] = self._search_leaves(X[rows], best_costs[rows], best_index[rows], leaf_rows, leaf_nodes)
+        return best_costs, best_index
+
+    def _search(self, data_point: np.ndarray, first_n: int, max_leaves: int | None, max_checks: int | None, seed: tuple) -> tuple:
+        """ budgeted best-first search for a single normalized vector, continuing from the results of a seed node """
+        seed_node, best_costs, best_index = seed
+        num_leaves = 1
+        num_checks = self.bounds[seed_node, 1] - self.bounds[seed_node, 0]
+
+        # heap items are (squared node distance, tie breaker, node), where ties are visited depth-first
+        heap = [(0.0, 0, 0)]
+        counter = -1
+        while heap:
+            if len(best_costs) == first_n:
+                if (max_leaves and num_leaves >= max_leaves) or (max_checks and num_checks >= max_checks):
+                    break
+                if heap[0][0] > best_costs[-1]:
+                    break
+            _, _, node = heappop(heap)
+            if node == seed_node:
+                continue
+            if self.children[node, 0] >= 0:
+                children = self.children[node]
+                child_bounds = self._node_bounds(np.stack([data_point, data_point]), children)
+                if child_bounds[0] == child_bounds[1]:
+                    near = int(self._sides(data_point[np.newaxis], np.array([node]))[0])
+                else:
+                    near = int(child_bounds[1] < child_bounds[0])
+                # push the near child last, so that it is popped first when bounds tie
+                for side in [1 - near, near]:
+                    if len(best_costs) < first_n or child_bounds[side] <= best_costs[-1]:
+                        heappush(heap, (float(child_bounds[side]), counter, children[side]))
+                        counter -= 1
+                continue
+            start, end = self.bounds[node]
+            costs = np.concatenate([best_costs, np.sum((self.features[start:end] - data_point)**2, axis=1)])
+            index = np.concatenate([best_index, np.arange(start, end)])
+            order = np.argsort(costs, kind='stable')[:first_n]
+            best_costs, best_index = costs[order], index[order]
+            num_leaves += 1
+            num_checks += end - start
+        return best_costs, best_index
+
+    def knn_batch(self,
+                  X: np.ndarray,
+                  k: int = 10,
+                  search: str = 'approx',
+                  max_leaves: int | None = None,
+                  max_checks: int | None = None,
+                  **kwargs) -> tuple:
+        """
+        Finds the ``k`` nearest neighbors of every row in ``X``.
+        Returns an ``(indices, distances)`` tuple of arrays of shape ``(len(X), k)``, sorted by distance,
+        where ``indices`` point to rows of the ``features``, ``sources`` and ``markers`` arrays.
+
+        X: np.ndarray
+            Matrix of input vectors, in the same (non-normalized) space as the data used to build the tree.
+
+        k: int = 10
+            Number of nearest neighbors per input vector. It is capped to the number of items in the tree.
+
+        search: str = 'approx'
+            Search mode. Both modes start from the leaf each vector falls into, or from the smallest subtree around it
+            holding at least ``k`` items (``EXACT_SEED_SIZE`` items in ``"exact"`` mode). ``"exact"`` then compares each vector
+            against every leaf whose bounding region is closer than its ``k``-th candidate, descending the tree for all vectors at once,
+            or searches exhaustively if that would compare them against more than ``EXHAUSTIVE_RATIO`` of the items.
+            ``"approx"`` runs a best-first search for each vector instead, which stops once ``max_leaves`` leaves
+            or ``max_checks`` data items have been visited (whichever comes first, if both are given) and ``k`` candidates were found.
+
+        max_leaves: int | None = None
+            Maximum number of leaves to visit in ``"approx"`` mode. If neither ``max_leaves`` nor ``max_checks`` is given, a single leaf is visited.
+
+        max_checks: int | None = None
+            Maximum number of data items to compare against in ``"approx"`` mode.
+            Search options meant for other indices (e.g., ``nprobe``) are ignored.
+        """
+        if search not in SEARCH_MODES:
+            CONSOLE.error(ValueError, f'"{search}" is not a valid search mode. Choose one of the following: {SEARCH_MODES}')
+        exact = search == 'exact'
+        if max_leaves is None and max_checks is None:
+            max_leaves = 1
+        X = self._normalize_input(np.atleast_2d(X))
+        k = min(k, len(self))
+        # exact searches start from larger seeds, whose k-th candidates prune more of the tree
+        seeds = self._find_seeds(X, min(max(k, self.EXACT_SEED_SIZE), len(self)) if exact else k)
+        costs = np.empty((len(X), k), dtype='float32')
+        indices = np.empty((len(X), k), dtype='int64')
+
+        # compare each vector against the items around its own leaf, in chunks of bounded size
+        max_size = int(np.max(self.bounds[seeds, 1] - self.bounds[seeds, 0]))
+        chunk_size = max(1, 2**22 // (max_size * X.shape[1]))
+        for i in range(0, len(X), chunk_size):
+            chunk = slice(i, i + chunk_size)
+            costs[chunk], indices[chunk] = self._search_nodes(X[chunk], seeds[chunk], k)
+
+        # keep searching for vectors whose seed does not satisfy the search mode
+        if exact:
+            costs, indices = self._search_exact(X, costs, indices, seeds)
+        elif max_leaves != 1:
+            checks = self.bounds[seeds, 1] - self.bounds[seeds, 0]
+            for i in np.flatnonzero(checks < (max_checks or np.inf)):
+                costs[i], indices[i] = self._search(X[i], k, max_leaves, max_checks, (seeds[i], costs[i], indices[i]))
+
+        return indices, np.sqrt(costs)
+
+
+class KDTree(BinaryTree):
+    """
+    k-dimensional binary search tree.
+
+    The tree is built by recursively splitting the data at its median along one dimension, found with ``np.argpartition``.
+    Besides the ``BinaryTree`` node arrays, each node stores its split dimension and value,
+    and the bounding box of its data, which is used to prune branches during search.
+
+    Insertions and removals only rebuild the subtrees whose leaves overflow or whose children become unbalanced,
+    and the whole tree is rebuilt (and renormalized) once the number of changed items exceeds ``rebuild_ratio``
+    times the size of the tree when it was last fully built.
+
+    Attributes
+    ----------
+    leaf_size: int = 10
+        Maximum number of data items per leaf.
+
+    balance: float = 0.75
+        Maximum fraction of the items of a node that any of its children can hold before the node is rebuilt on update.
+
+    rebuild_ratio: float = 0.5
+        Fraction of changed items after which the whole tree is rebuilt on update.
+    """
+
+    def __init__(self, leaf_size: int = 10, balance: float = 0.75, rebuild_ratio: float = 0.5, **kwargs) -> None:
+        super().__init__(leaf_size=leaf_size, **kwargs)
+        self.balance = balance
+        self.rebuild_ratio = rebuild_ratio
+        self.built_size = 0
+        self.num_changes = 0
 
-    def __build(self, data: list, vector_path: str, k: int = 0) -> dict:
-        data_size = len(data)
-        if (data_size <= self.leaf_size):
+        # node arrays
+        self.split_dim = None
+        self.split_value = None
+        self.box_min = None
+        self.box_max = None
+
+    def _sides(self, X: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+        return (X[np.arange(len(X)), self.split_dim[nodes]] >= self.split_value[nodes]).astype('int64')
+
+    def _node_bounds(self, X: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+        """ squared distance from each row of ``X`` to the bounding box of its node """
+        delta = np.maximum(self.box_min[nodes] - X, 0) + np.maximum(X - self.box_max[nodes], 0)
+        return np.einsum('ij,ij->i', delta, delta)
+
+    def __build(self, order: np.ndarray, features: np.ndarray, nodes: dict, start: int, end: int, k: int) -> int:
+        """ recursively partitions ``order[start:end]`` along dimension ``k`` and appends nodes, returning the node index """
+        node = len(nodes['bounds'])
+        nodes['bounds'].append((start, end))
+        nodes['children'].append((-1, -1))
+        data_size = end - start
+        if data_size <= self.leaf_size:
             CONSOLE.bar.next(data_size)
-            for d in data:
-                self.__update_minmax(get_nested_value(d, vector_path))
-            return {
-                'leaf': data,
-            }
-        data.sort(key=lambda x: get_nested_value(x, vector_path)[k])
-        middle_index = len(data) // 2
-        next_k = (k + 1) % self.k
-        vector = get_nested_value(data[middle_index], vector_path)
-        return {
-            'node': {
-                'k': k,
-                'value': vector[k]
-            },
-            0: self.__build(data[:middle_index], vector_path, next_k),
-            1: self.__build(data[middle_index:], vector_path, next_k),
-        }
-
-    def build(self, data: list | np.ndarray, vector_path: str) -> None:
-        # get tree dimensions
-        self.k = len(get_nested_value(data[0], vector_path))
-
-        # initialize min, max, and norm arrays
-        self.min = np.zeros(self.k)
-        self.min.fill(np.inf)
-
-        self.max = np.zeros(self.k)
-        self.max.fill(-np.inf)
-
-        self.norm = np.ones(self.k)
-
-        CONSOLE.reset_bar('Classifying audio grains:', max=len(data), item='grains')
-        # build binary tree and fit data
-        self.data = self.__build(data, vector_path, k=randint(0, self.k-1))
+            nodes['split_dim'].append(-1)
+            nodes['split_value'].append(0.0)
+            return node
+        middle_index = self._split(order, features, start, end, k)
+        nodes['split_dim'].append(k)
+        nodes['split_value'].append(features[order[middle_index], k])
+        next_k = (k + 1) % features.shape[1]
+        nodes['children'][node] = (
+            self.__build(order, features, nodes, start, middle_index, next_k),
+            self.__build(order, features, nodes, middle_index, end, next_k),
+        )
+        return node
+
+    def _build(self, features: np.ndarray, columns: dict) -> None:
+        """ builds node arrays over already normalized ``features`` and stores data columns in leaf order """
+        order = np.arange(len(features))
+        nodes = {'split_dim': [], 'split_value': [], 'children': [], 'bounds': []}
+        k = randint(0, features.shape[1]-1)
+        CONSOLE.reset_bar('Classifying audio grains:', max=len(features), item='grains')
+        self.__build(order, features, nodes, 0, len(features), k)
         CONSOLE.bar.finish()
-        self.norm = self.max - self.min
-        self.__fit(vector_path)
+        self.__set_nodes(nodes, order, features, columns)
+        self.built_size = len(features)
+        self.num_changes = 0
+
+    def __set_nodes(self, nodes: dict, order: np.ndarray, features: np.ndarray, columns: dict) -> None:
+        """ stores node lists as arrays, and data rows in the given leaf order """
+        self.split_dim = np.array(nodes['split_dim'], dtype='int32')
+        self.split_value = np.array(nodes['split_value'], dtype='float32')
+        self.children = np.array(nodes['children'], dtype='int32')
+        self.bounds = np.array(nodes['bounds'], dtype='int64')
+        self.features = np.ascontiguousarray(features[order], dtype='float32')
+        for name, column in columns.items():
+            setattr(self, name, np.ascontiguousarray(column[order]))
+        self.__build_boxes()
+
+    def __build_boxes(self) -> None:
+        """ computes node bounding boxes, from leaves upwards """
+        n_nodes = len(self.split_dim)
+        self.box_min = np.empty((n_nodes, self.features.shape[1]), dtype='float32')
+        self.box_max = np.empty((n_nodes, self.features.shape[1]), dtype='float32')
+        self.box_min.fill(np.inf)
+        self.box_max.fill(-np.inf)
+        # leaves emptied by removals keep an empty box, which is never visited
+        leaves = np.flatnonzero((self.split_dim < 0) & (self.bounds[:, 1] > self.bounds[:, 0]))
+        starts = self.bounds[leaves, 0]
+        if len(leaves):
+            self.box_min[leaves] = np.minimum.reduceat(self.features, starts, axis=0)
+            self.box_max[leaves] = np.maximum.reduceat(self.features, starts, axis=0)
+        # nodes are stored in pre-order, so children always come after their parent
+        for node in np.flatnonzero(self.split_dim >= 0)[::-1]:
+            left, right = self.children[node]
+            self.box_min[node] = np.minimum(self.box_min[left], self.box_min[right])
+            self.box_max[node] = np.maximum(self.box_max[left], self.box_max[right])
 
-    def __normalize_input(self, x: np.ndarray) -> np.ndarray:
-        return (x - self.min) / self.norm
+    def _update(self, features: np.ndarray, columns: dict, keep: np.ndarray) -> None:
+        """ relays out the tree with its ``keep`` rows plus new (non-normalized) ``features``, rebuilding only affected subtrees """
+        self.num_changes += len(features) + int(np.sum(~keep))
+        if self.num_changes > self.rebuild_ratio * self.built_size or not np.any(keep):
+            return super()._update(features, columns, keep)
 
-    def __fit(self, vector_path: str) -> None:
-        """ recursively normalize tree data """
-        def fit(tree, vector_path):
+        features = self._normalize_input(features)
+        n_nodes = len(self.split_dim)
+        internal = np.flatnonzero(self.split_dim >= 0)
+
+        # number of nodes in the subtree of each node (nodes are stored in pre-order, so subtrees are contiguous)
+        subtree_end = np.arange(1, n_nodes + 1)
+        for node in internal[::-1]:
+            subtree_end[node] = subtree_end[self.children[node, 1]]
+
+        # route new rows to leaves, and count kept and new rows under each node
+        new_leaves = self._find_seeds(features, 0)
+        new_order = np.argsort(new_leaves, kind='stable')
+        new_leaves = new_leaves[new_order]
+        kept = np.concatenate([[0], np.cumsum(keep)])
+        counts = kept[self.bounds[:, 1]] - kept[self.bounds[:, 0]]
+        counts += np.searchsorted(new_leaves, subtree_end) - np.searchsorted(new_leaves, np.arange(n_nodes))
+
+        # flag overflowing leaves, unbalanced nodes, and nodes small enough to become a leaf
+        rebuild = (self.split_dim < 0) & (counts > self.leaf_size)
+        child_counts = counts[self.children[internal]].max(axis=1)
+        rebuild[internal] = (counts[internal] <= self.leaf_size) | (
+            (child_counts > self.balance * counts[internal]) & (counts[internal] > 2 * self.leaf_size))
+
+        # all rows, with new ones appended after the current ones
+        all_features = np.concatenate([self.features, features])
+        all_columns = {name: np.concatenate([column, columns[name]]) for name, column in self._columns().items()}
+        num_rows = len(self)
+
+        order = np.empty(int(counts[0]), dtype='int64')
+        nodes = {'split_dim': [], 'split_value': [], 'children': [], 'bounds': []}
+
+        def relayout(node: int, start: int) -> int:
+            """ copies ``node`` into the new node lists with its rows starting at ``start``, returning its new index """
+            if not rebuild[node] and self.split_dim[node] >= 0:
+                new_node = len(nodes['bounds'])
+                nodes['bounds'].append((start, start + counts[node]))
+                nodes['children'].append((-1, -1))
+                nodes['split_dim'].append(self.split_dim[node])
+                nodes['split_value'].append(self.split_value[node])
+                left, right = self.children[node]
+                nodes['children'][new_node] = (relayout(left, start), relayout(right, start + counts[left]))
+                return new_node
+            old_start, old_end = self.bounds[node]
+            rows = np.concatenate([
+                np.flatnonzero(keep[old_start:old_end]) + old_start,
+                new_order[np.searchsorted(new_leaves, node):np.searchsorted(new_leaves, subtree_end[node])] + num_rows,
+            ])
+            order[start:start + len(rows)] = rows
+            k = self.split_dim[node] if self.split_dim[node] >= 0 else randint(0, all_features.shape[1]-1)
+            return self.__build(order, all_features, nodes, start, start + len(rows), k)
+
+        # only the topmost flagged node of each branch gets rebuilt
+        inherited = np.zeros(n_nodes, dtype='bool')
+        for node in internal:
+            if rebuild[node] or inherited[node]:
+                inherited[self.children[node]] = True
+        CONSOLE.reset_bar('Updating audio grains:', max=int(np.sum(counts[rebuild & ~inherited])), item='grains')
+        relayout(0, 0)
+        CONSOLE.bar.finish()
+        self.__set_nodes(nodes, order, all_features, all_columns)
+
+    def __read_legacy(self, data: dict) -> None:
+        """ converts nested-dict trees from older ``.gamut`` files, whose leaf vectors are already normalized """
+        leaf_items = []
+        stack = [data]
+        while stack:
+            tree = stack.pop()
             if 'node' in tree:
-                k = tree['node']['k']
-                tree['node']['value'] = (
-                    tree['node']['value'] - self.min[k]) / self.norm[k]
-                fit(tree[0], vector_path)
-                fit(tree[1], vector_path)
-                return
-            for leaf_item in tree['leaf']:
-                vector = get_nested_value(leaf_item, vector_path)
-                set_nested_value(leaf_item, vector_path,
-                                 self.__normalize_input(vector))
-        fit(self.data, vector_path)
-
-    def __euclidean_distance(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
-        return np.sqrt(np.sum((a-b)**2))
-
-    def knn(self, x: np.ndarray, vector_path: str, first_n: int = 10) -> Iterable:
-        data = self.data
-        data_point = self.__normalize_input(x)
-        while 'node' in data:
-            node = data['node']
-            data = data[int(data_point[node['k']] >= node['value'])]
-        return sorted(
-            [
-                {
-                    'cost': self.__euclidean_distance(
-                        data_point,
-                        get_nested_value(leaf_item, vector_path)),
-                    'value': leaf_item
-                } for leaf_item in data['leaf']
-            ], key=lambda x: x['cost'])[:first_n]
-
-    def read(self, tree: dict) -> None:
-        for attr in tree:
-            hasattr(self, attr) and setattr(self, attr, tree[attr])
+                stack.extend([tree[1], tree[0]])
+                continue
+            leaf_items.extend(tree['leaf'])
+        features = np.array([get_nested_value(d, 'features') for d in leaf_items], dtype='float32')
+        sources = np.array([d['source'] for d in leaf_items], dtype='int32')
+        markers = np.array([d['marker'] for d in leaf_items], dtype='int64')
+        self.k = features.shape[1]
+        self._build(features, {'sources': sources, 'markers': markers})
+
+    def read(self, index: dict) -> None:
+        super().read(index)
+        if isinstance(index.get('data'), dict):
+            self.__read_legacy(index['data'])
+
+
+class BallTree(BinaryTree):
+    """
+    Binary tree of nested hyperspheres.
+
+    The tree is built by recursively splitting the data at its median along the dimension with the largest spread.
+    Every node stores the centroid of its data and the radius of the smallest ball around it that holds all of it,
+    which is used to prune branches during search. Balls adapt to the shape of the data better than boxes,
+    so ball trees tend to prune more than k-d trees in higher dimensions, at the cost of a slower build.
+    Insertions and removals rebuild the whole tree.
+
+    Attributes
+    ----------
+    leaf_size: int = 10
+        Maximum number of data items per leaf.
+    """
+
+    def __init__(self, leaf_size: int = 10, **kwargs) -> None:
+        super().__init__(leaf_size=leaf_size, **kwargs)
+
+        # node arrays
+        self.centers = None
+        self.radii = None
+
+    def __build(self, order: np.ndarray, features: np.ndarray, nodes: dict, start: int, end: int) -> int:
+        """ recursively partitions ``order[start:end]`` along its widest dimension and appends nodes, returning the node index """
+        node = len(nodes['bounds'])
+        nodes['bounds'].append((start, end))
+        nodes['children'].append((-1, -1))
+        if end - start <= self.leaf_size:
+            CONSOLE.bar.next(end - start)
+            return node
+        segment = features[order[start:end]]
+        k = int(np.argmax(segment.max(axis=0) - segment.min(axis=0)))
+        middle_index = self._split(order, features, start, end, k)
+        nodes['children'][node] = (
+            self.__build(order, features, nodes, start, middle_index),
+            self.__build(order, features, nodes, middle_index, end),
+        )
+        return node
+
+    def _build(self, features: np.ndarray, columns: dict) -> None:
+        """ builds node arrays over already normalized ``features`` and stores data columns in leaf order """
+        order = np.arange(len(features))
+        nodes = {'children': [], 'bounds': []}
+        CONSOLE.reset_bar('Classifying audio grains:', max=len(features), item='grains')
+        self.__build(order, features, nodes, 0, len(features))
+        CONSOLE.bar.finish()
+        self.children = np.array(nodes['children'], dtype='int32')
+        self.bounds = np.array(nodes['bounds'], dtype='int64')
+        self.features = np.ascontiguousarray(features[order], dtype='float32')
+        for name, column in columns.items():
+            setattr(self, name, np.ascontiguousarray(column[order]))
+        self.__build_balls()
+
+    def __build_balls(self) -> None:
+        """ computes the centroid and radius of every node """
+        sizes = self.bounds[:, 1] - self.bounds[:, 0]
+        sums = np.concatenate([np.zeros((1, self.features.shape[1])), np.cumsum(self.features, axis=0, dtype='float64')])
+        self.centers = ((sums[self.bounds[:, 1]] - sums[self.bounds[:, 0]]) / np.maximum(sizes, 1)[:, np.newaxis]).astype('float32')
+        self.radii = np.empty(len(self.bounds), dtype='float32')
+        for node, (start, end) in enumerate(self.bounds):
+            delta = self.features[start:end] - self.centers[node]
+            self.radii[node] = np.sqrt(np.max(np.einsum('ij,ij->i', delta, delta)))
+
+    def _sides(self, X: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+        left, right = self.children[nodes].T
+        left_costs = np.sum((X - self.centers[left])**2, axis=1)
+        right_costs = np.sum((X - self.centers[right])**2, axis=1)
+        return (right_costs < left_costs).astype('int64')
+
+    def _node_bounds(self, X: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+        """ squared distance from each row of ``X`` to the ball of its node """
+        delta = X - self.centers[nodes]
+        return np.maximum(np.sqrt(np.einsum('ij,ij->i', delta, delta)) - self.radii[nodes], 0) ** 2
+
+
+class IVFPQ(NeighborIndex):
+    """
+    Inverted file index with product quantization, for corpora too large to keep their feature vectors in memory.
+    Features are normalized and encoded a chunk at a time, so they can be fitted from a memory-mapped matrix.
+
+    Grains are clustered around ``nlist`` coarse centroids with k-means, and each grain is stored in the inverted list of its centroid.
+    The residual between a grain and its centroid is split into ``m`` sub-vectors, each of which is replaced by the ``uint8`` index of the
+    nearest of 256 sub-centroids, so that a grain takes ``m`` bytes instead of 4 bytes per feature.
+    Both quantizers are trained on a random sample of at most ``train_size`` grains.
+
+    Searching only visits the ``nprobe`` lists closest to each query, and approximates distances with lookup tables of the sub-centroids.
+    The ``rerank * k`` best candidates are then re-ranked with exact distances to their features, which are kept in half precision.
+
+    Attributes
+    ----------
+    nlist: int | None = None
+        Number of coarse centroids (i.e., inverted lists). Defaults to ``4 * sqrt(N)`` for ``N`` grains.
+
+    nprobe: int = 8
+        Number of inverted lists visited per query. Higher values are more accurate and slower.
+
+    m: int | None = None
+        Number of sub-vectors of the product quantizer (i.e., bytes per grain). Defaults to one per two features.
+
+    rerank: int = 4
+        Multiple of ``k`` of candidates to re-rank with exact distances.
+        If ``0``, features are not stored at all, and results are ranked by their quantized distances.
+
+    train_size: int = 65536
+        Maximum number of grains used to train the quantizers.
+    """
+
+    def __init__(self,
+                 nlist: int | None = None,
+                 nprobe: int = 8,
+                 m: int | None = None,
+                 rerank: int = 4,
+                 train_size: int = 65536,
+                 **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.m = m
+        self.rerank = rerank
+        self.train_size = train_size
+
+        # quantizers
+        self.centroids = None
+        self.codebooks = None
+
+        # compressed data, with rows sorted by inverted list
+        self.codes = None
+        self.list_offsets = None
+
+    @property
+    def mergeable(self) -> bool:
+        return False
+
+    def fit(self, features: np.ndarray, **columns) -> None:
+        """
+        Normalizes a ``(N, k)`` feature matrix and builds the index over it, along with ``N``-sized data columns.
+        Only the training sample is normalized at once, and other grains are normalized and encoded a chunk of rows at a time,
+        so that ``features`` can be memory-mapped (see ``GrainTable.from_analyses``) for corpora that do not fit in memory.
+        """
+        features = np.asarray(features, dtype='float32')
+        self._fit_normalization(features)
+        self.__train(features, normalize=True)
+        self.__set_lists(*self.__encode(features, normalize=True), columns)
+
+    def _build(self, features: np.ndarray, columns: dict) -> None:
+        self.__train(features)
+        self.__set_lists(*self.__encode(features), columns)
+
+    def __train(self, features: np.ndarray, normalize: bool = False) -> None:
+        """ trains the coarse and product quantizers on a sample of ``features``, normalizing it first if ``normalize`` is ``True`` """
+        CONSOLE.log_subprocess('Training quantizers...').print()
+        rng = self._rng()
+        # sorted, so that memory-mapped features are read in order
+        sample = features[np.sort(rng.choice(len(features), min(len(features), self.train_size), replace=False))]
+        if normalize:
+            sample = self._normalize_input(sample)
+        nlist = min(self.nlist or int(4 * np.sqrt(len(features))), len(sample))
+        self.centroids = self.__kmeans(sample, nlist, rng)
+
+        # split residuals into m sub-vectors of equal size, zero-padding the last one if needed
+        self.m = min(self.m or int(np.ceil(sample.shape[1] / 2)), sample.shape[1])
+        residuals = self.__pad(sample - self.centroids[vq(sample, self.centroids, check_finite=False)[0]])
+        residuals = residuals.reshape(len(sample), self.m, -1)
+        num_codes = min(256, len(sample))
+        self.codebooks = np.stack([self.__kmeans(residuals[:, j], num_codes, rng) for j in range(self.m)])
+
+    def __kmeans(self, x: np.ndarray, n_clusters: int, rng: np.random.Generator) -> np.ndarray:
+        """ trains ``n_clusters`` centroids over the rows of ``x`` """
+        with warnings.catch_warnings():
+            # empty clusters only leave some lists or codes unused
+            warnings.simplefilter('ignore')
+            return kmeans2(x, n_clusters, iter=10, minit='points', missing='warn', seed=rng)[0].astype('float32')
+
+    def __pad(self, x: np.ndarray) -> np.ndarray:
+        """ zero-pads the last dimension of ``x`` to a multiple of ``m`` """
+        return np.pad(x, [(0, 0)] * (x.ndim - 1) + [(0, -x.shape[-1] % self.m)])
+
+    def __encode(self, features: np.ndarray, normalize: bool = False) -> tuple:
+        """
+        assigns ``features`` (normalized a chunk of rows at a time first, if ``normalize`` is ``True``) to inverted lists, and quantizes their residuals.
+        Returns the ``(lists, codes, stored)`` of the grains, where ``stored`` holds their normalized features in half precision, if they are re-ranked
+        """
+        lists = np.empty(len(features), dtype='int64')
+        codes = np.empty((len(features), self.m), dtype='uint8')
+        stored = np.empty((len(features), self.centroids.shape[1]), dtype='float16') if self.rerank else None
+        CONSOLE.reset_bar('Encoding audio grains:', max=len(features), item='grains')
+        for chunk in row_chunks(len(features), features.shape[1]):
+            x = self._normalize_input(features[chunk]) if normalize else features[chunk]
+            lists[chunk] = vq(x, self.centroids, check_finite=False)[0]
+            residuals = self.__pad(x - self.centroids[lists[chunk]]).reshape(len(x), self.m, -1)
+            for j in range(self.m):
+                codes[chunk, j] = vq(residuals[:, j], self.codebooks[j], check_finite=False)[0]
+            if self.rerank:
+                stored[chunk] = x
+            CONSOLE.bar.next(len(x))
+        CONSOLE.bar.finish()
+        return lists, codes, stored
+
+    def __set_lists(self, lists: np.ndarray, codes: np.ndarray, stored: np.ndarray | None, columns: dict) -> None:
+        """ stores rows sorted by inverted list, along with the offset of each list """
+        order = np.argsort(lists, kind='stable')
+        self.codes = codes[order]
+        self.features = stored[order] if self.rerank else None
+        for name, column in columns.items():
+            setattr(self, name, np.ascontiguousarray(column[order]))
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=len(self.centroids)))])
+
+    def _update(self, features: np.ndarray, columns: dict, keep: np.ndarray) -> None:
+        """ keeps the ``keep`` rows and encodes new (non-normalized) ``features`` with the trained quantizers, without retraining them """
+        new_lists, new_codes, new_stored = self.__encode(features, normalize=True)
+        lists = np.repeat(np.arange(len(self.centroids)), np.diff(self.list_offsets))
+        self.__set_lists(np.concatenate([lists[keep], new_lists]),
+                         np.concatenate([self.codes[keep], new_codes]),
+                         np.concatenate([self.features[keep], new_stored]) if self.rerank else None,
+                         {name: np.concatenate([column[keep], columns[name]]) for name, column in self._columns().items()})
+
+    def knn_batch(self, X: np.ndarray, k: int = 10, search: str = 'approx', nprobe: int | None = None, **kwargs) -> tuple:
+        """
+        Finds the approximate ``k`` nearest neighbors of every row in ``X``.
+        Queries are searched together, in blocks whose candidates take about a quarter of ``config.MEMORY_BUDGET``.
+
+        X: np.ndarray
+            Matrix of input vectors, in the same (non-normalized) space as the data used to build the index.
+
+        k: int = 10
+            Number of nearest neighbors per input vector. It is capped to the number of items in the index.
+
+        search: str = 'approx'
+            Search mode. ``"approx"`` visits the ``nprobe`` closest inverted lists, or more if they hold fewer than ``k`` items,
+            and ``"exact"`` visits all of them. Since distances are quantized, results are not guaranteed to be exact in either mode.
+
+        nprobe: int | None = None
+            Number of inverted lists to visit per vector in ``"approx"`` mode. Defaults to the ``nprobe`` attribute.
+            Other search options (e.g., ``max_leaves``) are ignored.
+        """
+        if search not in SEARCH_MODES:
+            CONSOLE.error(ValueError, f'"{search}" is not a valid search mode. Choose one of the following: {SEARCH_MODES}')
+        nlist = len(self.centroids)
+        nprobe = nlist if search == 'exact' else min(nprobe or self.nprobe, nlist)
+        X = self._normalize_input(np.atleast_2d(X))
+        k = min(k, len(self))
+        costs = np.empty((len(X), k), dtype='float32')
+        indices = np.empty((len(X), k), dtype='int64')
+
+        # at most nprobe lists are visited, or the fewest that hold k items, which add up to less than k items plus the largest list
+        list_sizes = np.diff(self.list_offsets)
+        max_candidates = max(int(np.sort(list_sizes)[::-1][:nprobe].sum()), k + int(list_sizes.max()))
+        block_rows = max(1, MEMORY_BUDGET // 4 // (max_candidates * (4 * self.m + 64)))
+        for i in range(0, len(X), block_rows):
+            block = slice(i, i + block_rows)
+            costs[block], indices[block] = self.__search(X[block], k, nprobe, list_sizes)
+        return indices, np.sqrt(np.maximum(costs, 0))
+
+    def __search(self, X: np.ndarray, k: int, nprobe: int, list_sizes: np.ndarray) -> tuple:
+        """ finds the ``k`` nearest neighbors of every row of normalized ``X``, returning their squared costs and indices """
+        # visit the nprobe closest lists of each query, or more for queries until at least k items are found
+        coarse_costs = np.einsum('ij,ij->i', self.centroids, self.centroids)[np.newaxis, :] - 2 * (X @ self.centroids.T)
+        if nprobe < len(self.centroids):
+            probes = np.argpartition(coarse_costs, nprobe - 1, axis=1)[:, :nprobe]
+            probes = np.take_along_axis(probes, np.argsort(np.take_along_axis(coarse_costs, probes, axis=1), axis=1, kind='stable'), axis=1)
+        else:
+            probes = np.argsort(coarse_costs, axis=1, kind='stable')
+        num_probes = np.full(len(X), nprobe)
+        few = np.flatnonzero(list_sizes[probes].sum(axis=1) < k)
+        if len(few):
+            probes = np.concatenate([probes, np.zeros((len(X), len(self.centroids) - nprobe), dtype=probes.dtype)], axis=1)
+            probes[few] = np.argsort(coarse_costs[few], axis=1, kind='stable')
+            num_probes[few] = np.argmax(np.cumsum(list_sizes[probes[few]], axis=1) >= k, axis=1) + 1
+            probes = probes[:, :num_probes.max()]
+        sizes = np.where(np.arange(probes.shape[1]) < num_probes[:, np.newaxis], list_sizes[probes], 0).ravel()
+
+        # distance lookup tables from the residual of each (query, list) pair to the sub-centroids of each subspace,
+        # without the squared norm of the residual, which is added once per pair
+        residuals = self.__pad(X[:, np.newaxis] - self.centroids[probes]).reshape(sizes.size, self.m, -1)
+        tables = np.einsum('mcd,mcd->mc', self.codebooks, self.codebooks)[:, np.newaxis] - 2 * (residuals.transpose(1, 0, 2) @ self.codebooks.transpose(0, 2, 1))
+        num_codes = tables.shape[-1]
+
+        # candidates of every pair, laid out in a row per query, padded with infinite costs
+        pairs = np.repeat(np.arange(sizes.size), sizes)
+        queries = pairs // probes.shape[1]
+        rows = self.list_offsets[probes.ravel()][pairs] + np.arange(len(pairs)) - (np.cumsum(sizes) - sizes)[pairs]
+        counts = np.bincount(queries, minlength=len(X))
+        columns = np.arange(len(pairs)) - (np.cumsum(counts) - counts)[queries]
+        lookups = (np.arange(self.m) * sizes.size + pairs[:, np.newaxis]) * num_codes + self.codes[rows]
+        candidate_rows = np.zeros((len(X), counts.max()), dtype='int64')
+        approx_costs = np.full((len(X), counts.max()), np.inf, dtype='float32')
+        candidate_rows[queries, columns] = rows
+        approx_costs[queries, columns] = np.take(tables, lookups).sum(axis=1) + np.einsum('ijk,ijk->i', residuals, residuals)[pairs]
+
+        # re-rank the best candidates with exact distances
+        shortlist = min(counts.max(), max(k, k * self.rerank))
+        best = np.argpartition(approx_costs, shortlist - 1, axis=1)[:, :shortlist]
+        rows = np.take_along_axis(candidate_rows, best, axis=1)
+        candidate_costs = np.take_along_axis(approx_costs, best, axis=1)
+        if self.rerank:
+            delta = self.features[rows].astype('float32') - X[:, np.newaxis]
+            candidate_costs = np.where(np.isinf(candidate_costs), np.inf, np.einsum('ijk,ijk->ij', delta, delta))
+        best = np.argsort(candidate_costs, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(candidate_costs, best, axis=1), np.take_along_axis(rows, best, axis=1)
+
+
+INDICES = {
+    'kdtree': KDTree,
+    'balltree': BallTree,
+    'brute': BruteForce,
+    'ivfpq': IVFPQ,
+}
+
+
+def load_index(kind: str, index: dict) -> NeighborIndex:
+    """ Creates an index of the given ``INDICES`` type from a ``dict`` returned by its ``serialize`` method """
+    if kind not in INDICES:
+        CONSOLE.error(ValueError, f'"{kind}" is not a valid index type. Choose one of the following: {list(INDICES)}')
+    loaded = INDICES[kind]()
+    loaded.read(index)
+    return loaded
+
+
+def select_index(n: int, d: int) -> str:
+    """
+    Picks an index type for ``n`` grains of ``d`` features. Exact k-d tree search only prunes well once there are many grains
+    per cell of the ``2**d`` cells that splitting every dimension once would make, and it is otherwise slower than exhaustive search,
+    whose cost grows linearly with ``n``. So grains are searched exhaustively up to ``config.BRUTE_FORCE_CELL_SIZE * 2**d`` grains
+    (e.g., about 16 thousand grains for 4 features, 260 thousand for 8, and any corpus with more), and with a k-d tree from then on,
+    or past ``config.BRUTE_FORCE_MAX_SIZE`` grains (about half a million), where exhaustive search takes a few milliseconds per query.
+    """
+    if n <= min(BRUTE_FORCE_MAX_SIZE, BRUTE_FORCE_CELL_SIZE * 2**d):
+        return 'brute'
+    return 'kdtree'
+
+
+def merge_indices(indices: Iterable, leaf_size: int = 15) -> NeighborIndex:
+    """
+    Merges the indices of several corpora into a single index, so that they can all be searched with one query (see ``search_merged``).
+    Features are mapped back to their original scale and normalized again with a shared min-max range,
+    and a ``corpora`` column stores the position in ``indices`` of the index each grain comes from.
+    The merged index is of the same type as ``indices`` if they all share one (``leaf_size`` is used for trees),
+    and is otherwise picked with ``select_index``.
+
+    The ``MERGED_INDEX_CACHE_SIZE`` most recently merged indices are kept in memory, and reused as long as
+    the same ``indices`` are merged again without having been updated since.
+    """
+    if not all(index.mergeable for index in indices):
+        CONSOLE.error(ValueError, 'Indices with projected or quantized features cannot be merged')
+    dims = {index.k for index in indices}
+    if len(dims) > 1:
+        CONSOLE.error(ValueError, f'Indices with different numbers of features ({", ".join(map(str, dims))}) cannot be merged')
+
+    # indices replace their feature matrix whenever they are updated, so cached entries hold on to the matrices they were merged from
+    key = (tuple(id(index) for index in indices), leaf_size)
+    with MERGED_INDICES_LOCK:
+        if key in MERGED_INDICES and all(a is index.features for a, index in zip(MERGED_INDICES[key][0], indices)):
+            MERGED_INDICES.move_to_end(key)
+            return MERGED_INDICES[key][1]
+
+    features = np.concatenate([index._denormalize(index.features) for index in indices])
+    kinds = {type(index) for index in indices}
+    kind = kinds.pop() if len(kinds) == 1 else INDICES[select_index(*features.shape)]
+    merged = kind(leaf_size=leaf_size) if issubclass(kind, BinaryTree) else kind()
+    merged.fit(features,
+               sources=np.concatenate([index.sources for index in indices]),
+               markers=np.concatenate([index.markers for index in indices]),
+               corpora=np.concatenate([np.full(len(index), i, dtype='int16') for i, index in enumerate(indices)]))
+
+    with MERGED_INDICES_LOCK:
+        MERGED_INDICES[key] = (tuple(index.features for index in indices), merged)
+        while len(MERGED_INDICES) > MERGED_INDEX_CACHE_SIZE:
+            MERGED_INDICES.popitem(last=False)
+    return merged
+
+
+def search_merged(merged: NeighborIndex, X: np.ndarray, k: int, **kwargs) -> tuple:
+    """
+    Finds the ``k`` nearest grains to every row of ``X`` among all the indices ``merged`` by ``merge_indices``, with a single search
+    of ``merged``, so that neighbors are ranked globally, with the normalization shared by all indices. ``kwargs`` are passed to ``knn_batch``.
+    Indices whose grains are far from a row may get no neighbors at all for it.
+
+    Returns a ``(corpora, sources, markers, distances)`` tuple of arrays with ``k`` columns (fewer, if ``merged`` holds fewer grains),
+    sorted by distance, where ``corpora`` stores the position of the index of each neighbor in the list passed to ``merge_indices``.
+    """
+    rows, distances = merged.knn_batch(X, min(k, len(merged)), **kwargs)
+    return merged.corpora[rows], merged.sources[rows], merged.markers[rows], distances
+
+
+def evaluate_index(index: NeighborIndex,
+                   features: np.ndarray,
+                   sources: np.ndarray,
+                   markers: np.ndarray,
+                   k: int = 10,
+                   num_queries: int = 500,
+                   seed: int | None = None,
+                   **kwargs) -> dict:
+    """
+    Measures the recall and latency of ``index`` against an exact, exhaustive search over the (non-normalized) ``features``
+    it was built from, using a random sample of ``num_queries`` of them as queries, drawn with ``seed``. ``kwargs`` are passed to ``index.knn_batch``.
+    Returns a dict with the mean fraction of the true ``k`` nearest neighbors found by ``index`` (``recall``, see ``compute_recall``),
+    and by an exact search of ``index`` (``exact search recall``), which leaves out the loss of its search mode, so that only that of its projection
+    or quantization remains, along with the time per query of ``index`` (``latency``) and of the exhaustive search (``exact latency``), in seconds.
+    """
+    reference = BruteForce()
+    reference.fit(features, sources=sources, markers=markers)
+    queries = features[np.random.default_rng(seed).choice(len(features), min(num_queries, len(features)), replace=False)]
+
+    start = perf_counter()
+    indices = index.knn_batch(queries, k, **kwargs)[0]
+    latency = (perf_counter() - start) / len(queries)
+    start = perf_counter()
+    exact_distances = reference.knn_batch(queries, k)[1]
+    exact_latency = (perf_counter() - start) / len(queries)
+    exact_indices = index.knn_batch(queries, k, **{**kwargs, 'search': 'exact'})[0]
+    return {
+        'recall': compute_recall(index, indices, reference, queries, exact_distances),
+        'exact search recall': compute_recall(index, exact_indices, reference, queries, exact_distances),
+        'latency': latency,
+        'exact latency': exact_latency,
+    }
+
+
+def compute_recall(index: NeighborIndex,
+                   indices: np.ndarray,
+                   reference: BruteForce,
+                   queries: np.ndarray,
+                   reference_distances: np.ndarray) -> float:
+    """
+    Mean fraction of the neighbors found by ``index`` for ``queries`` (i.e., ``indices``, returned by its ``knn_batch`` method)
+    that are as close as the ``k``-th nearest neighbor found by an exhaustive ``reference`` index over the same grains,
+    whose ``reference_distances`` were returned by its ``knn_batch`` method. Distances are measured in the space of ``reference``,
+    so that grains with identical features count as equally good matches, and projected indices can be compared.
+    """
+    # identify grains by their source and marker, since each index orders its rows differently
+    marker_range = int(max(index.markers.max(), reference.markers.max())) + 1
+    reference_keys = reference.sources.astype('int64') * marker_range + reference.markers
+    found_keys = index.sources[indices].astype('int64') * marker_range + index.markers[indices]
+    sorter = np.argsort(reference_keys)
+    rows = sorter[np.searchsorted(reference_keys, found_keys, sorter=sorter)]
+    delta = reference.features[rows] - reference._normalize_input(queries)[:, np.newaxis, :]
+    distances = np.sqrt(np.einsum('ijk,ijk->ij', delta, delta))
+    # allow for the rounding errors of exhaustive distances
+    worst = reference_distances[:, -1:] * (1 + 1e-4) + 1e-4
+    return float(np.mean(distances <= worst))
@@ -1,24 +1,33 @@
 from __future__ import annotations
 # librosa
-from librosa import magphase, stft, samples_like, load
-from librosa.feature import mfcc, chroma_stft, rms, zero_crossing_rate
+from librosa import load
 from librosa.beat import tempo
 
 # gamut
 from .controls import Points, Envelope, object_to_points
-from .utils import resample_array
-from .audio import AudioBuffer
-from .config import FILE_EXT, CONSOLE, ANALYSIS_TYPES, MIME_TYPES, AUDIO_DIR, get_elapsed_time
-from .data import KDTree
+from .utils import get_num_workers
+from .audio import AudioBuffer, AudioFile, EncodedAudio
+from .sources import scan_sources
+from .container import write_container, read_container, read_header
+from .store import AudioStore
+from .cache import FeatureCache, SampleCache
+from .analysis import AnalysisEngine, get_engine, read_blocks
+from .config import FILE_EXT, CONSOLE, ANALYSIS_TYPES, SEARCH_MODES, SEGMENTATION_TYPES, INDEX_TYPES, PROJECTIONS, MIME_TYPES, ANALYSIS_BATCH_SIZE, TARGET_CACHE_SIZE, STREAMABLE_FORMATS, AUDIO_DTYPES, AUDIO_CODECS, AUDIO_DIR, get_elapsed_time
+from . import config
+from .data import INDICES, GrainTable, NeighborIndex, load_index, select_index, merge_indices, search_merged, evaluate_index
 
 # os
 from os.path import realpath, basename, isdir, splitext, join, commonprefix, relpath, dirname
-from os import walk, rename
+
+# multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from tempfile import TemporaryDirectory
 
 # misc utils
 import filetype
+import soundfile
 from random import choices, random
-from copy import deepcopy
 import datetime
 import os
 
@@ -61,6 +70,8 @@ class Analyzer(ABC):
         self.type = self.__get_type()
         self.name = None
         self.portable = False
+        self.audio_codec = None
+        self.audio_store = False
 
     @abstractmethod
     def _serialize(self):
@@ -76,33 +87,42 @@ class Analyzer(ABC):
 
     def summarize(self) -> None:
         """ Prints a summary of the current structure of the object """
-        summary = self._summarize()
-        if self.name:
-            summary = {'name': self.name, **summary}
-        line = "".join("-" for _ in range(90))
-        CONSOLE.log_process(f"*** {self.type.upper()} SUMMARY ***\n{CONSOLE.c3}{line}").print()
-        for key in summary:
-            val = summary[key]
-            print(f"{CONSOLE.c4}{key.upper()}: {CONSOLE.reset}{val}")
-        print(f'{CONSOLE.c3}{line}{CONSOLE.reset}')
+        print_summary(self.metadata())
+
+    def metadata(self) -> dict:
+        """ Returns the ``type``, ``name`` and ``summary`` of the object, which are stored in the header of ``.gamut`` files (see ``read_metadata``) """
+        return {'type': self.type, 'name': self.name, 'summary': self._summarize()}
 
     @get_elapsed_time
-    def write(self, output: str, portable: bool = False) -> None:
-        """ Writes a ``.gamut`` file to disk """
+    def write(self, output: str, portable: bool = False, audio_codec: str | None = None, audio_store: bool = False) -> None:
+        """
+        Writes a ``.gamut`` file to disk, in the container format of ``gamut.container``.
+        If ``portable`` is ``True``, the audio samples of all sources are embedded in the file, encoded with ``audio_codec``
+        (one of ``config.AUDIO_CODECS``, see ``gamut.audio.EncodedAudio``) if it is not ``None``.
+        If ``audio_store`` is ``True``, samples are instead stored once in the shared ``gamut.store.AudioStore`` (``~/.gamut/objects``),
+        also encoded with ``audio_codec``, and only referenced by the file, so that corpora and the mosaics built from them do not store the same audio twice.
+        Such files do not depend on the source audio files, but they do depend on the store, so they are not portable
+        (see ``AudioStore.prune`` to delete the samples that no file references anymore).
+        """
+        if audio_codec not in [None, *AUDIO_CODECS]:
+            CONSOLE.error(ValueError, f'"{audio_codec}" is not a valid audio codec. Choose one of the following: {AUDIO_CODECS}')
+        if portable and audio_store:
+            CONSOLE.error(ValueError, 'Files written with audio_store=True depend on the AudioStore, so they cannot be portable. Set either portable or audio_store to True')
         self.portable = portable
+        self.audio_codec = audio_codec if portable or audio_store else None
+        self.audio_store = audio_store
         self.name = splitext(basename(output))[0]
         output_dir = splitext(output)[0]
-        CONSOLE.log_disk_op(f'{"" if portable else "non-"}portable {self.type}', f'{realpath(output_dir)}{FILE_EXT}').print()
+        CONSOLE.log_disk_op(f'{self.__storage(portable, audio_store)} {self.type}', f'{realpath(output_dir)}{FILE_EXT}').print()
         serialized_object = self._serialize()
 
-        # write file and set correct file extension
-        np.save(output_dir, serialized_object)
-        rename(output_dir + '.npy', output_dir+FILE_EXT)
+        # write file with correct file extension
+        write_container(output_dir + FILE_EXT, serialized_object, metadata=self.metadata())
         return self
 
     @get_elapsed_time
     def read(self, file: str, warn_user=False) -> Self:
-        """ Reads a ``.gamut`` file from disk """
+        """ Reads a ``.gamut`` file from disk, memory-mapping its arrays (see ``gamut.container.read_container``) """
         if warn_user:
             CONSOLE.warn(f"This {self.type} already has a source")
 
@@ -110,12 +130,12 @@ class Analyzer(ABC):
         if splitext(file)[1] != FILE_EXT:
             CONSOLE.error(ValueError, 'Wrong file extension. Provide a directory for a {} file'.format(FILE_EXT))
 
-        serialized_object = np.load(file, allow_pickle=True).item()
+        serialized_object = read_container(file)
         if serialized_object['type'] != self.type:
             CONSOLE.error(TypeError, 'The specified file .gamut file is a {}, not a {}.'.format(
                 serialized_object['type'], self.type))
-        is_portable = serialized_object['portable']
-        CONSOLE.log_disk_op(f'{"" if is_portable else "non-"}portable {self.type}', basename(file), read=True).print()
+        storage = self.__storage(serialized_object['portable'], serialized_object.get('audio_store', False))
+        CONSOLE.log_disk_op(f'{storage} {self.type}', basename(file), read=True).print()
 
         serialized_object = self._preload(serialized_object)
 
@@ -130,51 +150,201 @@ class Analyzer(ABC):
         """ Helper function to get subclass name """
         return self.__class__.__name__.lower()
 
-    def _analyze_audio_file(self, y: np.ndarray, features: Iterable, sr: int | None = None) -> tuple:
+    @staticmethod
+    def __storage(portable: bool, audio_store: bool) -> str:
+        """ Helper function to describe where the audio samples of a file are stored """
+        return 'store-backed' if audio_store else f'{"" if portable else "non-"}portable'
+
+    def _stores_audio(self, obj: dict | None = None) -> bool:
+        """ whether the audio samples of ``obj`` (or of ``self``, if ``None``) are kept in the file or in the ``AudioStore``, rather than reloaded from audio files """
+        obj = vars(self) if obj is None else obj
+        return bool(obj['portable'] or obj.get('audio_store'))
+
+    def _analyze_audio_file(self, y: np.ndarray, features: Iterable, sr: int | None = None, segmentation: str = 'frame') -> tuple:
         """ Extracts audio features from an ``ndarray`` of audio samples """
-        S = magphase(stft(y=y,
-                          n_fft=self.n_fft,
-                          win_length=self.win_length,
-                          hop_length=self.hop_length))[0]
-
-        analysis = []
-        if 'timbre' in features:
-            mfcc_features = mfcc(S=S,
-                                 sr=sr,
-                                 n_mfcc=self.n_mfcc,
-                                 hop_length=self.hop_length)
-
-            analysis.extend(mfcc_features)
-
-        if 'pitch' in features:
-            zerox = zero_crossing_rate(y=y,
-                                       frame_length=self.win_length,
-                                       hop_length=self.hop_length)
-            loudness = rms(S=S,
-                           frame_length=self.win_length,
-                           hop_length=self.hop_length)
-            chroma_features = chroma_stft(S=S,
-                                          sr=sr,
-                                          n_fft=self.n_fft,
-                                          win_length=self.win_length,
-                                          hop_length=self.hop_length)
-            analysis.extend(np.concatenate([chroma_features, loudness, zerox]))
-
-        analysis = np.array(analysis).T[:-1]
-
-        markers = samples_like(X=analysis,
-                               hop_length=self.hop_length,
-                               n_fft=self.n_fft,
-                               axis=0)
+        return analyze_audio(y=y, features=features, sr=sr, segmentation=segmentation, **self._analysis_params())
+
+    def _serialize_source(self, source: dict) -> dict:
+        """
+        shallow copy of a source ``dict`` to write, without its audio samples (``y``) if neither portable nor store-backed,
+        or with them encoded with ``audio_codec``
+        """
+        serialized = {key: value for key, value in source.items() if key != 'y' or self._stores_audio()}
+        y = serialized.get('y')
+        if y is None:
+            return serialized
+        if self.audio_codec and not (isinstance(y, EncodedAudio) and y.codec == self.audio_codec):
+            y = EncodedAudio.encode(y, self.audio_codec, sr=source['sr'])
+        if self.audio_store:
+            del serialized['y']
+            serialized['blob'] = AudioStore().put(y)
+        elif self.audio_codec:
+            serialized['y'] = y.serialize()
+        return serialized
+
+    @staticmethod
+    def _preload_source(source: dict) -> None:
+        """ restores the audio samples of a source read from a portable or store-backed file, if they were encoded or kept in the ``AudioStore`` """
+        if 'blob' in source:
+            source['y'] = AudioStore().get(source.pop('blob'))
+        elif isinstance(source.get('y'), dict):
+            source['y'] = EncodedAudio(**source['y'])
+
+    def _analysis_params(self) -> dict:
+        """ analysis parameters, as keyword arguments of ``analyze_audio`` """
+        return {'n_mfcc': self.n_mfcc, 'hop_length': self.hop_length, 'win_length': self.win_length, 'n_fft': self.n_fft}
+
+
+def print_summary(metadata: dict) -> None:
+    """ Prints the summary of a ``Corpus`` or ``Mosaic``, given its ``metadata`` (see ``Analyzer.metadata``) """
+    summary = metadata['summary']
+    if metadata['name']:
+        summary = {'name': metadata['name'], **summary}
+    line = "".join("-" for _ in range(90))
+    CONSOLE.log_process(f"*** {metadata['type'].upper()} SUMMARY ***\n{CONSOLE.c3}{line}").print()
+    for key in summary:
+        val = summary[key]
+        print(f"{CONSOLE.c4}{key.upper()}: {CONSOLE.reset}{val}")
+    print(f'{CONSOLE.c3}{line}{CONSOLE.reset}')
+
+
+def read_metadata(file: str) -> dict:
+    """
+    Returns the metadata of a ``.gamut`` file (i.e., the ``type``, ``name`` and ``summary`` returned by ``Analyzer.metadata`` when it was written),
+    reading only its header, so that neither its index, frames nor audio are loaded.
+    Files written before metadata was stored in headers are read in full.
+    """
+    if splitext(file)[1] != FILE_EXT:
+        CONSOLE.error(ValueError, 'Wrong file extension. Provide a directory for a {} file'.format(FILE_EXT))
+    header = read_header(file)[1]
+    if header is not None and header.get('metadata'):
+        return header['metadata']
+    gamut_type = read_container(file)['type']
+    return {'corpus': Corpus, 'mosaic': Mosaic}[gamut_type]().read(file).metadata()
+
+
+def analyze_audio(y: np.ndarray,
+                  features: Iterable,
+                  sr: int | None = None,
+                  n_mfcc: int = 13,
+                  hop_length: int = 512,
+                  win_length: int = 1024,
+                  n_fft: int = 1024,
+                  segmentation: str = 'frame') -> tuple:
+    """
+    Extracts audio features from an ``ndarray`` of audio samples, returning a matrix of analysis frames and their sample markers,
+    or of onset segments and the markers of their first frames if ``segmentation`` is ``"onset"`` (see ``AnalysisEngine.analyze``)
+    """
+    engine = get_engine(n_mfcc=n_mfcc, hop_length=hop_length, win_length=win_length, n_fft=n_fft)
+    return engine.analyze(y=y, features=features, sr=sr, segmentation=segmentation)
+
+
+def load_and_analyze(files: list,
+                     features: Iterable,
+                     max_duration: float | None = None,
+                     cache: FeatureCache | None = None,
+                     block_size: int | None = None,
+                     lazy: bool = False,
+                     segmentation: str = 'frame',
+                     **params) -> list:
+    """
+    Loads a batch of audio files as mono at their own sampling rates, and extracts their audio features with a single ``AnalysisEngine`` pass,
+    reusing the analyses stored in ``cache`` for the same files and parameters, if any.
+    If ``block_size`` is not ``None``, files are instead read and analyzed one by one, in blocks of ``block_size`` samples.
+    If ``lazy`` is ``True``, samples are returned as ``AudioFile`` instances rather than loaded in memory, and files whose analysis is cached are not decoded.
+    Otherwise, files whose analysis is cached are not decoded either, but returned as ``AudioFile`` instances that load them in memory once they are first read.
+    ``segmentation`` is passed to ``AnalysisEngine.analyze_batch``.
+    Returns a ``(y, sr, analysis, markers)`` tuple per file. Defined at module level, so that it can run in worker processes.
+    """
+    engine = get_engine(**params)
+    results = [None] * len(files)
+    keys = [None] * len(files)
+    if cache is not None:
+        for i, file in enumerate(files):
+            # keys of frame analyses predate segmentation
+            segmented = {} if segmentation == 'frame' else {'segmentation': segmentation}
+            keys[i] = cache.key(file, features=sorted(features), max_duration=max_duration, **segmented, **params)
+            cached = cache.get(keys[i])
+            if cached is None:
+                continue
+            if lazy:
+                y = AudioFile(file, max_duration=max_duration).open()
+            elif 'length' in cached:
+                y = AudioFile(file, sr=int(cached['sr']), max_duration=max_duration, length=int(cached['length']), in_memory=True)
+            else:
+                # entries stored without the sampling rate and length of their file, which are measured by decoding it
+                y = AudioFile(file, max_duration=max_duration, in_memory=True).open()
+            results[i] = (y, y.sr, cached['analysis'], cached['markers'])
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    if block_size is None:
+        signals = [load(path=files[i], sr=None, mono=True, duration=max_duration) for i in missing]
+        analyses = zip(signals, engine.analyze_batch(signals, features, segmentation=segmentation))
+    else:
+        analyses = (stream_and_analyze(files[i], features, block_size, max_duration, engine, lazy=lazy, segmentation=segmentation)
+                    for i in missing)
+
+    for i, ((y, sr), (analysis, markers)) in zip(missing, analyses):
+        if lazy and not isinstance(y, AudioFile):
+            y = AudioFile(files[i], sr=sr, max_duration=max_duration).open()
+        results[i] = (y, sr, analysis, markers)
+        if cache is not None:
+            cache.put(keys[i], analysis=analysis, markers=markers, sr=sr, length=len(y))
+    return results
+
+
+def stream_and_analyze(file: str,
+                       features: Iterable,
+                       block_size: int,
+                       max_duration: float | None,
+                       engine: AnalysisEngine,
+                       lazy: bool = False,
+                       segmentation: str = 'frame') -> tuple:
+    """
+    Reads an audio file in blocks of ``block_size`` samples and analyzes them as they are read (see ``AnalysisEngine.analyze_blocks``),
+    so that the memory used by the analysis does not grow with the file duration.
+    Returns a ``((y, sr), (analysis, markers))`` tuple, where ``y`` is an ``AudioFile``, which unless ``lazy`` is ``True`` loads the file in memory once first read,
+    so that samples are not held while analyzing.
+    Files in formats that ``soundfile`` cannot read sample-accurately in blocks (e.g., MP3) are loaded whole, and then analyzed block by block.
+    """
+    try:
+        info = soundfile.info(file)
+    except (soundfile.LibsndfileError, RuntimeError):
+        info = None
+    if info is None or info.format not in STREAMABLE_FORMATS:
+        y, sr = load(path=file, sr=None, mono=True, duration=max_duration)
+        blocks = (lambda: (y[i:i+block_size] for i in range(0, len(y), block_size)))
+        return (y, sr), engine.analyze_blocks(blocks, features, sr, segmentation=segmentation)
+
+    # source samples are only read again to synthesize a mosaic, by sample ranges if lazy, or otherwise loaded in memory then
+    sr = info.samplerate
+    length = info.frames if max_duration is None else min(info.frames, int(max_duration * sr))
+    y = AudioFile(file, sr=sr, max_duration=max_duration, length=length, in_memory=not lazy)
+    return (y, sr), engine.analyze_blocks(lambda: read_blocks(file, block_size, max_duration), features, sr, segmentation=segmentation)
+
+
+def load_target(file: str, sr: int | None = None) -> tuple:
+    """
+    Loads a target audio file as ``librosa.load(file, sr=sr)`` does, keeping the ``TARGET_CACHE_SIZE`` most recently loaded targets in memory,
+    so that building several mosaics for the same target decodes it once. The returned samples are read-only, since they may be shared.
+    """
+    stat = os.stat(file)
+    return _load_target(realpath(file), sr, stat.st_size, stat.st_mtime_ns)
 
-        return analysis, markers
+
+@lru_cache(maxsize=TARGET_CACHE_SIZE)
+def _load_target(file: str, sr: int | None, size: int, mtime: int) -> tuple:
+    """ cached ``load_target``, keyed by the identity of the file """
+    y, sr = load(file, sr=sr)
+    y.flags.writeable = False
+    return y, sr
 
 
 class Corpus(Analyzer):
     """ 
     A ``Corpus`` represents a collection of one or more audio sources, from which a ``Mosaic`` can be built.
     Internally, the audio sources are analyzed and decomposed into grains.\n
-    Based on the audio features of these grains (e.g., timbre or pitch content), a k-dimensional search tree is built, 
+    Based on the audio features of these grains (e.g., timbre or pitch content), a nearest neighbor index (e.g., a k-dimensional search tree) is built, 
     which helps to optimize the process of finding the best matches for a given audio target.
 
     source: str | list | None = None
@@ -202,6 +372,63 @@ class Corpus(Analyzer):
 
     leaf_size: int = 10
         Maximum number of data items per leaf in the k-dimensional binary search tree.
+        It also sets how many candidate grains are matched to each target segment when building a ``Mosaic``.
+
+    index: str = 'auto'
+        Type of nearest neighbor index used to search the corpus grains. ``"kdtree"`` builds a k-dimensional binary search tree, 
+        ``"balltree"`` builds a binary tree of nested hyperspheres, which can prune better with many features,
+        and ``"brute"`` runs an exact, vectorized exhaustive search, which is fast enough for small corpora. 
+        ``"auto"`` picks ``"brute"`` or ``"kdtree"`` by the number of grains and of features (see ``gamut.data.select_index``).
+        ``"ivfpq"`` builds an inverted file index with product quantization, which stores a few bytes per grain
+        and is meant for very large corpora (e.g., hundreds of hours of audio) whose features do not fit in memory.
+
+    index_options: dict | None = None
+        Extra arguments for the index, such as ``nlist``, ``nprobe`` or ``m`` for ``"ivfpq"`` indices (see ``gamut.data.IVFPQ``).
+
+    projection: str | None = None
+        Optional projection of the grain features onto fewer dimensions before indexing, which speeds up search
+        for corpora with many features (e.g., ``['timbre', 'pitch']``) at the cost of approximate matches.
+        ``"pca"`` uses principal component analysis, and ``"random"`` a gaussian random projection.
+        The projection is stored with the index and automatically applied to target segments when building a ``Mosaic``.
+        The recall and latency of the projected index, compared to an exact search, are reported in the corpus summary,
+        both for the default ``"approx"`` search mode and for an ``"exact"`` search of the projected index, which only suffers from the projection.
+        They are not measured for ``"ivfpq"`` indices, whose grain features are not kept in memory (see ``gamut.data.evaluate_index``).
+
+    n_components: int | float | None = None
+        Number of dimensions to project onto. For ``"pca"``, a ``float`` between 0 and 1 keeps the fewest components
+        that explain at least that fraction of the variance (``0.95`` by default).
+        For ``"random"``, a ``float`` is taken as a fraction of the number of features (``0.5`` by default).
+
+    n_jobs: int | None = 1
+        Number of processes used to load and analyze audio files in parallel. ``-1`` or ``None`` uses all CPU cores.
+        Sources are merged in the same order regardless of ``n_jobs``. Since worker processes may re-import the calling script
+        (e.g., on macOS and Windows), scripts that use ``n_jobs`` other than 1 must build the ``Corpus`` under an ``if __name__ == '__main__':`` block.
+
+    cache: bool = True
+        Whether to reuse the features of audio files analyzed before with the same parameters, stored in an on-disk cache
+        (see ``gamut.cache.FeatureCache``), so that only new or modified files are analyzed.
+        Cached files are not decoded when building the corpus, so that large corpora are rebuilt in seconds. Unless ``lazy`` is ``True``,
+        they are decoded and kept in memory once a mosaic first reads their samples.
+
+    block_size: int | None = None
+        If not ``None``, audio files are read and analyzed in blocks of ``block_size`` samples, rather than loaded whole before analysis,
+        so that the memory used by the analysis of long files (e.g., hours of field recordings) depends on ``block_size`` rather than on their duration.
+        Unless ``lazy`` is ``True``, the samples of such files are only loaded in memory once a mosaic first reads them.
+
+    lazy: bool = False
+        If ``True``, the samples of audio sources are not kept in memory, but read from disk when synthesizing a mosaic, only for the grains it uses
+        (see ``gamut.audio.AudioFile``). This allows using corpora larger than the available memory, but requires the source files to remain in place.
+        Compressed files (e.g., MP3) are decoded once into an on-disk cache (see ``gamut.cache.SampleCache``).
+
+    segmentation: str = 'frame'
+        How audio sources are decomposed into grains. ``"frame"`` makes a grain out of every analysis frame, every ``hop_length`` samples,
+        while ``"onset"`` makes a grain out of every segment between detected onsets, with the average features of its frames.
+        Onset segmentation typically yields 5 to 20 times fewer grains, which makes corpora smaller and faster to search, especially for sparse or percussive sources.
+
+    seed: int | None = None
+        Seed for the random parts of building the index, i.e., ``"random"`` projections, the training of ``"ivfpq"`` indices,
+        and the queries sampled to report the recall of projected indices. If ``None``, a seed is drawn and stored with the corpus,
+        so that its index and report can be reproduced.
     """
 
     def __init__(self,
@@ -209,6 +436,16 @@ class Corpus(Analyzer):
                  max_duration: int | None = None,
                  leaf_size: int | None = 15,
                  features: Iterable = ['timbre'],
+                 index: str = 'auto',
+                 index_options: dict | None = None,
+                 projection: str | None = None,
+                 n_components: int | float | None = None,
+                 n_jobs: int | None = 1,
+                 cache: bool = True,
+                 block_size: int | None = None,
+                 lazy: bool = False,
+                 segmentation: str = 'frame',
+                 seed: int | None = None,
                  *args,
                  **kwargs) -> None:
         super().__init__(*args, **kwargs)
@@ -217,7 +454,19 @@ class Corpus(Analyzer):
         self.features = features
         self.total_duration = 0
         self.source_root = ""
-        self.tree = KDTree(leaf_size=leaf_size)
+        self.leaf_size = leaf_size
+        self.index = index
+        self.index_options = index_options
+        self.projection = projection
+        self.n_components = n_components
+        self.projection_report = None
+        self.n_jobs = n_jobs
+        self.cache = cache
+        self.block_size = block_size
+        self.lazy = lazy
+        self.segmentation = segmentation
+        self.seed = seed
+        self.tree = None
         CONSOLE.reset_counter('Analyzing audio samples: ')
 
         for f in self.features:
@@ -229,6 +478,12 @@ class Corpus(Analyzer):
         if len(self.features) == 0:
             CONSOLE.error(
                 ValueError, f'You must specify at least one audio feature to instantiate a {self.type.capitalize()} instance')
+        if self.index not in INDEX_TYPES:
+            CONSOLE.error(ValueError, f'"{self.index}" is not a valid index type. Choose one of the following: {INDEX_TYPES}')
+        if self.projection not in [None, *PROJECTIONS]:
+            CONSOLE.error(ValueError, f'"{self.projection}" is not a valid projection. Choose one of the following: {PROJECTIONS}')
+        if self.segmentation not in SEGMENTATION_TYPES:
+            CONSOLE.error(ValueError, f'"{self.segmentation}" is not a valid segmentation. Choose one of the following: {SEGMENTATION_TYPES}')
 
         self.soundfiles = []
         if self.source:
@@ -240,10 +495,84 @@ class Corpus(Analyzer):
     def __build(self) -> None:
         """ build corpus from `source` """
         CONSOLE.log_process('\N{brain} Building audio corpus...').print()
-        data = self.__compile(source=None, data=[], excluded_files=[])
+        with TemporaryDirectory() as directory:
+            # IVF-PQ indices are fitted a chunk at a time, so their grain features are memory-mapped rather than kept in memory
+            grains = self.__compile(source=None, excluded_files=[], path=join(directory, 'features.npy') if self.index == 'ivfpq' else None)
+            CONSOLE.counter.finish()
+            self.__set_source_root()
+            if self.index == 'auto':
+                self.index = select_index(*grains.features.shape)
+            if self.seed is None:
+                self.seed = int(np.random.default_rng().integers(2**32))
+            options = {'projection': self.projection, 'n_components': self.n_components, 'seed': self.seed, **(self.index_options or {})}
+            if self.index in ['kdtree', 'balltree']:
+                options['leaf_size'] = self.leaf_size
+            self.tree = INDICES[self.index](**options)
+            self.tree.fit(grains.features, **grains.columns)
+            # measuring recall takes an exhaustive index over all grains, which would not fit in memory for IVF-PQ corpora
+            if self.projection and self.index != 'ivfpq':
+                CONSOLE.log_subprocess('Measuring recall of projected index...').print()
+                self.projection_report = evaluate_index(self.tree, grains.features, grains.sources, grains.markers,
+                                                        k=self.leaf_size, seed=self.seed)
+            del grains
+
+    @get_elapsed_time
+    def add_sources(self, source: str | list) -> None:
+        """
+        Adds one or more audio sources to the ``Corpus``, analyzing only the new files and inserting their grains into the existing index.
+        ``source`` can be either a ``str`` or a list of ``str``, where ``str`` is an audio file path or a directory of audio files.
+        Files with the same name as a source already in the ``Corpus`` are skipped.
+        """
+        if self.tree is None:
+            CONSOLE.error(ValueError, f'Sources can only be added to a {self.type} that has already been built or read from disk')
+        CONSOLE.log_process('\N{brain} Adding sources to audio corpus...').print()
+        source = [source] if isinstance(source, str) else list(source)
+        self.__restore_source_paths()
+        CONSOLE.reset_counter('Analyzing audio samples: ')
+        grains = self.__compile(source=source, excluded_files=[
+            splitext(basename(sf['file']))[0] for sf in self.soundfiles])
         CONSOLE.counter.finish()
         self.__set_source_root()
-        self.tree.build(data=data, vector_path='features')
+        self.source = list(self.source or []) + source
+        if not len(grains):
+            return
+        self.tree.insert(grains.features, **grains.columns)
+
+    @get_elapsed_time
+    def remove_sources(self, source: str | list) -> None:
+        """
+        Removes one or more audio sources from the ``Corpus``, along with their grains in the index.
+        ``source`` can be either a ``str`` or a list of ``str``, where ``str`` is an audio file path or a directory,
+        in which case all sources inside of it are removed.
+        """
+        CONSOLE.log_process('\N{brain} Removing sources from audio corpus...').print()
+        paths = [realpath(s) for s in ([source] if isinstance(source, str) else source)]
+        self.__restore_source_paths()
+        removed = []
+        for source_id, sf in enumerate(self.soundfiles):
+            path = realpath(sf['file'])
+            if any(path == p or path.startswith(join(p, '')) for p in paths):
+                removed.append(source_id)
+        kept = [source_id for source_id in range(len(self.soundfiles)) if source_id not in set(removed)]
+        if not kept:
+            CONSOLE.error(ValueError, 'Removing these sources would leave the corpus without any source audio files')
+
+        if removed:
+            self.tree.remove(np.isin(self.tree.sources, removed))
+            # re-number the remaining sources
+            lookup = np.full(len(self.soundfiles), -1, dtype='int32')
+            lookup[kept] = np.arange(len(kept))
+            self.tree.sources = lookup[self.tree.sources]
+            self.total_duration -= sum(len(self.soundfiles[i]['y']) / self.soundfiles[i]['sr'] for i in removed)
+            self.soundfiles = [self.soundfiles[i] for i in kept]
+            self.source = [s for s in self.source or [] if realpath(s) not in paths]
+        self.__set_source_root()
+
+    def __restore_source_paths(self) -> None:
+        """ undo `__set_source_root`, so that sources can be added or removed """
+        # copy soundfile entries, since mosaics built from this corpus may share them
+        self.soundfiles = [{**sf, 'file': join(self.source_root, sf['file'])} for sf in self.soundfiles]
+        self.source_root = ""
 
     def _summarize(self) -> dict:
         filenames = "\n"
@@ -256,54 +585,84 @@ class Corpus(Analyzer):
         return {
             "source root": self.source_root,
             "portable": self.portable,
+            **({"audio store": AudioStore().directory} if self.audio_store else {}),
+            **({"audio codec": self.audio_codec} if self.audio_codec else {}),
             "duration (H:M:S)": str(datetime.timedelta(seconds=int(self.total_duration))),
             "max. duration per source": f'{self.max_duration}' + ("s" if self.max_duration else ""),
-            "max. tree leaf size": self.tree.leaf_size,
+            "search index": self.index,
+            "index size": self.__summarize_index_size(),
+            "max. tree leaf size": self.leaf_size,
             "analysis features": ", ".join(self.features),
+            "segmentation": self.segmentation,
+            **self.__summarize_projection(),
             f'sources ({len(self.soundfiles)})': filenames,
         }
 
-    def __compile(self, source: list | str | None = None, excluded_files: list = [], data: list = []) -> None:
-        """ recursively collects and extracts features from all audio files in `source` """
-        source = source or self.source
-        source_type = type(source or self.source)
-        if source_type == list:
-            for x in source:
-                self.__compile(x, excluded_files=excluded_files, data=data)
-            return data
-
-        source_path = realpath(source)
-        if isdir(source_path):
-            for root, _, files in walk(source_path):
-                for f in files:
-                    self.__compile(join(root, f), excluded_files=excluded_files, data=data)
-            return data
-
-        filename = splitext(basename(source))[0]
-        kind = filetype.guess(source_path)
-        if kind is None or kind.mime not in MIME_TYPES or filename in excluded_files:
-            return data
-
-        excluded_files.append(filename)
-
-        y, sr = load(path=source, sr=None, mono=True,
-                     duration=self.max_duration)
-        source_id = len(self.soundfiles)
-        self.soundfiles.append({
-            'file': source,
-            'sr': sr,
-            'y': y
-        })
-        self.total_duration += len(y)/sr
-        analysis, markers = self._analyze_audio_file(y=y, features=self.features, sr=sr)
-        CONSOLE.counter.next()
-        data.extend([{
-            'source': source_id,
-            'marker': marker,
-            'features': features,
-        } for features, marker in zip(analysis, markers)])
-
-        return data
+    def __summarize_index_size(self) -> str | None:
+        if self.tree is None or len(self.tree) == 0:
+            return None
+        return f'{self.tree.nbytes / 2**20:.1f} MB ({self.tree.nbytes / len(self.tree):.0f} bytes per grain)'
+
+    def __summarize_projection(self) -> dict:
+        if not self.projection or self.tree is None:
+            return {}
+        summary = f'{self.projection}, {self.tree.k} → {self.tree.components.shape[1]} dimensions'
+        if self.tree.explained_variance is not None:
+            summary += f' ({self.tree.explained_variance:.1%} of variance)'
+        report = self.projection_report
+        if not report:
+            return {'projection': summary}
+        return {
+            'projection': summary,
+            f'projection recall@{self.leaf_size}': f"{report['recall']:.1%} ({report['exact search recall']:.1%} with exact search), "
+            f"at {report['latency'] * 1000:.3f} ms per segment "
+            f"(vs. {report['exact latency'] * 1000:.3f} ms for an exact search without projection)",
+        }
+
+    def __compile(self, source: list | str | None = None, excluded_files: list = [], path: str | None = None) -> GrainTable:
+        """
+        extracts features from all audio files in `source`, spreading them over `n_jobs` processes, returning their grains,
+        whose features are memory-mapped from a file at `path`, if given (see ``GrainTable.from_analyses``)
+        """
+        files = [entry['file'] for entry in scan_sources(source or self.source, excluded_files=excluded_files)]
+        cache = FeatureCache() if self.cache else None
+        params = {'features': self.features, 'max_duration': self.max_duration, 'cache': cache,
+                  'block_size': self.block_size, 'lazy': self.lazy, 'segmentation': self.segmentation, **self._analysis_params()}
+        num_workers = min(get_num_workers(self.n_jobs), len(files))
+        # batch files so that each worker analyzes several of them in one pass
+        batch_size = max(1, min(ANALYSIS_BATCH_SIZE, len(files) // max(num_workers, 1)))
+        batches = [files[i:i+batch_size] for i in range(0, len(files), batch_size)]
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                futures = {pool.submit(load_and_analyze, batch, **params): batch for batch in batches}
+                for future in as_completed(futures):
+                    for _ in futures[future]:
+                        CONSOLE.counter.next()
+                results = [result for future in futures for result in future.result()]
+        else:
+            results = []
+            for batch in batches:
+                results.extend(load_and_analyze(batch, **params))
+                for _ in batch:
+                    CONSOLE.counter.next()
+        if cache is not None:
+            cache.evict()
+        if self.lazy:
+            SampleCache().evict()
+
+        # merge results in source order
+        analyses = []
+        for file, (y, sr, analysis, markers) in zip(files, results):
+            source_id = len(self.soundfiles)
+            self.soundfiles.append({
+                'file': file,
+                'sr': sr,
+                'y': y
+            })
+            self.total_duration += len(y)/sr
+            analyses.append((source_id, analysis, markers))
+
+        return GrainTable.from_analyses(analyses, path=path)
 
     @classmethod
     def print_feature_choices(cls) -> None:
@@ -321,32 +680,34 @@ class Corpus(Analyzer):
             self.soundfiles[i]['file'] = relpath(sf['file'], self.source_root)
 
     def _serialize(self) -> dict:
-        """ called from within write method """
-        corpus = deepcopy({**vars(self), 'tree': vars(self.tree)})
-
-        # if not portable, delete audio samples from soundfiles on write
-        if not self.portable:
-            for sf in corpus['soundfiles']:
-                del sf['y']
-        return corpus
+        """ called from within write method. Arrays are shared with ``self`` rather than copied, and audio samples are skipped if neither portable nor store-backed """
+        return {
+            **vars(self),
+            'tree': self.tree.serialize(),
+            'soundfiles': [self._serialize_source(sf) for sf in self.soundfiles],
+        }
 
     def _preload(self, obj: object) -> dict:
         """ called from within read method """
         gamut_type = obj['type']
         if gamut_type != self.type:
             CONSOLE.error(ValueError, f'source file should be a {self.type}, not a {gamut_type}')
-        tree = KDTree()
-        tree.read(obj['tree'])
-        obj['tree'] = tree
+        # files written before index types were introduced always hold a k-d tree
+        obj.setdefault('index', 'kdtree')
+        obj.setdefault('leaf_size', obj['tree'].get('leaf_size'))
+        obj['tree'] = load_index(obj['index'], obj['tree'])
 
-        # re-load audio files if corpus file is not portable
-        if not obj['portable']:
+        # re-load audio files if corpus file is neither portable nor store-backed
+        if not self._stores_audio(obj):
             CONSOLE.counter.message = CONSOLE.log_subprocess('Loading audio files: ')
             for sf in obj['soundfiles']:
                 path = join(obj['source_root'], sf['file'])
-                sf['y'] = load(path, sr=sf['sr'])[0]
+                sf['y'] = AudioFile(path, sr=sf['sr'], max_duration=obj['max_duration']) if obj.get('lazy') else AudioStore().load(path, sr=sf['sr'])
                 CONSOLE.counter.next()
             CONSOLE.counter.finish()
+        else:
+            for sf in obj['soundfiles']:
+                self._preload_source(sf)
         return obj
 
     def read(self, file: str) -> None:
@@ -377,22 +738,68 @@ class Mosaic(Analyzer):
     beat_unit: float | int | None = None
         Optional argument to set the grain rate to a beat unit relative to detected tempo (e.g., 1/4, 1/8, 1/16, etc.).
         Works best when ``target`` has a steady and perceptible tempo.
+
+    search: str = 'approx'
+        Nearest neighbor search mode used to match target segments to corpus grains.
+        ``"exact"`` finds the true nearest grains at a higher cost, while ``"approx"`` limits the search to a budget of
+        ``max_leaves`` tree leaves and/or ``max_checks`` grains for k-d and ball trees, or to the ``nprobe`` closest inverted lists of IVF-PQ indices.
+        It does not apply to brute-force indices, which always search exhaustively.
+
+    max_leaves: int | None = None
+        Maximum number of tree leaves to visit per target segment in ``"approx"`` search mode.
+        If neither ``max_leaves`` nor ``max_checks`` is given, a single leaf is visited.
+
+    max_checks: int | None = None
+        Maximum number of corpus grains to compare against per target segment in ``"approx"`` search mode.
+
+    segmentation: str = 'frame'
+        How the target is decomposed into segments to be matched. ``"frame"`` matches every analysis frame, every ``hop_length`` samples (or every ``beat_unit``),
+        while ``"onset"`` matches every segment between detected onsets, by the average features of its frames, and renders a grain per segment.
+        For sparse or percussive targets, onset segmentation typically matches 5 to 20 times fewer segments, so mosaics are faster to build and render.
+
+    cache: bool = True
+        Whether to reuse the tempo estimate and analysis of targets analyzed before with the same parameters, stored in an on-disk cache
+        (see ``gamut.cache.FeatureCache``). Decoded targets are also kept in memory, so that building several mosaics for the same target
+        only loads and analyzes it once.
+
+    merge_corpora: bool = False
+        Whether to search several corpora with one query per target segment, through an index merged from theirs with a shared normalization
+        (see ``gamut.data.merge_indices``), which returns the ``sum(leaf_size)`` best matches across all corpora, so that a corpus far from a segment
+        may get none. Otherwise, each corpus is searched on its own for its ``leaf_size`` best matches. Merged indices cost about as much to build as
+        the corpora did and are only kept in memory, while a merged search saves little over separate ones, so this only pays off when many mosaics
+        are built from the same corpora. Corpora with projected or quantized features are always searched on their own.
     """
 
+    # candidate grains for each target segment, sorted from best to worst match
+    FRAME_DTYPE = np.dtype([('corpus', 'int16'), ('source', 'int32'), ('marker', 'int64')])
+
     def __init__(self,
                  target: str | None = None,
                  corpus: Iterable | Corpus | None = None,
                  sr: int | None = None,
                  beat_unit: float | int | None = None,
+                 search: str = 'approx',
+                 max_leaves: int | None = None,
+                 max_checks: int | None = None,
+                 segmentation: str = 'frame',
+                 cache: bool = True,
+                 merge_corpora: bool = False,
                  *args,
                  **kwargs) -> None:
-        self.__validate(target, corpus)
+        self.__validate(target, corpus, search, segmentation)
         super().__init__(*args, **kwargs)
 
         self.target = target
         self.sr = sr
         self.frames = []
         self.beat_unit = beat_unit
+        self.search = search
+        self.max_leaves = max_leaves
+        self.max_checks = max_checks
+        self.segmentation = segmentation
+        self.segments = None
+        self.cache = cache
+        self.merge_corpora = merge_corpora
         self.features = []
         self.duration = None
 
@@ -403,13 +810,17 @@ class Mosaic(Analyzer):
             self.features = corpora[0].features
             self.__build(corpora=corpora, sr=sr)
 
-    def __validate(self, target: str | None, corpus: Iterable | Corpus | None) -> None:
+    def __validate(self, target: str | None, corpus: Iterable | Corpus | None, search: str, segmentation: str) -> None:
         if any([target, corpus]) and not all([target, corpus]):
             CONSOLE.error(
                 ValueError,
                 f'You must either provide both target and corpus attributes, or leave them blank to build Mosaic from {FILE_EXT} file')
         if not target:
             return
+        if search not in SEARCH_MODES:
+            CONSOLE.error(ValueError, f'"{search}" is not a valid search mode. Choose one of the following: {SEARCH_MODES}')
+        if segmentation not in SEGMENTATION_TYPES:
+            CONSOLE.error(ValueError, f'"{segmentation}" is not a valid segmentation. Choose one of the following: {SEGMENTATION_TYPES}')
         target_path = realpath(target)
         if isdir(target_path):
             CONSOLE.error(ValueError, f'{target} is not a valid audio file path')
@@ -446,13 +857,17 @@ class Mosaic(Analyzer):
         CONSOLE.log_process(
             f'\N{brain} Building mosaic for {basename(self.target)} from {"corpus" if num_corpora == 1 else f"{num_corpora} corpora"}...').print()
         CONSOLE.log_subprocess('Loading target...').print()
-        y, self.sr = load(self.target, sr=sr)
+        y, self.sr = load_target(self.target, sr=sr)
+        cache = FeatureCache() if self.cache else None
 
         self.duration = len(y) / self.sr
 
         if self.beat_unit:
-            self.hop_length = int((self.sr * 60) / (tempo(y=y, sr=self.sr)[0] / self.beat_unit))
-        target_analysis = self._analyze_audio_file(y=y, features=corpora[0].features, sr=self.sr)[0]
+            self.hop_length = int((self.sr * 60) / (self.__estimate_tempo(y, cache) / self.beat_unit))
+        target_analysis, target_markers = self.__analyze_target(y, corpora[0].features, cache)
+        if self.segmentation == 'onset':
+            # sample boundaries of target segments
+            self.segments = np.append(target_markers - self.n_fft // 2, len(y))
 
         # include separate corpus for target
         self.soundfiles[-1] = {
@@ -471,37 +886,74 @@ class Mosaic(Analyzer):
             self.soundfiles[corpus_id] = {
                 'source_root': corpus.source_root,
                 'max_duration': corpus.max_duration,
+                'lazy': corpus.lazy,
                 'sources': {}
             }
-        CONSOLE.reset_bar('Finding matches for target segments:', max=len(target_analysis), item='segments')
-        for x in target_analysis:
-            matches = []
+        CONSOLE.log_subprocess('Finding matches for target segments...').print()
+        search = {'search': self.search, 'max_leaves': self.max_leaves, 'max_checks': self.max_checks}
+        if num_corpora == 1:
+            indices = corpora[0].tree.knn_batch(X=target_analysis, k=corpora[0].leaf_size, **search)[0]
+            self.frames = self.__get_frames(corpora[0].tree, indices)
+        elif self.merge_corpora and all(corpus.tree.mergeable for corpus in corpora):
+            # search all corpora at once through a merged index with a shared normalization, for a globally ranked list of matches
+            index = merge_indices([corpus.tree for corpus in corpora], leaf_size=max(corpus.leaf_size for corpus in corpora))
+            corpus_ids, sources, markers, _ = search_merged(index, target_analysis, sum(corpus.leaf_size for corpus in corpora), **search)
+            self.frames = np.empty(sources.shape, dtype=self.FRAME_DTYPE)
+            self.frames['corpus'], self.frames['source'], self.frames['marker'] = corpus_ids, sources, markers
+        else:
+            # each corpus is searched separately for its leaf_size matches, which are then sorted by distance
+            frames, costs = [], []
             for corpus_id, corpus in enumerate(corpora):
-                nearest_neighbors = corpus.tree.knn(
-                    x=x,
-                    vector_path='features',
-                    first_n=corpus.tree.leaf_size)
-                for nn in nearest_neighbors:
-                    # get id of source audio file
-                    source_id = nn['value']['source']
-                    self.soundfiles[corpus_id]['sources'][source_id] = corpus.soundfiles[source_id]
-                    nn['value']['corpus'] = corpus_id
-                    option = deepcopy(nn)
-                    del option['value']['features']
-                    matches.append(option)
-            self.frames.append([x['value'] for x in sorted(matches, key=lambda x: x['cost'])])
-            CONSOLE.bar.next()
-        CONSOLE.bar.finish()
+                indices, distances = corpus.tree.knn_batch(X=target_analysis, k=corpus.leaf_size, **search)
+                frames.append(self.__get_frames(corpus.tree, indices, corpus_id))
+                costs.append(distances)
+            order = np.argsort(np.concatenate(costs, axis=1), axis=1, kind='stable')
+            self.frames = np.take_along_axis(np.concatenate(frames, axis=1), order, axis=1)
 
-    def _serialize(self) -> dict:
-        mosaic = deepcopy(vars(self))
+        # keep a reference to every source audio file used by the mosaic
+        for corpus_id, corpus in enumerate(corpora):
+            for source_id in np.unique(self.frames['source'][self.frames['corpus'] == corpus_id]).tolist():
+                self.soundfiles[corpus_id]['sources'][source_id] = corpus.soundfiles[source_id]
+
+    def __estimate_tempo(self, y: np.ndarray, cache: FeatureCache | None) -> float:
+        """ estimates the tempo of the target, reusing the estimate stored in ``cache``, if any """
+        if cache is None:
+            return tempo(y=y, sr=self.sr)[0]
+        key = cache.key(self.target, sr=self.sr, analysis='tempo')
+        cached = cache.get(key)
+        if cached is not None:
+            return cached['tempo'][0]
+        target_tempo = tempo(y=y, sr=self.sr)
+        cache.put(key, tempo=target_tempo)
+        return target_tempo[0]
+
+    def __analyze_target(self, y: np.ndarray, features: Iterable, cache: FeatureCache | None) -> tuple:
+        """ extracts the audio features of the target and their markers, reusing the analysis stored in ``cache``, if any """
+        if cache is None:
+            return self._analyze_audio_file(y=y, features=features, sr=self.sr, segmentation=self.segmentation)
+        key = cache.key(self.target, sr=self.sr, features=sorted(features), segmentation=self.segmentation, **self._analysis_params())
+        cached = cache.get(key)
+        if cached is not None:
+            return cached['analysis'], cached['markers']
+        analysis, markers = self._analyze_audio_file(y=y, features=features, sr=self.sr, segmentation=self.segmentation)
+        cache.put(key, analysis=analysis, markers=markers)
+        return analysis, markers
+
+    def __get_frames(self, index: NeighborIndex, indices: np.ndarray, corpus_id: int = 0) -> np.ndarray:
+        """ looks up the corpus, source and marker of each grain in a matrix of ``index`` rows """
+        frames = np.empty(indices.shape, dtype=self.FRAME_DTYPE)
+        frames['corpus'] = corpus_id if index.corpora is None else index.corpora[indices]
+        frames['source'] = index.sources[indices]
+        frames['marker'] = index.markers[indices]
+        return frames
 
-        # if not portable, delete audio samples from soundfiles on write
-        if not self.portable:
-            for corpus_id in mosaic['soundfiles']:
-                for source_id in mosaic['soundfiles'][corpus_id]['sources']:
-                    del mosaic['soundfiles'][corpus_id]['sources'][source_id]['y']
-        return mosaic
+    def _serialize(self) -> dict:
+        """ called from within write method. Arrays are shared with ``self`` rather than copied, and audio samples are skipped if neither portable nor store-backed """
+        soundfiles = {}
+        for corpus_id, corpus in self.soundfiles.items():
+            sources = {source_id: self._serialize_source(source) for source_id, source in corpus['sources'].items()}
+            soundfiles[corpus_id] = {**corpus, 'sources': sources}
+        return {**vars(self), 'soundfiles': soundfiles}
 
     def _summarize(self) -> dict:
         duration = str(datetime.timedelta(seconds=int(self.duration))) if self.duration else None
@@ -518,21 +970,34 @@ class Mosaic(Analyzer):
         return {
             "target": basename(str(self.target)),
             "portable": self.portable,
+            **({"audio store": AudioStore().directory} if self.audio_store else {}),
+            **({"audio codec": self.audio_codec} if self.audio_codec else {}),
             "duration (H:M:S)": duration,
             "num. of corpora": num_corpora,
             "num. of sources": ", ".join(num_sources),
             "analysis features": ", ".join(self.features),
+            "search mode": self.search,
+            "segmentation": self.segmentation,
             "num. of grains": len(self.frames)
         }
 
     def _preload(self, obj: dict) -> dict:
-        # reload soundfiles if non-portable
-        if not obj['portable']:
+        # convert frames from older files, stored as lists of dicts
+        if isinstance(obj['frames'], list):
+            obj['frames'] = [np.array([(f['corpus'], f['source'], f['marker']) for f in frame], dtype=self.FRAME_DTYPE)
+                             for frame in obj['frames']]
+
+        # reload soundfiles if neither portable nor store-backed
+        if not self._stores_audio(obj):
             self.__load_soundfiles(obj['soundfiles'])
+        else:
+            for corpus in obj['soundfiles'].values():
+                for source in corpus['sources'].values():
+                    self._preload_source(source)
         return obj
 
     def read(self, file: str) -> Self:
-        return super().read(file, warn_user=self.frames)
+        return super().read(file, warn_user=len(self.frames) > 0)
 
     def __load_soundfiles(self, soundfiles: Iterable) -> None:
         CONSOLE.counter.message = CONSOLE.log_subprocess('Loading audio files: ')
@@ -543,8 +1008,10 @@ class Mosaic(Analyzer):
                 source = sources[source_id]
                 if 'y' not in source:
                     path = join(corpus['source_root'], source['file'])
-                    soundfiles[corpus_id]['sources'][source_id]['y'] = load(
-                        path, sr=source['sr'], duration=corpus['max_duration'])[0]
+                    if corpus.get('lazy'):
+                        source['y'] = AudioFile(path, sr=source['sr'], max_duration=corpus['max_duration'])
+                    else:
+                        source['y'] = AudioStore().load(path, sr=source['sr'], duration=corpus['max_duration'])
                 CONSOLE.counter.next()
         CONSOLE.counter.finish()
 
@@ -552,7 +1019,7 @@ class Mosaic(Analyzer):
     def to_audio(self,
                  # dynamic control parameters
                  fidelity: float | int | Envelope | Iterable = 1.0,
-                 grain_dur: float | int | Envelope | Iterable = 0.1,
+                 grain_dur: float | int | Envelope | Iterable | None = None,
                  stretch_factor: float | int | Envelope | Iterable = 1.0,
                  onset_var: float | int | Envelope | Iterable = 0,
                  pan_depth: float | int | Envelope | Iterable = 5,
@@ -562,15 +1029,16 @@ class Mosaic(Analyzer):
                  # static parameters
                  n_chans: int = 2,
                  sr: int | None = None,
-                 win_length_res: int = 512) -> AudioBuffer:
+                 win_length_res: int = 512,
+                 dtype: str | None = None) -> AudioBuffer:
         """
         Returns an *audio mosaic* as an ``AudioBuffer`` instance, based on several audio control parameters, such as `grain duration`, `onset variation`, `panning depth`, `grain envelope`, `grain duration`, `number of channels`, and more.
 
         fidelity: float | int | Envelope | Iterable = 1.0
             Normalized probablity (0.0 - 1.0) of choosing the best possible match from ``Corpus`` for each grain in ``target``.
 
-        grain_dur: float | int | Envelope | Iterable = 0.1
-            Grain duration in seconds.
+        grain_dur: float | int | Envelope | Iterable | None = None
+            Grain duration in seconds. Defaults to 0.1 seconds, or to the duration of each target segment for mosaics with onset segmentation.
 
         stretch_factor: float | int | Envelope | Iterable = 1.0
             Stretch factor of audio output (e.g., 1: original speed, 0.5: twice as fast, 2: twice as slow, etc.)
@@ -601,7 +1069,17 @@ class Mosaic(Analyzer):
         win_length_res: int = 512
             Grain duration resolution in samples.
 
+        dtype: str | None = None
+            Data type of the grain windows, panning gains and output audio buffer, as one of ``config.AUDIO_DTYPES``. Defaults to ``config.AUDIO_DTYPE``.
+            With ``"float32"``, grains are read, enveloped and mixed in single precision, which halves the memory taken by the output buffer.
+            Control tables are kept in ``float64`` (or ``int64``) in either case, since grain onsets are accumulated over the whole output,
+            and so are the positions at which resampled sources are interpolated, which would lose sample accuracy after 2**24 samples in ``float32``.
+
         """
+        # read when called, so that changes to config.AUDIO_DTYPE apply to modules imported before them
+        dtype = dtype if dtype is not None else config.AUDIO_DTYPE
+        if dtype not in AUDIO_DTYPES:
+            CONSOLE.error(ValueError, f'dtype must be one of the following: {AUDIO_DTYPES}')
         n_segments = len(self.frames)
 
         def as_points(param, N: int = n_segments) -> Points:
@@ -628,60 +1106,68 @@ class Mosaic(Analyzer):
                 even_weights = False
             return mix_table / mix_table.sum(axis=1)[:, np.newaxis], even_weights
 
-        def preprocess_samples(n_chans: int, sr: int) -> None:
-            """ resamples files with conflicting sampling rates """
-            soundfiles = deepcopy(self.soundfiles)
-            CONSOLE.reset_counter('Preprocessing audio files: ')
-            for corpus_id in soundfiles:
-                sources = soundfiles[corpus_id]['sources']
-                for source_id in sources:
-                    source = sources[source_id]
-                    y = source['y']
-                    sr_ratio = sr/source['sr']
-                    if source['sr'] != sr:
-                        y = resample_array(y, int(len(y) * sr_ratio))
-                    soundfiles[corpus_id]['sources'][source_id]['y'] = np.repeat(np.array([y]).T, n_chans, axis=1)
-                    CONSOLE.counter.next()
-            CONSOLE.counter.finish()
-            return soundfiles
+        def source_length(source: dict) -> int:
+            """ number of samples of a source, once resampled to the output sampling rate """
+            return len(source['y']) if source['sr'] == sr else int(len(source['y']) * sr / source['sr'])
+
+        def read_grain(source: dict, start: int, end: int) -> np.ndarray:
+            """
+            reads samples ``start`` to ``end`` of a source, resampled to the output sampling rate, so that only the samples of grains
+            in use are read from sources that are not in memory. Samples match those of resampling the whole source with ``resample_array``
+            """
+            y = source['y']
+            if source['sr'] == sr:
+                return y[start:end]
+            positions = np.arange(start, end) * ((len(y) - 1) / max(1, source_length(source) - 1))
+            first, last = int(positions[0]), min(len(y), int(positions[-1]) + 2)
+            return np.interp(positions, np.arange(first, last), y[first:last]).astype(dtype, copy=False)
 
         CONSOLE.log_process(f'\N{brain} Generating audio from mosaic target: {basename(self.target)}...').print()
         # playback ratio
         sr, sr_ratio = (self.sr, 1) if not sr else (sr, sr/self.sr)
         hop_length = int(self.hop_length * sr_ratio)
 
-        soundfiles = preprocess_samples(n_chans=n_chans, sr=sr)
-
         # DYNAMIC CONTROL TABLES
         CONSOLE.log_subprocess('Creating parameter envelopes...').print()
 
         corpus_weights_table, even_weights = parse_corpus_weights_param(corpus_weights)
 
-        win_length_table = (as_points(grain_dur) * sr).quantize(win_length_res).astype('int64')
+        # segment lengths in output samples
+        if self.segmentation == 'onset':
+            segment_lengths = Points(np.diff(self.segments) * sr_ratio)
+        else:
+            segment_lengths = hop_length
 
-        max_win_length = np.amax(win_length_table) + win_length_res
-        win_lengths = np.arange(win_length_res, max_win_length, win_length_res, dtype='int64')
+        if grain_dur is None and self.segmentation == 'onset':
+            win_length_table = segment_lengths.quantize(win_length_res).clip(min=win_length_res).astype('int64')
+        else:
+            win_length_table = (as_points(0.1 if grain_dur is None else grain_dur) * sr).quantize(win_length_res).astype('int64')
 
         samp_onset_table = (as_points(stretch_factor)
-                            * hop_length).quantize().concat([0], prepend=True).astype('int64').cumsum()[:-1]
+                            * segment_lengths).quantize().concat([0], prepend=True).astype('int64').cumsum()[:-1]
 
         # apply onset variation to samp_onset_table
         samp_onset_var_table = (np.random.rand(n_segments) - 0.5) * as_points(onset_var) * (sr // 2)
         samp_onset_table += samp_onset_var_table.astype('int64')
         samp_onset_table[samp_onset_table < 0] = 0
 
-        # compute amplitude windows
-        windows = [as_points(grain_env, wl).wrap().T.replicate(n_chans, axis=1) for wl in win_lengths]
+        # amplitude windows, computed for each grain size on first use
+        windows = {}
+
+        def get_window(size: int) -> Points:
+            if size not in windows:
+                windows[size] = object_to_points(grain_env, size, dtype=dtype).wrap().T.replicate(n_chans, axis=1)
+            return windows[size]
 
         # compute panning table
         pan_depth_table = as_points(pan_depth).wrap().T.replicate(n_chans, axis=1)
         pan_table = Points(np.linspace(0, 1, n_chans)).wrap().replicate(n_segments, axis=0) - np.random.rand(n_segments, 1)
         pan_table = 1 / (2**(pan_depth_table * pan_table.abs()))
         pan_table /= pan_table.sum(axis=1)[:, np.newaxis]
+        pan_table = pan_table.astype(dtype, copy=False)
 
         # make buffer array
-        buffer = np.empty(shape=(int(np.amax(samp_onset_table) + np.amax(win_length_table)), n_chans))
-        buffer.fill(0)
+        buffer = np.zeros(shape=(int(np.amax(samp_onset_table) + np.amax(win_length_table)), n_chans), dtype=dtype)
 
         CONSOLE.reset_bar('Concatenating grains:', max=len(self.frames), item='grains')
 
@@ -695,8 +1181,11 @@ class Mosaic(Analyzer):
                 amp = 1.0
                 candidates = frames
                 if not even_weights:
-                    corpus_id = choices([x for x in self.soundfiles.keys() if x != -1], weights=corpora_weights[1:])[0]
-                    candidates = [x for x in candidates if x['corpus'] == corpus_id]
+                    # only corpora with candidates for this frame can be picked, since merged searches may leave some without any
+                    corpus_ids = np.unique(candidates['corpus'])
+                    if corpora_weights[1:][corpus_ids].any():
+                        corpus_id = choices(corpus_ids, weights=corpora_weights[1:][corpus_ids])[0]
+                        candidates = candidates[candidates['corpus'] == corpus_id]
 
                 num_candidates = max(1, int(len(candidates) * (1 - fidelity_value)))
                 weights = np.linspace(1.0, 0.0, num_candidates)
@@ -705,26 +1194,27 @@ class Mosaic(Analyzer):
                 f = {
                     'corpus': -1,
                     'source': 0,
-                    'marker': n * self.hop_length,
+                    'marker': n * self.hop_length if self.segments is None else self.segments[n],
                 }
-                amp = target_weight
+                amp = float(target_weight)
             source_id = f['source']
             corpus_id = f['corpus']
-            source = soundfiles[corpus_id]['sources'][source_id]['y']
-            source_sr_ratio = sr/soundfiles[corpus_id]['sources'][source_id]['sr']
-            max_idx = len(source) - 1
+            source = self.soundfiles[corpus_id]['sources'][source_id]
+            source_sr_ratio = sr/source['sr']
+            max_idx = source_length(source) - 1
             grain_start = int(f['marker'] * source_sr_ratio)
             grain_end = min(max_idx, grain_start+win_length)
             grain_size = round((grain_end-grain_start) / win_length_res) * win_length_res
             grain_end = grain_start+grain_size
             if grain_size > 0 and grain_end <= max_idx:
-                idx = int(np.where(win_lengths == grain_size)[0])
-                window = windows[idx]
-                grain = source[grain_start:grain_end] * window * pan_value * amp
+                window = get_window(grain_size)
+                grain = read_grain(source, grain_start, grain_end)[:, np.newaxis] * window * pan_value * amp
                 buffer[grain_onset:grain_onset+grain_size] = buffer[grain_onset:grain_onset+grain_size] + grain
             CONSOLE.bar.next()
 
         CONSOLE.bar.finish()
 
-        # return normalized buffer
-        return AudioBuffer(y=(buffer / np.amax(np.abs(buffer))) * np.sqrt(0.5), sr=sr)
+        # return normalized buffer, in place to avoid copies of the whole output
+        buffer /= max(buffer.max(), -buffer.min())
+        buffer *= np.sqrt(0.5).astype(dtype)
+        return AudioBuffer(y=buffer, sr=sr)
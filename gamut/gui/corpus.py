@@ -12,7 +12,7 @@ from kivy.app import App
 from .config import CORPUS_DIR, CORPUS_CACHE, GAMUT_SESSION
 from .dialogs import LoadDialog, Summary
 from .utils import log_message, capture_exceptions, log_done, UserConfirmation
-from ..features import Corpus
+from ..features import Corpus, read_metadata
 from ..config import AUDIO_FORMATS
 from .buttons import MenuItem
 
@@ -153,14 +153,12 @@ class CorpusMenuWidget(Widget):
     @capture_exceptions
     def open_summary(self):
         """ Opens a modal window with information about the currently selected corpus """
-        global CORPUS_CACHE
         corpus_name = self.get_selected_toggles()[0].value
         if corpus_name in CORPUS_CACHE:
-            corpus = CORPUS_CACHE[corpus_name]
+            summary = CORPUS_CACHE[corpus_name]._summarize()
         else:
-            corpus = Corpus().read(os.path.join(CORPUS_DIR, f'{corpus_name}.gamut'))
-            CORPUS_CACHE[corpus_name] = corpus
-        Summary(title="CORPUS SUMMARY", summary=corpus._summarize()).open()
+            summary = read_metadata(os.path.join(CORPUS_DIR, f'{corpus_name}.gamut'))['summary']
+        Summary(title="CORPUS SUMMARY", summary=summary).open()
 
     def delete_selected_corpora(self) -> None:
         selected = self.get_selected_toggles()
@@ -14,7 +14,7 @@ from .utils import capture_exceptions, log_done, log_message, UserConfirmation
 from .dialogs import LoadDialog, Summary
 from .buttons import MenuItem
 
-from ..features import Corpus, Mosaic
+from ..features import Corpus, Mosaic, read_metadata
 from ..config import AUDIO_FORMATS
 
 # misc
@@ -158,14 +158,12 @@ class MosaicMenuWidget(Widget):
     @capture_exceptions
     def open_summary(self):
         """ Opens a modal window with information about the currently selected mosaic """
-        global MOSAIC_CACHE
         mosaic_name = self.get_selected_toggles()[0].value
         if mosaic_name in MOSAIC_CACHE:
-            mosaic = MOSAIC_CACHE[mosaic_name]
+            summary = MOSAIC_CACHE[mosaic_name]._summarize()
         else:
-            mosaic = Mosaic().read(os.path.join(MOSAIC_DIR, f'{mosaic_name}.gamut'))
-            MOSAIC_CACHE[mosaic_name] = mosaic
-        Summary(title="MOSAIC SUMMARY", summary=mosaic._summarize()).open()
+            summary = read_metadata(os.path.join(MOSAIC_DIR, f'{mosaic_name}.gamut'))['summary']
+        Summary(title="MOSAIC SUMMARY", summary=summary).open()
 
 
 class MosaicWidget(Widget):
@@ -0,0 +1,77 @@
+from __future__ import annotations
+# gamut
+from .config import AUDIO_FORMATS, MIME_TYPES, SCAN_WORKERS
+
+# misc
+from concurrent.futures import ThreadPoolExecutor
+from os.path import realpath, basename, isdir, splitext, join
+from os import walk
+import filetype
+import soundfile
+import os
+
+# typing
+from collections.abc import Iterable
+
+
+def scan_sources(source: str | list, excluded_files: Iterable = (), num_workers: int = SCAN_WORKERS) -> list:
+    """
+    Finds all audio files in ``source``, returning a manifest with a ``dict`` per file, whose keys are
+    ``file``, ``size`` (in bytes), ``mtime`` (in nanoseconds), ``sr``, ``channels`` and ``duration`` (in seconds).
+    Audio properties are ``None`` for files that ``soundfile`` cannot read (their duration may also be approximate for compressed files).
+
+    Folders are walked recursively, and only their files with an extension in ``config.AUDIO_FORMATS`` are considered.
+    The headers of those files, as well as of files given explicitly, are then sniffed concurrently to keep only supported audio formats.
+    Files are listed in the order in which they are found, skipping those whose name (without extension) was already found, or is in ``excluded_files``.
+
+    source: str | list
+        Audio file path(s) and/or folder(s).
+
+    excluded_files: Iterable = ()
+        Names of files to skip, without extension.
+
+    num_workers: int = config.SCAN_WORKERS
+        Number of threads used to read file headers.
+    """
+    candidates = []
+    for path in [source] if isinstance(source, str) else source:
+        source_path = realpath(path)
+        if not isdir(source_path):
+            candidates.append(path)
+            continue
+        for root, _, filenames in walk(source_path):
+            candidates.extend(join(root, f) for f in filenames if splitext(f)[1].lower() in AUDIO_FORMATS)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        manifest = pool.map(sniff_audio_file, candidates)
+
+    names = set(excluded_files)
+    sources = []
+    for entry in manifest:
+        if entry is None:
+            continue
+        name = splitext(basename(entry['file']))[0]
+        if name in names:
+            continue
+        names.add(name)
+        sources.append(entry)
+    return sources
+
+
+def sniff_audio_file(file: str) -> dict | None:
+    """ Returns the manifest entry of ``file`` (see ``scan_sources``), or ``None`` if it is not a supported audio file """
+    try:
+        kind = filetype.guess(realpath(file))
+        stat = os.stat(file)
+    except OSError:
+        return None
+    if kind is None or kind.mime not in MIME_TYPES:
+        return None
+
+    entry = {'file': file, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sr': None, 'channels': None, 'duration': None}
+    try:
+        info = soundfile.info(file)
+    except (soundfile.LibsndfileError, RuntimeError):
+        return entry
+    entry.update(sr=info.samplerate, channels=info.channels, duration=info.duration)
+    return entry
@@ -0,0 +1,157 @@
+from __future__ import annotations
+# gamut
+from .config import OBJECTS_DIR, FILE_BLOCK_SIZE, FILE_EXT, CONSOLE
+from .audio import AudioFile, EncodedAudio
+from .container import write_container, read_container, read_header
+
+# misc
+from librosa import load
+from os.path import join, realpath, exists, isdir
+from weakref import WeakValueDictionary
+from threading import Lock
+from typing import Iterable, Iterator
+import hashlib
+import json
+import os
+import re
+
+# numpy
+import numpy as np
+
+
+class AudioStore:
+    """
+    Content-addressed store of audio samples, shared by the corpora and mosaics written with ``audio_store=True`` (see ``Analyzer.write``).
+    Each set of samples is stored once in ``directory``, as a ``.gamut`` container named after the hash of its contents,
+    and ``.gamut`` files only reference it by hash, so that corpora and the mosaics built from them do not duplicate audio on disk.
+
+    In-process, samples are shared through weak references: all corpora and mosaics that use the same samples hold the same object,
+    which is loaded (memory-mapped) once and released when the last of them is dropped.
+    Audio files loaded by non-portable corpora and mosaics are shared the same way, by file, sampling rate and duration.
+
+    Samples are never deleted when the files that reference them are, so ``prune`` should be called from time to time
+    with all the ``.gamut`` files in use, to delete the samples that none of them references.
+
+    directory: str = config.OBJECTS_DIR
+        Directory where samples are stored (``~/.gamut/objects`` by default).
+    """
+
+    # samples in use by any corpus or mosaic, by content hash and by audio file identity
+    _blobs = WeakValueDictionary()
+    _files = WeakValueDictionary()
+    _lock = Lock()
+
+    def __init__(self, directory: str = OBJECTS_DIR) -> None:
+        self.directory = directory
+
+    def _path(self, key: str) -> str:
+        return join(self.directory, key)
+
+    @staticmethod
+    def _is_key(name: str) -> bool:
+        return re.fullmatch('[0-9a-f]{40}', name) is not None
+
+    @staticmethod
+    def hash(y: np.ndarray | AudioFile | EncodedAudio) -> str:
+        """ Returns the content hash of a set of samples, which for ``EncodedAudio`` is that of its encoded data """
+        digest = hashlib.blake2b(digest_size=20)
+        if isinstance(y, EncodedAudio):
+            state = y.serialize()
+            digest.update(json.dumps({key: value for key, value in state.items() if key not in ['data', 'offsets']}).encode())
+            for key in ['data', 'offsets']:
+                if state[key] is not None:
+                    digest.update(np.ascontiguousarray(state[key]).reshape(-1).view('uint8'))
+            return digest.hexdigest()
+        digest.update(b'float32')
+        block_size = FILE_BLOCK_SIZE // 4
+        for start in range(0, len(y), block_size):
+            digest.update(np.ascontiguousarray(y[start:start + block_size], dtype='float32').view('uint8'))
+        return digest.hexdigest()
+
+    def put(self, y: np.ndarray | AudioFile | EncodedAudio) -> str:
+        """ Stores a set of samples, unless they are already stored, and returns their key """
+        with self._lock:
+            key = next((key for key, value in list(self._blobs.items()) if value is y), None)
+        key = key or self.hash(y)
+        if not exists(self._path(key)):
+            os.makedirs(self.directory, exist_ok=True)
+            write_container(self._path(key), {'y': y.serialize() if isinstance(y, EncodedAudio) else y})
+        if not isinstance(y, AudioFile):
+            with self._lock:
+                self._blobs.setdefault(key, y)
+        return key
+
+    def get(self, key: str) -> np.ndarray | EncodedAudio:
+        """ Returns the samples stored under ``key``, sharing them with any corpus or mosaic that already uses them """
+        with self._lock:
+            y = self._blobs.get(key)
+            if y is not None:
+                return y
+            if not exists(self._path(key)):
+                CONSOLE.error(FileNotFoundError, f'Audio object {key} is missing from {self.directory}')
+            y = read_container(self._path(key))['y']
+            y = EncodedAudio(**y) if isinstance(y, dict) else y
+            self._blobs[key] = y
+            return y
+
+    def load(self, file: str, sr: int | None = None, duration: float | None = None) -> np.ndarray:
+        """
+        Loads an audio file as ``librosa.load(file, sr=sr, duration=duration)[0]`` does, sharing its samples with any corpus or mosaic
+        that already loaded the same file, as long as it has not changed since.
+        """
+        stat = os.stat(file)
+        key = (realpath(file), stat.st_size, stat.st_mtime_ns, sr, duration)
+        with self._lock:
+            y = self._files.get(key)
+            if y is None:
+                y = load(file, sr=sr, duration=duration)[0]
+                self._files[key] = y
+            return y
+
+    def references(self, file: str) -> set:
+        """ Returns the keys of the samples referenced by a ``.gamut`` file, reading only its header """
+        header = read_header(file)[1]
+        return set() if header is None else set(_find_blobs(header['object']))
+
+    def prune(self, files: Iterable) -> list:
+        """
+        Deletes the samples that are not referenced by any of ``files``, nor in use in this process, and returns their keys.
+        ``files`` are paths to ``.gamut`` files, or to directories searched recursively for them.
+        The samples of any store-backed file left out of ``files`` are deleted as well, so it can no longer be read.
+        """
+        if not isdir(self.directory):
+            return []
+        referenced = set()
+        for file in _find_files(files):
+            referenced |= self.references(file)
+        removed = []
+        with self._lock:
+            referenced |= set(self._blobs.keys())
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and self._is_key(entry.name) and entry.name not in referenced:
+                    os.remove(entry.path)
+                    removed.append(entry.name)
+        return removed
+
+
+def _find_files(paths: Iterable) -> Iterator:
+    """ yields ``paths`` that are ``.gamut`` files, and the ``.gamut`` files within those that are directories """
+    for path in [paths] if isinstance(paths, str) else paths:
+        if not isdir(path):
+            yield path
+            continue
+        for root, _, names in os.walk(path):
+            yield from (join(root, name) for name in names if name.endswith(FILE_EXT))
+
+
+def _find_blobs(value: object) -> Iterator:
+    """ yields the ``blob`` keys of sources within the JSON header tree of a ``.gamut`` file """
+    if isinstance(value, list):
+        for item in value:
+            yield from _find_blobs(item)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'blob' and isinstance(item, str):
+                yield item
+            else:
+                yield from _find_blobs(item)
@@ -2,6 +2,7 @@ from __future__ import annotations
 import numpy as np
 from typing import Any, Callable
 from collections.abc import Iterable
+import os
 
 
 def get_nested_value(obj: object, path: str | None, separator: str = ".") -> Any:
@@ -61,8 +62,17 @@ def set_nested_value(obj: object, path: str, replace: object, separator: str = '
     return __set_nested_value(obj, path.split(separator), replace)
 
 
-def resample_array(array: np.ndarray, N: int) -> np.ndarray:
-    return np.interp(np.linspace(0, len(array) - 1, N), np.arange(0, len(array)), array)
+def resample_array(array: np.ndarray, N: int, dtype: np.dtype | str | None = None) -> np.ndarray:
+    """ Linearly resamples a 1D ``array`` to ``N`` samples, as ``float64`` values unless another ``dtype`` is given """
+    y = np.interp(np.linspace(0, len(array) - 1, N), np.arange(0, len(array)), array)
+    return y if dtype is None else y.astype(dtype, copy=False)
+
+
+def get_num_workers(n_jobs: int | None) -> int:
+    """ Resolves an ``n_jobs`` argument into a number of workers, where ``-1`` or ``None`` means all CPU cores """
+    if n_jobs is None or n_jobs < 0:
+        return os.cpu_count() or 1
+    return max(1, n_jobs)
 
 
 def catch_keyboard_interrupt(interrupt_func: Callable | None = None) -> Callable:
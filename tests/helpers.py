@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import soundfile
+from unittest import mock
+from gamut.cache import FeatureCache, SampleCache
+from gamut.store import AudioStore
+
+
+def write_tone(path: str, freq: float, duration: float = 1.0, sr: int = 22050, noise: float = 0.05, seed: int = 0) -> str:
+    """ writes a mono sine tone with some white noise to ``path``, returning the path """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sr)) / sr
+    y = 0.5 * np.sin(2 * np.pi * freq * t) + noise * rng.standard_normal(len(t))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    soundfile.write(path, y.astype('float32'), sr)
+    return path
+
+
+def write_sources(directory: str, freqs: list, **kwargs) -> list:
+    """ writes one tone per frequency in ``freqs`` to ``directory``, returning their paths """
+    return [write_tone(os.path.join(directory, f'tone{i}.wav'), freq, seed=i, **kwargs) for i, freq in enumerate(freqs)]
+
+
+def patch_gamut_dirs(directory: str) -> list:
+    """
+    starts patching the default directories of the feature cache, sample cache and audio store to subdirectories of ``directory``,
+    so that tests do not write to ``~/.gamut``. Returns the patchers, to be stopped by the caller
+    """
+    patchers = [
+        mock.patch.object(FeatureCache.__init__, '__defaults__', (os.path.join(directory, 'cache'), FeatureCache.__init__.__defaults__[1])),
+        mock.patch.object(SampleCache.__init__, '__defaults__', (os.path.join(directory, 'samples'), SampleCache.__init__.__defaults__[1])),
+        mock.patch.object(AudioStore.__init__, '__defaults__', (os.path.join(directory, 'objects'),)),
+    ]
+    for patcher in patchers:
+        patcher.start()
+    return patchers
+
+
+def isolate_gamut_dirs() -> None:
+    """ patches the default gamut directories to a temporary directory until the end of the calling test module (see ``patch_gamut_dirs``) """
+    temp = tempfile.TemporaryDirectory()
+    unittest.addModuleCleanup(temp.cleanup)
+    for patcher in patch_gamut_dirs(temp.name):
+        unittest.addModuleCleanup(patcher.stop)
+
+
+class TempDirTestCase(unittest.TestCase):
+    """ test case with a temporary directory, ``self.temp``, created before each test and removed after it """
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+
+
+class SharedTempDirTestCase(unittest.TestCase):
+    """ test case with a temporary directory, ``cls.temp``, shared by all of its tests """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(cls.temp.cleanup)
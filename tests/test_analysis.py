@@ -0,0 +1,152 @@
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import soundfile
+from librosa import load
+from os.path import join
+from gamut.sys import set_vebosity
+from gamut.analysis import AnalysisEngine, Framer, librosa_analysis, read_blocks
+from gamut.features import stream_and_analyze
+
+set_vebosity(False)
+
+
+def make_signal(duration: float, sr: int, freq: float, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sr)) / sr
+    return (0.5 * np.sin(2 * np.pi * freq * t) * np.exp(-t) + 0.05 * rng.standard_normal(len(t))).astype('float32')
+
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = AnalysisEngine()
+        self.signals = [
+            (make_signal(1.0, 22050, 440), 22050),
+            (make_signal(0.73, 44100, 261.6, seed=1), 44100),
+            (make_signal(2.1, 16000, 880, seed=2), 16000),
+        ]
+
+    def assert_close(self, analysis, expected):
+        # relative to the range of each feature, as in benchmarks.benchmark_analysis
+        scale = np.maximum(np.ptp(expected, axis=0), 1e-3)
+        np.testing.assert_array_less(np.abs(analysis - expected) / scale, 1e-3)
+
+    def test_matches_librosa(self):
+        for features in [['timbre'], ['pitch'], ['timbre', 'pitch']]:
+            for y, sr in self.signals:
+                analysis, markers = self.engine.analyze(y, features, sr=sr)
+                expected, expected_markers = librosa_analysis(y, features, sr=sr)
+                self.assertEqual(analysis.shape, expected.shape)
+                np.testing.assert_array_equal(markers, expected_markers)
+                self.assert_close(analysis, expected)
+
+    def test_matches_librosa_with_other_parameters(self):
+        engine = AnalysisEngine(n_mfcc=20, hop_length=256, win_length=2048, n_fft=2048)
+        y, sr = self.signals[0]
+        analysis, markers = engine.analyze(y, ['timbre', 'pitch'], sr=sr)
+        expected, expected_markers = librosa_analysis(y, ['timbre', 'pitch'], sr=sr, n_mfcc=20, hop_length=256, win_length=2048, n_fft=2048)
+        np.testing.assert_array_equal(markers, expected_markers)
+        self.assert_close(analysis, expected)
+
+    def test_batches(self):
+        expected = [self.engine.analyze(y, ['timbre', 'pitch'], sr=sr) for y, sr in self.signals]
+        # a memory budget of a few frames splits the signals into several batches
+        for engine in [self.engine, AnalysisEngine(memory_budget=2**16)]:
+            for (analysis, markers), (expected_analysis, expected_markers) in zip(engine.analyze_batch(self.signals, ['timbre', 'pitch']), expected):
+                np.testing.assert_allclose(analysis, expected_analysis, rtol=1e-5, atol=1e-5)
+                np.testing.assert_array_equal(markers, expected_markers)
+
+    def test_short_signal(self):
+        y, sr = make_signal(0.03, 22050, 440), 22050
+        analysis, markers = self.engine.analyze(y, ['timbre'], sr=sr)
+        expected = librosa_analysis(y, ['timbre'], sr=sr)[0]
+        self.assertEqual(analysis.shape, expected.shape)
+        self.assertEqual(len(markers), len(analysis))
+
+    def test_invalid_parameters(self):
+        y, sr = self.signals[0]
+        with self.assertRaises(ValueError):
+            AnalysisEngine(win_length=512, n_fft=1024).analyze(y, ['pitch'], sr=sr)
+        with self.assertRaises(ValueError):
+            self.engine.analyze(y, ['timbre'], sr=sr, segmentation='beat')
+
+
+def split(y: np.ndarray, block_size: int):
+    """ function returning a new iterator over blocks of ``y``, as expected by ``AnalysisEngine.analyze_blocks`` """
+    return lambda: (y[i:i + block_size] for i in range(0, len(y), block_size))
+
+
+class BlockStreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = AnalysisEngine()
+        self.y, self.sr = make_signal(3.0, 22050, 330), 22050
+
+    def test_framer(self):
+        frame_length, hop_length = 1024, 512
+        expected = np.lib.stride_tricks.sliding_window_view(np.pad(self.y, frame_length // 2), frame_length)[::hop_length]
+        for block_size in [100, 512, 1000, 4096, len(self.y)]:
+            framer = Framer(frame_length, hop_length)
+            frames = [framer.push(block) for block in split(self.y, block_size)()] + [framer.flush()]
+            np.testing.assert_array_equal(np.concatenate(frames), expected)
+
+    def test_matches_whole_signal(self):
+        for features in [['timbre'], ['timbre', 'pitch']]:
+            for segmentation in ['frame', 'onset']:
+                expected, expected_markers = self.engine.analyze(self.y, features, sr=self.sr, segmentation=segmentation)
+                for block_size in [300, 2048, 10000]:
+                    analysis, markers = self.engine.analyze_blocks(split(self.y, block_size), features, sr=self.sr, segmentation=segmentation)
+                    np.testing.assert_array_equal(markers, expected_markers)
+                    np.testing.assert_allclose(analysis, expected, rtol=1e-3, atol=1e-3)
+
+    def test_read_blocks(self):
+        with tempfile.TemporaryDirectory() as temp:
+            file = join(temp, 'stereo.wav')
+            soundfile.write(file, np.stack([self.y, -0.5 * self.y], axis=1), self.sr)
+            expected = load(file, sr=None, mono=True, duration=1.5)[0]
+            np.testing.assert_allclose(np.concatenate(list(read_blocks(file, 1000, max_duration=1.5))), expected, atol=1e-6)
+
+            # samples are not decoded whole while the file is analyzed, but once they are first read
+            with mock.patch('gamut.audio.load', side_effect=AssertionError('loaded the whole file')):
+                (y, sr), (analysis, markers) = stream_and_analyze(file, ['timbre'], 1000, None, self.engine)
+                self.assertEqual(len(y), len(self.y))
+            expected_y = load(file, sr=None, mono=True)[0]
+            np.testing.assert_allclose(y[:], expected_y, atol=1e-6)
+            expected_analysis = self.engine.analyze(expected_y, ['timbre'], sr=sr)[0]
+            np.testing.assert_allclose(analysis, expected_analysis, rtol=1e-3, atol=1e-3)
+
+
+class OnsetSegmentationTest(unittest.TestCase):
+
+    def setUp(self):
+        # decaying noise bursts every quarter of a second
+        sr = 22050
+        rng = np.random.default_rng(3)
+        t = np.arange(sr // 4) / sr
+        burst = np.exp(-30 * t)
+        self.y = np.concatenate([burst * rng.uniform(-0.5, 0.5, len(t)) for _ in range(8)]).astype('float32')
+        self.sr = sr
+        self.engine = AnalysisEngine()
+
+    def test_segments_average_frames(self):
+        frames, frame_markers = self.engine.analyze(self.y, ['timbre', 'pitch'], sr=self.sr)
+        segments, markers = self.engine.analyze(self.y, ['timbre', 'pitch'], sr=self.sr, segmentation='onset')
+        self.assertLess(len(segments), len(frames) // 4)
+        self.assertGreaterEqual(len(segments), 6)
+        starts = np.searchsorted(frame_markers, markers)
+        np.testing.assert_array_equal(frame_markers[starts], markers)
+        self.assertEqual(starts[0], 0)
+        for i, (start, end) in enumerate(zip(starts, np.append(starts[1:], len(frames)))):
+            np.testing.assert_allclose(segments[i], frames[start:end].mean(axis=0), rtol=1e-4, atol=1e-5)
+
+    def test_onsets_follow_bursts(self):
+        markers = self.engine.analyze(self.y, ['timbre'], sr=self.sr, segmentation='onset')[1]
+        # every burst starts a segment, within a couple of frames
+        for burst in range(1, 8):
+            self.assertLess(np.min(np.abs(markers - burst * self.sr // 4)), 3 * self.engine.hop_length)
+
+
+if __name__ == '__main__':
+    unittest.main()
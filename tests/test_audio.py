@@ -0,0 +1,125 @@
+import importlib.util
+import pickle
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import soundfile
+from librosa import load
+from os.path import join
+from gamut.sys import set_vebosity
+from gamut.cache import SampleCache
+from gamut.audio import AudioFile, EncodedAudio
+from helpers import TempDirTestCase, write_tone
+
+set_vebosity(False)
+
+
+class AudioFileTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.file = join(self.temp.name, 'stereo.wav')
+        rng = np.random.default_rng(0)
+        soundfile.write(self.file, rng.uniform(-0.5, 0.5, (30000, 2)).astype('float32'), 22050, subtype='FLOAT')
+        self.expected = load(self.file, sr=None, mono=True)[0]
+        # decoded samples go to a temporary sample cache
+        self.cache = SampleCache(directory=join(self.temp.name, 'samples'))
+        patcher = mock.patch('gamut.audio.SampleCache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_direct_reads(self):
+        y = AudioFile(self.file)
+        self.assertEqual(len(y), len(self.expected))
+        self.assertEqual(y.sr, 22050)
+        for key in [slice(None), slice(100, 2000), slice(-500, None), slice(20000, 10), slice(10, 3000, 7), slice(2999, 10, -3), 1234, -1]:
+            np.testing.assert_allclose(y[key], self.expected[key], atol=1e-6)
+        np.testing.assert_allclose(np.asarray(y), self.expected, atol=1e-6)
+        # nothing was decoded into the sample cache
+        self.assertIsNone(self.cache.get(self.cache.key(self.file, sr=None, max_duration=None)))
+
+    def test_max_duration(self):
+        y = AudioFile(self.file, max_duration=0.5)
+        self.assertEqual(len(y), 11025)
+        np.testing.assert_allclose(y[-10:], self.expected[11015:11025], atol=1e-6)
+
+    def test_resampled_reads(self):
+        expected = load(self.file, sr=16000, mono=True)[0]
+        y = AudioFile(self.file, sr=16000)
+        self.assertEqual(len(y), len(expected))
+        np.testing.assert_allclose(y[500:900], expected[500:900], atol=1e-6)
+        # the decoded samples are memory-mapped from the cache from then on
+        with mock.patch('gamut.audio.load', side_effect=AssertionError('decoded a cached file')):
+            np.testing.assert_allclose(AudioFile(self.file, sr=16000)[:], expected, atol=1e-6)
+
+    def test_pickle(self):
+        y = AudioFile(self.file).open()
+        copy = pickle.loads(pickle.dumps(y))
+        self.assertEqual((copy.file, copy.sr, copy.length), (y.file, y.sr, y.length))
+        np.testing.assert_array_equal(copy[:100], y[:100])
+
+
+class SampleCacheTest(unittest.TestCase):
+
+    def test_memory_mapped_entries(self):
+        with tempfile.TemporaryDirectory() as temp:
+            cache = SampleCache(directory=join(temp, 'samples'))
+            key = cache.key(write_tone(join(temp, 'tone.wav'), 440), sr=None)
+            self.assertIsNone(cache.get(key))
+            samples = np.arange(1000, dtype='float32')
+            cache.put(key, samples)
+            entry = cache.get(key)
+            self.assertIsInstance(entry, np.memmap)
+            self.assertFalse(entry.flags.writeable)
+            np.testing.assert_array_equal(entry, samples)
+            del entry
+
+
+class EncodedAudioTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.y = np.concatenate([rng.uniform(-0.9, 0.9, 10000), [1.5, -1.5]]).astype('float32')
+
+    def assert_round_trip(self, codec: str, atol: float):
+        # clipped samples are compared with their clipped values
+        expected = np.clip(self.y, -1.0, 1.0)
+        encoded = EncodedAudio.encode(self.y, codec, block_size=1024, sr=22050)
+        self.assertEqual((len(encoded), encoded.shape, encoded.dtype), (len(self.y), self.y.shape, np.float32))
+        np.testing.assert_allclose(np.asarray(encoded), expected, atol=atol)
+        for key in [slice(1000, 1024), slice(1020, 3100), slice(-5, None), slice(3000, 100, -7), slice(50, 10), 2047, -1]:
+            np.testing.assert_allclose(encoded[key], expected[key], atol=atol)
+        # serialized states restore the same samples
+        np.testing.assert_array_equal(np.asarray(EncodedAudio(**encoded.serialize())), np.asarray(encoded))
+        return encoded
+
+    def test_pcm(self):
+        self.assertEqual(self.assert_round_trip('pcm16', 2**-15).nbytes, 2 * len(self.y))
+        self.assertEqual(self.assert_round_trip('pcm24', 2**-23).nbytes, 3 * len(self.y))
+
+    def test_flac(self):
+        self.assert_round_trip('flac', 2**-23)
+
+    def test_zlib(self):
+        self.y = self.y.clip(-1.0, 1.0)
+        encoded = self.assert_round_trip('zlib', 0)
+        self.assertEqual(len(encoded.offsets), -(-len(self.y) // 1024) + 1)
+
+    @unittest.skipUnless(importlib.util.find_spec('zstandard'), 'zstandard is not installed')
+    def test_zstd(self):
+        self.y = self.y.clip(-1.0, 1.0)
+        self.assert_round_trip('zstd', 0)
+
+    def test_empty(self):
+        for codec in ['pcm16', 'pcm24', 'zlib']:
+            encoded = EncodedAudio.encode(np.empty(0, dtype='float32'), codec)
+            self.assertEqual(len(encoded[:]), 0)
+
+    def test_invalid_codec(self):
+        with self.assertRaises(ValueError):
+            EncodedAudio.encode(self.y, 'mp3')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from os.path import join
+from gamut.sys import set_vebosity
+from gamut.features import Corpus, Mosaic
+from gamut.benchmarks import benchmark_indices, benchmark_memory
+from helpers import SharedTempDirTestCase, write_sources, write_tone
+
+set_vebosity(False)
+
+
+class BenchmarkTest(SharedTempDirTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        write_sources(join(cls.temp.name, 'sources'), [220, 330, 440, 660])
+        cls.corpus = Corpus(join(cls.temp.name, 'sources'), index='brute', cache=False)
+        cls.target = write_tone(join(cls.temp.name, 'target.wav'), 275, seed=5)
+
+    def test_benchmark_indices(self):
+        results = benchmark_indices(self.corpus, indices=['kdtree', 'balltree', 'brute'], k=5, num_queries=50,
+                                    verbose=False, search='exact')
+        self.assertEqual(list(results), ['kdtree', 'balltree', 'brute'])
+        for result in results.values():
+            self.assertAlmostEqual(result['recall'], 1.0)
+            self.assertGreater(result['queries per second'], 0)
+            self.assertGreater(result['bytes per grain'], 0)
+
+    def test_invalid_index(self):
+        with self.assertRaises(ValueError):
+            benchmark_indices(self.corpus, indices=['lsh'], verbose=False)
+
+    def test_benchmark_memory(self):
+        mosaic = Mosaic(self.target, self.corpus, cache=False)
+        results = benchmark_memory(mosaic, dtypes=['float32', 'float64'], verbose=False, grain_dur=0.2)
+        self.assertEqual(list(results), ['float32', 'float64'])
+        self.assertEqual(results['float32']['output memory'] * 2, results['float64']['output memory'])
+        self.assertLess(results['float32']['max difference'], 1e-4)
+        self.assertEqual(results['float64']['max difference'], 0.0)
+        self.assertIsNone(benchmark_memory(mosaic, dtypes=['float32'], verbose=False)['float32']['max difference'])
+        with self.assertRaises(ValueError):
+            benchmark_memory(mosaic, dtypes=['float16'], verbose=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
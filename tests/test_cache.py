@@ -0,0 +1,116 @@
+import os
+import unittest
+from unittest import mock
+import librosa
+import numpy as np
+from os.path import join
+from gamut.sys import set_vebosity
+from gamut.cache import FeatureCache
+from gamut.analysis import AnalysisEngine
+from gamut.features import load_and_analyze
+from helpers import TempDirTestCase, write_tone
+
+set_vebosity(False)
+
+
+class FeatureCacheTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = FeatureCache(directory=join(self.temp.name, 'cache'))
+        self.file = write_tone(join(self.temp.name, 'tone.wav'), 440)
+
+    def test_round_trip(self):
+        key = self.cache.key(self.file, features=['timbre'])
+        self.assertIsNone(self.cache.get(key))
+        analysis = np.random.default_rng().standard_normal((20, 13)).astype('float32')
+        self.cache.put(key, analysis=analysis, markers=np.arange(20))
+        entry = self.cache.get(key)
+        np.testing.assert_array_equal(entry['analysis'], analysis)
+        np.testing.assert_array_equal(entry['markers'], np.arange(20))
+
+    def test_key_invalidation(self):
+        key = self.cache.key(self.file, features=['timbre'], hop_length=512)
+        self.assertEqual(self.cache.key(self.file, hop_length=512, features=['timbre']), key)
+        self.assertNotEqual(self.cache.key(self.file, features=['timbre'], hop_length=256), key)
+        self.assertNotEqual(self.cache.key(self.file, features=['pitch'], hop_length=512), key)
+        # editing the file changes its identity
+        write_tone(self.file, 220, duration=1.5)
+        self.assertNotEqual(self.cache.key(self.file, features=['timbre'], hop_length=512), key)
+
+    def test_corrupted_entry(self):
+        key = self.cache.key(self.file)
+        os.makedirs(self.cache.directory)
+        with open(self.cache._path(key), 'wb') as f:
+            f.write(b'not an npz file')
+        self.assertIsNone(self.cache.get(key))
+
+    def test_evict_least_recently_used(self):
+        keys = [self.cache.key(self.file, n=i) for i in range(4)]
+        for i, key in enumerate(keys):
+            self.cache.put(key, analysis=np.zeros(10000))
+            os.utime(self.cache._path(key), (i, i))
+        self.cache.get(keys[0])
+        self.cache.max_size = 2.5 * os.path.getsize(self.cache._path(keys[0]))
+        self.cache.evict()
+        self.assertEqual([self.cache.get(key) is not None for key in keys], [True, False, False, True])
+
+    def test_clear(self):
+        key = self.cache.key(self.file)
+        self.cache.put(key, analysis=np.zeros(10))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(key))
+        self.assertEqual(os.listdir(self.cache.directory), [])
+
+
+class CachedAnalysisTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = FeatureCache(directory=join(self.temp.name, 'cache'))
+        self.files = [write_tone(join(self.temp.name, f'tone{i}.wav'), 220 * (i + 1), seed=i) for i in range(3)]
+
+    def test_hits_skip_analysis(self):
+        first = load_and_analyze(self.files, ['timbre', 'pitch'], cache=self.cache)
+        with mock.patch.object(AnalysisEngine, 'analyze_batch', return_value=[]) as analyze_batch:
+            second = load_and_analyze(self.files, ['timbre', 'pitch'], cache=self.cache)
+        analyze_batch.assert_called_once_with([], ['timbre', 'pitch'], segmentation='frame')
+        for (y, sr, analysis, markers), (cached_y, cached_sr, cached_analysis, cached_markers) in zip(first, second):
+            self.assertEqual(sr, cached_sr)
+            np.testing.assert_array_equal(y, cached_y)
+            np.testing.assert_array_equal(analysis, cached_analysis)
+            np.testing.assert_array_equal(markers, cached_markers)
+
+    def test_lazy_hits_skip_decoding(self):
+        load_and_analyze(self.files, ['timbre'], cache=self.cache)
+        with mock.patch('gamut.features.load', side_effect=AssertionError('decoded a cached file')):
+            results = load_and_analyze(self.files, ['timbre'], cache=self.cache, lazy=True)
+        self.assertEqual([len(y) for y, *_ in results], [22050] * 3)
+
+    def test_hits_defer_decoding(self):
+        first = load_and_analyze(self.files, ['timbre'], cache=self.cache)
+        with mock.patch('gamut.features.load', side_effect=AssertionError('decoded a cached file')), \
+                mock.patch('gamut.audio.load', side_effect=AssertionError('decoded a cached file')):
+            results = load_and_analyze(self.files, ['timbre'], cache=self.cache)
+            self.assertEqual([(len(y), sr) for y, sr, *_ in results], [(22050, 22050)] * 3)
+        # samples are loaded in memory once first read
+        with mock.patch('gamut.audio.load', wraps=librosa.load) as load:
+            for (y, *_), (expected, *_) in zip(results, first):
+                np.testing.assert_array_equal(y[100:200], expected[100:200])
+                np.testing.assert_array_equal(y[:], expected)
+        self.assertEqual(load.call_count, 3)
+
+    def test_misses(self):
+        load_and_analyze(self.files[:1], ['timbre'], cache=self.cache)
+        write_tone(self.files[0], 880)
+        analysis = load_and_analyze(self.files[:1], ['timbre'], cache=self.cache)[0][2]
+        expected = load_and_analyze(self.files[:1], ['timbre'])[0][2]
+        np.testing.assert_array_equal(analysis, expected)
+        # other parameters and segmentations have their own entries
+        load_and_analyze(self.files[:1], ['timbre'], cache=self.cache, hop_length=256)
+        load_and_analyze(self.files[:1], ['timbre'], cache=self.cache, segmentation='onset')
+        self.assertEqual(len(os.listdir(self.cache.directory)), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
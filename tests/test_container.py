@@ -0,0 +1,117 @@
+import struct
+import unittest
+from unittest import mock
+import numpy as np
+from os.path import join
+from gamut.config import FILE_ALIGNMENT, FILE_MAGIC, FILE_VERSION
+from gamut.container import write_container, read_container, read_header
+from helpers import TempDirTestCase
+
+
+class BlockArray:
+    """ array-like read in slices, as ``gamut.audio.AudioFile`` """
+
+    def __init__(self, array: np.ndarray) -> None:
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.reads = 0
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return self.array[key]
+
+    def __array__(self, dtype=None):
+        return self.array
+
+
+class ContainerTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.file = join(self.temp.name, 'object.gamut')
+        rng = np.random.default_rng(0)
+        self.obj = {
+            'type': 'Corpus',
+            'features': rng.standard_normal((100, 7)).astype('float32'),
+            'markers': np.arange(100, dtype='int64') * 512,
+            'records': np.zeros(3, dtype=[('source', 'int32'), ('marker', 'int64'), ('features', 'float32', (2,))]),
+            'soundfiles': {-1: {'file': 'target.wav', 'sr': 22050}, 0: {'file': 'source.wav', 'sr': 44100}},
+            'window': (512, 1024.0, None, True),
+            'nested': [{'y': np.ones(5, dtype='float64')}, 'text'],
+            'objects': np.array([{'a': 1}, None], dtype=object),
+            'scalar': np.float32(0.5),
+        }
+
+    def assert_equal_objects(self, found: object, expected: object):
+        if isinstance(expected, np.ndarray):
+            self.assertEqual(found.dtype, expected.dtype)
+            np.testing.assert_array_equal(found, expected)
+        elif isinstance(expected, dict):
+            self.assertEqual(list(found), list(expected))
+            for key in expected:
+                self.assert_equal_objects(found[key], expected[key])
+        elif isinstance(expected, (list, tuple)):
+            self.assertIs(type(found), type(expected))
+            self.assertEqual(len(found), len(expected))
+            for f, e in zip(found, expected):
+                self.assert_equal_objects(f, e)
+        else:
+            self.assertEqual(found, expected)
+
+    def test_round_trip(self):
+        write_container(self.file, self.obj, metadata={'type': 'Corpus', 'size': 100})
+        for mmap in [True, False]:
+            self.assert_equal_objects(read_container(self.file, mmap=mmap), self.obj)
+
+    def test_header(self):
+        write_container(self.file, self.obj, metadata={'type': 'Corpus', 'size': 100})
+        version, header, start = read_header(self.file)
+        self.assertEqual(version, FILE_VERSION)
+        self.assertEqual(header['metadata'], {'type': 'Corpus', 'size': 100})
+        self.assertEqual(start % FILE_ALIGNMENT, 0)
+        for entry in header['arrays']:
+            self.assertEqual(entry['offset'] % FILE_ALIGNMENT, 0)
+
+    def test_memory_mapped_arrays(self):
+        write_container(self.file, self.obj)
+        features = read_container(self.file)['features']
+        base = features
+        while not isinstance(base, np.memmap) and base is not None:
+            base = base.base
+        self.assertIsInstance(base, np.memmap)
+        self.assertEqual((features.ctypes.data - base.ctypes.data) % FILE_ALIGNMENT, 0)
+        self.assertFalse(isinstance(read_container(self.file, mmap=False)['features'].base, np.memmap))
+        # arrays are copy-on-write, so that changes are not written to the file
+        features[:] = 0
+        np.testing.assert_array_equal(read_container(self.file)['features'], self.obj['features'])
+        # files can be overwritten while they are memory-mapped
+        write_container(self.file, {'features': np.ones(3)})
+        np.testing.assert_array_equal(read_container(self.file)['features'], np.ones(3))
+
+    def test_array_likes_in_blocks(self):
+        array = BlockArray(np.arange(10000, dtype='float32'))
+        with mock.patch('gamut.container.FILE_BLOCK_SIZE', 4096):
+            write_container(self.file, {'y': array})
+        self.assertEqual(array.reads, 10)
+        np.testing.assert_array_equal(read_container(self.file)['y'], array.array)
+
+    def test_version_1(self):
+        np.save(self.file, self.obj, allow_pickle=True)
+        file = self.file + '.npy'
+        self.assertEqual(read_header(file), (1, None, None))
+        self.assert_equal_objects(read_container(file), self.obj)
+
+    def test_invalid_files(self):
+        with open(self.file, 'wb') as f:
+            f.write(b'not a gamut file')
+        with self.assertRaises(ValueError):
+            read_header(self.file)
+        with open(self.file, 'wb') as f:
+            f.write(FILE_MAGIC + struct.pack('<HQ', FILE_VERSION + 1, 2) + b'{}')
+        with self.assertRaises(ValueError):
+            read_container(self.file)
+
+
+if __name__ == '__main__':
+    unittest.main()
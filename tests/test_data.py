@@ -0,0 +1,584 @@
+import os
+import unittest
+from unittest import mock
+import numpy as np
+from gamut.sys import set_vebosity
+from gamut.config import BRUTE_FORCE_MAX_SIZE, BRUTE_FORCE_CELL_SIZE
+from gamut.data import BLOCK_COLUMNS, BLOCK_SIZE, exhaustive_knn, row_chunks, GrainTable, NeighborIndex, KDTree, BallTree, BruteForce, IVFPQ, INDICES, load_index, select_index, merge_indices, search_merged, evaluate_index
+from helpers import TempDirTestCase
+
+set_vebosity(False)
+
+
+def make_grains(n: int = 2000, k: int = 6, seed: int = 0) -> tuple:
+    """ random features with distinct (source, marker) pairs """
+    rng = np.random.default_rng(seed)
+    features = rng.standard_normal((n, k)).astype('float32')
+    sources = np.arange(n) % 7
+    markers = np.arange(n) * 512
+    return features, sources, markers
+
+
+def exact_knn(index, X: np.ndarray, k: int) -> np.ndarray:
+    """ distances to the exact ``k`` nearest neighbors in the normalized space of ``index``, computed in float64 """
+    X = index._normalize_input(X).astype('float64')
+    delta = index.features.astype('float64')[np.newaxis, :, :] - X[:, np.newaxis, :]
+    return np.sort(np.sqrt(np.sum(delta**2, axis=2)), axis=1)[:, :k]
+
+
+class GrainTableTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.features, self.sources, self.markers = make_grains(100)
+
+    def test_from_analyses(self):
+        analyses = [(3, self.features[:40], self.markers[:40]), (5, np.empty((0, 6)), np.empty(0)), (8, self.features[40:], self.markers[40:])]
+        table = GrainTable.from_analyses(analyses)
+        self.assertEqual(len(table), 100)
+        self.assertEqual((table.features.dtype, table.sources.dtype, table.markers.dtype), (np.float32, np.int32, np.int64))
+        np.testing.assert_array_equal(table.features, self.features)
+        np.testing.assert_array_equal(table.sources, [3] * 40 + [8] * 60)
+        np.testing.assert_array_equal(table.markers, self.markers)
+        self.assertEqual(len(GrainTable.from_analyses([(0, np.empty((0, 6)), np.empty(0))])), 0)
+
+    def test_from_analyses_to_file(self):
+        analyses = [(3, self.features[:40], self.markers[:40]), (8, self.features[40:], self.markers[40:])]
+        table = GrainTable.from_analyses(analyses, path=os.path.join(self.temp.name, 'features.npy'))
+        self.assertIsInstance(table.features.base, np.memmap)
+        np.testing.assert_array_equal(table.features, self.features)
+        np.testing.assert_array_equal(table.sources, [3] * 40 + [8] * 60)
+
+    def test_from_records(self):
+        records = [{'source': s, 'marker': m, 'data': {'features': f}} for f, s, m in zip(self.features, self.sources, self.markers)]
+        table = GrainTable.from_records(records, vector_path='data.features')
+        np.testing.assert_array_equal(table.features, self.features)
+        np.testing.assert_array_equal(table.sources, self.sources)
+        np.testing.assert_array_equal(table.markers, self.markers)
+
+    def test_columns(self):
+        table = GrainTable(self.features, self.sources, self.markers)
+        self.assertEqual(table.nbytes, 100 * (6 * 4 + 4 + 8))
+        tree = KDTree(leaf_size=10)
+        tree.fit(table.features, **table.columns)
+        self.assertEqual(sorted(zip(tree.sources, tree.markers)), sorted(zip(self.sources, self.markers)))
+        self.assertEqual(len(GrainTable()), 0)
+
+
+class KDTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.features, self.sources, self.markers = make_grains()
+        self.tree = KDTree(leaf_size=10)
+        self.tree.fit(self.features, sources=self.sources, markers=self.markers)
+
+    def test_leaves_partition_data(self):
+        leaves = np.flatnonzero(self.tree.children[:, 0] < 0)
+        sizes = self.tree.bounds[leaves, 1] - self.tree.bounds[leaves, 0]
+        self.assertTrue(np.all(sizes <= 10))
+        ranges = np.sort(self.tree.bounds[leaves], axis=0)
+        self.assertEqual(ranges[0, 0], 0)
+        self.assertEqual(ranges[-1, 1], len(self.features))
+        np.testing.assert_array_equal(ranges[1:, 0], ranges[:-1, 1])
+
+    def test_boxes_hold_their_items(self):
+        for node in range(len(self.tree.children)):
+            start, end = self.tree.bounds[node]
+            items = self.tree.features[start:end]
+            self.assertTrue(np.all(items >= self.tree.box_min[node]))
+            self.assertTrue(np.all(items <= self.tree.box_max[node]))
+
+    def test_columns_follow_feature_rows(self):
+        # rows are reordered by leaf, so each feature row must keep its own source and marker
+        original = {(s, m): f for f, s, m in zip(self.features, self.sources, self.markers)}
+        restored = self.tree._denormalize(self.tree.features)
+        for row in range(0, len(self.tree), 97):
+            key = (self.tree.sources[row], self.tree.markers[row])
+            np.testing.assert_allclose(restored[row], original[key], rtol=1e-5, atol=1e-5)
+
+    def test_build_from_records(self):
+        records = [{'features': f, 'source': s, 'marker': m} for f, s, m in zip(self.features, self.sources, self.markers)]
+        tree = KDTree(leaf_size=10)
+        tree.build(records)
+        self.assertEqual(len(tree), len(records))
+        self.assertEqual(sorted(zip(tree.sources, tree.markers)), sorted(zip(self.sources, self.markers)))
+
+    def test_serialize_round_trip(self):
+        loaded = load_index('kdtree', self.tree.serialize())
+        queries = self.features[:50]
+        for search in ['exact', 'approx']:
+            expected = self.tree.knn_batch(queries, 5, search=search)
+            found = loaded.knn_batch(queries, 5, search=search)
+            np.testing.assert_array_equal(found[0], expected[0])
+            np.testing.assert_array_equal(found[1], expected[1])
+
+    def test_nearest_item_is_itself(self):
+        result = self.tree.knn(self.features[10], first_n=1)[0]
+        self.assertEqual((result['value']['source'], result['value']['marker']), (self.sources[10], self.markers[10]))
+        self.assertAlmostEqual(float(result['cost']), 0.0, places=5)
+
+    def test_knn_positional_arguments(self):
+        # the former knn(x, vector_path, first_n) signature still works, with a deprecation warning
+        with self.assertWarns(DeprecationWarning):
+            results = self.tree.knn(self.features[10], 'features', 3)
+        self.assertEqual([r['cost'] for r in results], [r['cost'] for r in self.tree.knn(self.features[10], first_n=3)])
+
+
+class SearchModeTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        # clustered data, with duplicate grains
+        centers = rng.standard_normal((20, 8)) * 4
+        features = (centers[rng.integers(0, 20, 6000)] + rng.standard_normal((6000, 8))).astype('float32')
+        features[::10] = features[1]
+        self.features = features
+        self.queries = (centers[rng.integers(0, 20, 200)] + rng.standard_normal((200, 8))).astype('float32')
+        self.tree = KDTree(leaf_size=15)
+        self.tree.fit(features, sources=np.arange(len(features)) % 3, markers=np.arange(len(features)))
+        self.expected = exact_knn(self.tree, self.queries, 10)
+
+    def assert_exact(self, distances):
+        np.testing.assert_allclose(distances, self.expected, rtol=1e-4, atol=1e-4)
+
+    def test_exact(self):
+        self.assert_exact(self.tree.knn_batch(self.queries, 10, search='exact')[1])
+
+    def test_exact_tree_descent(self):
+        # small seeds and no exhaustive fallback, so that the tree is searched leaf by leaf
+        self.tree.EXACT_SEED_SIZE = 16
+        self.tree.EXHAUSTIVE_RATIO = np.inf
+        self.assert_exact(self.tree.knn_batch(self.queries, 10, search='exact')[1])
+
+    def test_exact_exhaustive_fallback(self):
+        self.tree.EXHAUSTIVE_RATIO = 0
+        self.assert_exact(self.tree.knn_batch(self.queries, 10, search='exact')[1])
+
+    def test_unbounded_approx_is_exact(self):
+        self.assert_exact(self.tree.knn_batch(self.queries, 10, search='approx', max_leaves=np.inf)[1])
+        self.assert_exact(self.tree.knn_batch(self.queries, 10, search='approx', max_checks=len(self.tree))[1])
+
+    def test_approx_returns_sorted_candidates(self):
+        indices, distances = self.tree.knn_batch(self.queries, 10, search='approx', max_leaves=4, max_checks=100)
+        self.assertEqual(indices.shape, (len(self.queries), 10))
+        self.assertTrue(np.all(np.diff(distances, axis=1) >= 0))
+        self.assertTrue(np.all(distances >= self.expected - 1e-4))
+        # every returned index is distinct within its row
+        self.assertTrue(all(len(set(row)) == 10 for row in indices))
+
+    def test_more_leaves_are_closer(self):
+        one = self.tree.knn_batch(self.queries, 10, max_leaves=1)[1]
+        many = self.tree.knn_batch(self.queries, 10, max_leaves=32)[1]
+        self.assertLessEqual(np.mean(many), np.mean(one))
+        np.testing.assert_array_equal(self.tree.knn_batch(self.queries, 10)[1], one)
+
+    def test_max_checks_alone(self):
+        one = self.tree.knn_batch(self.queries, 10)[1]
+        checked = self.tree.knn_batch(self.queries, 10, max_checks=300)[1]
+        self.assertLess(np.mean(checked), np.mean(one))
+        # with both budgets, the search stops at whichever is reached first
+        np.testing.assert_array_equal(self.tree.knn_batch(self.queries, 10, max_leaves=1, max_checks=300)[1], one)
+        with mock.patch.object(KDTree, '_search', autospec=True, side_effect=KDTree._search) as search:
+            self.tree.knn_batch(self.queries, 10, max_checks=300)
+        for call in search.call_args_list:
+            self.assertEqual(call.args[3:5], (None, 300))
+
+    def test_k_is_capped(self):
+        tree = KDTree(leaf_size=4)
+        tree.fit(self.features[:7], sources=np.zeros(7), markers=np.arange(7))
+        indices = tree.knn_batch(self.queries[:3], 10, search='exact')[0]
+        self.assertEqual(indices.shape, (3, 7))
+
+    def test_invalid_search_mode(self):
+        with self.assertRaises(ValueError):
+            self.tree.knn_batch(self.queries, 10, search='fast')
+
+
+class BatchQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.features, self.sources, self.markers = make_grains(3000)
+        self.tree = KDTree(leaf_size=10)
+        self.tree.fit(self.features, sources=self.sources, markers=self.markers)
+        self.queries = make_grains(100, seed=2)[0]
+
+    def test_batch_matches_single_queries(self):
+        for search in ['exact', 'approx']:
+            indices, distances = self.tree.knn_batch(self.queries, 5, search=search)
+            for i, query in enumerate(self.queries):
+                results = self.tree.knn(query, first_n=5, search=search)
+                self.assertEqual([r['value']['source'] for r in results], list(self.tree.sources[indices[i]]))
+                self.assertEqual([r['value']['marker'] for r in results], list(self.tree.markers[indices[i]]))
+                np.testing.assert_allclose([r['cost'] for r in results], distances[i], rtol=1e-4, atol=1e-5)
+
+    def test_single_vector_input(self):
+        indices, distances = self.tree.knn_batch(self.queries[0], 3)
+        self.assertEqual(indices.shape, (1, 3))
+        self.assertEqual(distances.shape, (1, 3))
+
+
+class BruteForceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.features, self.sources, self.markers = make_grains(3000, k=13)
+        # duplicate grains, which tie with each other
+        self.features[::5] = self.features[3]
+        self.queries = make_grains(300, k=13, seed=3)[0]
+        self.index = BruteForce()
+        self.index.fit(self.features, sources=self.sources, markers=self.markers)
+        self.expected = exact_knn(self.index, self.queries, 10)
+
+    def test_exact(self):
+        indices, distances = self.index.knn_batch(self.queries, 10)
+        np.testing.assert_allclose(distances, self.expected, rtol=1e-4, atol=1e-4)
+        self.assertTrue(all(len(set(row)) == 10 for row in indices))
+
+    @mock.patch('gamut.data.BLOCK_COLUMNS', 64)
+    def test_exact_across_blocks(self):
+        # small blocks and little memory to spare, so that candidates are thresholded and reduced many times
+        for memory_budget in [1, 20 * 64 * 16]:
+            index = BruteForce(memory_budget=memory_budget)
+            index.fit(self.features, sources=self.sources, markers=self.markers)
+            indices, distances = index.knn_batch(self.queries, 10)
+            np.testing.assert_allclose(distances, self.expected, rtol=1e-4, atol=1e-4)
+            self.assertTrue(all(len(set(row)) == 10 for row in indices))
+
+    def test_blocks_fit_memory_budget(self):
+        shapes = []
+
+        class Recorder(np.ndarray):
+            def __matmul__(self, other):
+                shapes.append((len(self), other.shape[1]))
+                return np.asarray(self) @ other
+
+        for memory_budget, max_size in [(2**16, 2**16 // 20), (2**30, BLOCK_SIZE)]:
+            shapes.clear()
+            index = BruteForce(memory_budget=memory_budget)
+            index.fit(self.features, sources=self.sources, markers=self.markers)
+            costs, indices = exhaustive_knn(index._normalize_input(self.queries).view(Recorder), index.features, index.sq_norms, 10, memory_budget)
+            np.testing.assert_allclose(np.sqrt(costs), self.expected, rtol=1e-4, atol=1e-4)
+            rows, columns = np.max(shapes, axis=0)
+            self.assertLessEqual(rows * columns, max_size)
+            self.assertLessEqual(columns, BLOCK_COLUMNS)
+            self.assertGreater(rows * columns, max_size // 4)
+
+    def test_matches_exact_tree_search(self):
+        tree = KDTree(leaf_size=10)
+        tree.fit(self.features, sources=self.sources, markers=self.markers)
+        np.testing.assert_allclose(self.index.knn_batch(self.queries, 10)[1], tree.knn_batch(self.queries, 10, search='exact')[1],
+                                   rtol=1e-4, atol=1e-4)
+
+    def test_ignores_tree_options(self):
+        expected = self.index.knn_batch(self.queries, 5)
+        found = self.index.knn_batch(self.queries, 5, search='approx', max_leaves=1)
+        np.testing.assert_array_equal(found[0], expected[0])
+
+    def test_select_index(self):
+        # few features only get a k-d tree for large corpora, and many features never do below the size cap
+        self.assertEqual(select_index(16 * BRUTE_FORCE_CELL_SIZE, 4), 'brute')
+        self.assertEqual(select_index(16 * BRUTE_FORCE_CELL_SIZE + 1, 4), 'kdtree')
+        self.assertEqual(select_index(100000, 8), 'brute')
+        self.assertEqual(select_index(BRUTE_FORCE_MAX_SIZE, 13), 'brute')
+        self.assertEqual(select_index(BRUTE_FORCE_MAX_SIZE + 1, 13), 'kdtree')
+
+
+class MergedIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.indices = []
+        for i, (n, offset) in enumerate([(1500, 0), (800, 0.5), (400, 6)]):
+            features = make_grains(n, seed=10 + i)[0] + offset
+            # shared extremes, so that every index has the same normalization as the merged one
+            features[:2] = [[-10] * 6, [10] * 6]
+            index = BruteForce()
+            index.fit(features, sources=np.arange(n) % 5, markers=np.arange(n) * 512)
+            self.indices.append(index)
+        self.queries = make_grains(50, seed=20)[0]
+
+    def test_global_ranking(self):
+        merged = merge_indices(self.indices)
+        with mock.patch.object(BruteForce, 'knn_batch', autospec=True, side_effect=BruteForce.knn_batch) as search:
+            corpora, sources, markers, distances = search_merged(merged, self.queries, 15)
+        # a single search of the merged index, ranked as an exhaustive search of all grains
+        search.assert_called_once()
+        self.assertIs(search.call_args.args[0], merged)
+        self.assertEqual(corpora.shape, (len(self.queries), 15))
+        self.assertTrue(np.all(np.diff(distances, axis=1) >= 0))
+        reference = BruteForce()
+        reference.fit(np.concatenate([index._denormalize(index.features) for index in self.indices]),
+                      sources=np.concatenate([index.sources for index in self.indices]),
+                      markers=np.concatenate([index.markers for index in self.indices]))
+        np.testing.assert_allclose(distances, reference.knn_batch(self.queries, 15)[1], rtol=1e-4, atol=1e-4)
+        expected = np.concatenate([np.full(len(index), i) for i, index in enumerate(self.indices)])[reference.knn_batch(self.queries, 15)[0]]
+        self.assertGreater(np.mean(corpora == expected), 0.99)
+        # the far away index gets no neighbors
+        self.assertFalse(np.any(corpora == 2))
+
+    def test_k_is_capped(self):
+        merged = merge_indices(self.indices[1:])
+        self.assertEqual(search_merged(merged, self.queries, 10000)[0].shape, (len(self.queries), len(merged)))
+
+    def test_merged_type(self):
+        trees = []
+        for index in self.indices[:2]:
+            tree = KDTree()
+            tree.fit(index._denormalize(index.features), sources=index.sources, markers=index.markers)
+            trees.append(tree)
+        merged = merge_indices(trees, leaf_size=20)
+        self.assertIsInstance(merged, KDTree)
+        self.assertEqual(merged.leaf_size, 20)
+        self.assertEqual(len(merged), sum(len(tree) for tree in trees))
+        self.assertIsInstance(merge_indices(self.indices), BruteForce)
+        self.assertIsInstance(merge_indices([trees[0], self.indices[1]]), INDICES[select_index(len(trees[0]) + len(self.indices[1]), trees[0].k)])
+
+    def test_cache(self):
+        merged = merge_indices(self.indices)
+        self.assertIs(merge_indices(self.indices), merged)
+        self.assertIsNot(merge_indices(self.indices, leaf_size=5), merged)
+        self.indices[1].insert(make_grains(10, seed=30)[0], sources=np.zeros(10, dtype='int64'), markers=np.arange(10))
+        updated = merge_indices(self.indices)
+        self.assertIsNot(updated, merged)
+        self.assertEqual(len(updated), len(merged) + 10)
+
+    def test_unmergeable(self):
+        projected = BallTree(projection='pca')
+        projected.fit(make_grains(100)[0], sources=np.zeros(100), markers=np.arange(100))
+        with self.assertRaises(ValueError):
+            merge_indices([self.indices[0], projected])
+        narrow = BruteForce()
+        narrow.fit(make_grains(100, k=3)[0], sources=np.zeros(100), markers=np.arange(100))
+        with self.assertRaises(ValueError):
+            merge_indices([self.indices[0], narrow])
+
+
+class TreeBuildTest(unittest.TestCase):
+
+    def assert_valid_tree(self, tree: KDTree):
+        self.assertEqual(tree.bounds[0, 0], 0)
+        self.assertEqual(tree.bounds[0, 1], len(tree))
+        for node in np.flatnonzero(tree.split_dim >= 0):
+            left, right = tree.children[node]
+            dim, value = tree.split_dim[node], tree.split_value[node]
+            self.assertEqual(tree.bounds[left, 0], tree.bounds[node, 0])
+            self.assertEqual(tree.bounds[left, 1], tree.bounds[right, 0])
+            self.assertEqual(tree.bounds[right, 1], tree.bounds[node, 1])
+            self.assertTrue(np.all(tree.features[slice(*tree.bounds[left]), dim] <= value))
+            self.assertTrue(np.all(tree.features[slice(*tree.bounds[right]), dim] >= value))
+
+    def test_median_splits(self):
+        features, sources, markers = make_grains(5000)
+        # repeated values along some dimensions
+        features[:, 0] = np.round(features[:, 0])
+        tree = KDTree(leaf_size=8)
+        tree.fit(features, sources=sources, markers=markers)
+        self.assert_valid_tree(tree)
+        # median splits halve every node, so the tree is as shallow as it can be
+        depth = np.zeros(len(tree.children), dtype='int64')
+        for node in np.flatnonzero(tree.split_dim >= 0):
+            depth[tree.children[node]] = depth[node] + 1
+        self.assertLessEqual(depth.max(), int(np.ceil(np.log2(len(tree) / 8))) + 1)
+
+    def test_partial_rebuilds(self):
+        features, sources, markers = make_grains(5000)
+        tree = KDTree(leaf_size=8, rebuild_ratio=10)
+        tree.fit(features, sources=sources, markers=markers)
+        new_features = make_grains(300, seed=4)[0] * 0.2 + 1
+        tree.insert(new_features, sources=np.full(300, 7), markers=np.arange(300))
+        tree.remove(tree.sources == 3)
+        # subtrees were rebuilt in place, without a full rebuild
+        self.assertEqual(tree.built_size, 5000)
+        self.assert_valid_tree(tree)
+        self.assertEqual(len(tree), 5300 - np.sum(sources == 3))
+        queries = make_grains(50, seed=5)[0]
+        np.testing.assert_allclose(tree.knn_batch(queries, 5, search='exact')[1], exact_knn(tree, queries, 5), rtol=1e-4, atol=1e-4)
+
+
+class ProjectionTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(6)
+        # 12 features spanning 3 dimensions, plus a little noise
+        self.features = (rng.standard_normal((3000, 3)) @ rng.standard_normal((3, 12)) + 0.01 * rng.standard_normal((3000, 12))).astype('float32')
+        self.sources = np.zeros(3000, dtype='int64')
+        self.markers = np.arange(3000)
+
+    def test_pca_components(self):
+        index = KDTree(projection='pca', n_components=0.99)
+        index.fit(self.features, sources=self.sources, markers=self.markers)
+        self.assertEqual(index.components.shape, (12, 3))
+        self.assertGreaterEqual(index.explained_variance, 0.99)
+        self.assertEqual(index.features.shape, (3000, 3))
+        index = KDTree(projection='pca', n_components=2)
+        index.fit(self.features, sources=self.sources, markers=self.markers)
+        self.assertEqual(index.features.shape, (3000, 2))
+
+    def test_random_components(self):
+        index = BruteForce(projection='random', n_components=0.5)
+        index.fit(self.features, sources=self.sources, markers=self.markers)
+        self.assertEqual(index.components.shape, (12, 6))
+        self.assertIsNone(index.explained_variance)
+
+    def test_random_seed(self):
+        index = BruteForce(projection='random', n_components=4)
+        index.fit(self.features, sources=self.sources, markers=self.markers)
+        # the drawn seed is kept with the index, and rebuilds the same projection
+        self.assertIsInstance(index.serialize()['seed'], int)
+        rebuilt = BruteForce(projection='random', n_components=4, seed=index.seed)
+        rebuilt.fit(self.features, sources=self.sources, markers=self.markers)
+        np.testing.assert_array_equal(rebuilt.components, index.components)
+
+    def test_recall_report(self):
+        index = KDTree(projection='random', n_components=6, seed=1)
+        index.fit(self.features, sources=self.sources, markers=self.markers)
+        report = evaluate_index(index, self.features, self.sources, self.markers, k=10, num_queries=200, seed=2)
+        # an exact search only misses the neighbors lost to the projection, unlike a single-leaf search
+        self.assertGreater(report['exact search recall'], report['recall'])
+        repeated = evaluate_index(index, self.features, self.sources, self.markers, k=10, num_queries=200, seed=2)
+        self.assertEqual((repeated['recall'], repeated['exact search recall']), (report['recall'], report['exact search recall']))
+
+    def test_pca_recall(self):
+        index = BruteForce(projection='pca', n_components=0.99)
+        index.fit(self.features, sources=self.sources, markers=self.markers)
+        self.assertGreater(evaluate_index(index, self.features, self.sources, self.markers, k=10, num_queries=200)['recall'], 0.9)
+
+    def test_update_keeps_projection(self):
+        index = BruteForce(projection='pca', n_components=3)
+        index.fit(self.features[:2000], sources=self.sources[:2000], markers=self.markers[:2000])
+        components = index.components
+        index.insert(self.features[2000:], sources=self.sources[2000:], markers=self.markers[2000:])
+        self.assertIs(index.components, components)
+        self.assertEqual(len(index), 3000)
+        with self.assertRaises(ValueError):
+            index._denormalize(index.features)
+
+    def test_invalid_projection(self):
+        with self.assertRaises(ValueError):
+            KDTree(projection='svd')
+
+
+class IVFPQTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(7)
+        centers = rng.standard_normal((30, 8)) * 3
+        self.features = (centers[rng.integers(0, 30, 5000)] + rng.standard_normal((5000, 8))).astype('float32')
+        self.sources = np.arange(5000) % 4
+        self.markers = np.arange(5000)
+        self.index = IVFPQ(nlist=32, nprobe=4)
+        self.index.fit(self.features, sources=self.sources, markers=self.markers)
+
+    def recall(self, index, **kwargs):
+        return evaluate_index(index, self.features, self.sources, self.markers, k=10, num_queries=200, **kwargs)['recall']
+
+    def test_layout(self):
+        self.assertEqual(self.index.codes.shape, (5000, 4))
+        self.assertEqual(self.index.codes.dtype, np.uint8)
+        self.assertEqual(self.index.list_offsets[-1], 5000)
+        self.assertEqual(sorted(zip(self.index.sources, self.index.markers)), sorted(zip(self.sources, self.markers)))
+
+    def test_exact_recall(self):
+        # all lists are visited and candidates are re-ranked, so only quantization can miss neighbors
+        self.assertGreater(self.recall(self.index, search='exact'), 0.9)
+
+    def test_nprobe(self):
+        self.assertGreaterEqual(self.recall(self.index, nprobe=32) + 0.02, self.recall(self.index, nprobe=1))
+        indices, distances = self.index.knn_batch(self.features[:20], 10, nprobe=1)
+        self.assertEqual(indices.shape, (20, 10))
+        self.assertTrue(np.all(np.diff(distances, axis=1) >= 0))
+
+    def test_without_reranking(self):
+        index = IVFPQ(nlist=32, rerank=0)
+        index.fit(self.features, sources=self.sources, markers=self.markers)
+        self.assertIsNone(index.features)
+        self.assertGreater(self.recall(index, search='exact'), 0.5)
+
+    def test_fit_in_chunks(self):
+        file = os.path.join(self.temp.name, 'features.npy')
+        np.save(file, self.features)
+        index = IVFPQ(nlist=32, nprobe=4, train_size=1000, seed=self.index.seed, projection='pca', n_components=6)
+        normalized = []
+        with mock.patch('gamut.data.row_chunks', side_effect=lambda n, k: row_chunks(n, k, 16 * k * 300)), \
+                mock.patch.object(IVFPQ, '_normalize_input', autospec=True,
+                                  side_effect=lambda index, x: normalized.append(len(x)) or NeighborIndex._normalize_input(index, x)):
+            index.fit(np.load(file, mmap_mode='r'), sources=self.sources, markers=self.markers)
+        # only the training sample is normalized at once, and the other grains in chunks
+        self.assertEqual(normalized, [1000] + [300] * 16 + [200])
+        expected = IVFPQ(nlist=32, nprobe=4, train_size=1000, seed=self.index.seed, projection='pca', n_components=6)
+        expected.fit(self.features, sources=self.sources, markers=self.markers)
+        np.testing.assert_allclose(index.components, expected.components, rtol=1e-5, atol=1e-5)
+        np.testing.assert_array_equal(index.knn_batch(self.features[:50], 5)[0], expected.knn_batch(self.features[:50], 5)[0])
+
+    def test_small_lists(self):
+        # queries whose closest lists hold fewer than k grains visit more of them
+        indices, distances = self.index.knn_batch(self.features[:30], 400, nprobe=1)
+        self.assertEqual(indices.shape, (30, 400))
+        self.assertTrue(all(len(set(row)) == 400 for row in indices))
+        self.assertTrue(np.all(np.diff(distances, axis=1) >= 0))
+        self.assertTrue(np.all(np.isfinite(distances)))
+        # searching queries in blocks gives the same results
+        with mock.patch('gamut.data.MEMORY_BUDGET', 2**16):
+            np.testing.assert_array_equal(self.index.knn_batch(self.features[:30], 400, nprobe=1)[1], distances)
+
+    def test_update(self):
+        self.index.insert(self.features[:100] + 0.01, sources=np.full(100, 9), markers=np.arange(100))
+        self.index.remove(self.index.sources == 0)
+        self.assertEqual(len(self.index), 5000 + 100 - np.sum(self.sources == 0))
+        self.assertEqual(self.index.list_offsets[-1], len(self.index))
+        rows = self.index.knn_batch(self.features[:100] + 0.01, 1, search='exact')[0][:, 0]
+        self.assertGreater(np.mean(self.index.sources[rows] == 9), 0.9)
+
+    def test_serialize_round_trip(self):
+        loaded = load_index('ivfpq', self.index.serialize())
+        np.testing.assert_array_equal(loaded.knn_batch(self.features[:50], 5)[0], self.index.knn_batch(self.features[:50], 5)[0])
+        self.assertFalse(loaded.mergeable)
+
+
+class BallTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.features, self.sources, self.markers = make_grains(4000, k=10)
+        self.tree = BallTree(leaf_size=12)
+        self.tree.fit(self.features, sources=self.sources, markers=self.markers)
+        self.queries = make_grains(100, k=10, seed=8)[0]
+
+    def test_balls_hold_their_items(self):
+        for node in range(len(self.tree.children)):
+            start, end = self.tree.bounds[node]
+            distances = np.linalg.norm(self.tree.features[start:end] - self.tree.centers[node], axis=1)
+            self.assertTrue(np.all(distances <= self.tree.radii[node] * (1 + 1e-5) + 1e-6))
+
+    def test_exact(self):
+        expected = exact_knn(self.tree, self.queries, 10)
+        np.testing.assert_allclose(self.tree.knn_batch(self.queries, 10, search='exact')[1], expected, rtol=1e-4, atol=1e-4)
+        self.tree.EXACT_SEED_SIZE = 24
+        self.tree.EXHAUSTIVE_RATIO = np.inf
+        np.testing.assert_allclose(self.tree.knn_batch(self.queries, 10, search='exact')[1], expected, rtol=1e-4, atol=1e-4)
+
+    def test_update(self):
+        self.tree.remove(self.tree.sources == 2)
+        self.assertEqual(len(self.tree), np.sum(self.sources != 2))
+        self.test_balls_hold_their_items()
+
+
+class IndexProtocolTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        features, sources, markers = make_grains(1500)
+        queries = make_grains(40, seed=9)[0]
+        for kind, index_class in INDICES.items():
+            index = index_class()
+            index.fit(features, sources=sources, markers=markers)
+            loaded = load_index(kind, index.serialize())
+            self.assertIsInstance(loaded, index_class)
+            self.assertEqual(len(loaded), len(index))
+            self.assertEqual(loaded.nbytes, index.nbytes)
+            np.testing.assert_array_equal(loaded.knn_batch(queries, 5)[0], index.knn_batch(queries, 5)[0])
+
+    def test_invalid_index(self):
+        with self.assertRaises(ValueError):
+            load_index('lsh', {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,430 @@
+import json
+import os
+import random
+import unittest
+from unittest import mock
+import numpy as np
+import soundfile
+from os.path import basename, join
+from gamut.sys import set_vebosity
+from gamut.config import AUDIO_DIR
+from gamut.features import Corpus, Mosaic, load_and_analyze, load_target, read_metadata
+from gamut.container import write_container, read_header
+from gamut.audio import AudioFile, EncodedAudio
+from gamut.data import BruteForce, IVFPQ, KDTree
+from helpers import SharedTempDirTestCase, TempDirTestCase, isolate_gamut_dirs, write_sources, write_tone
+
+set_vebosity(False)
+
+
+def setUpModule():
+    isolate_gamut_dirs()
+
+
+def grain_keys(corpus: Corpus) -> list:
+    """ (file name, marker) of every grain of ``corpus``, which do not depend on the order of its sources """
+    names = [basename(sf['file']) for sf in corpus.soundfiles]
+    return sorted((names[source], int(marker)) for source, marker in zip(corpus.tree.sources, corpus.tree.markers))
+
+
+class IncrementalCorpusTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.first = join(self.temp.name, 'first')
+        self.second = join(self.temp.name, 'second')
+        write_sources(self.first, [220, 330])
+        write_tone(join(self.second, 'extra0.wav'), 440, seed=5)
+        write_tone(join(self.second, 'extra1.wav'), 550, seed=6)
+
+    def test_add_sources(self):
+        for index in ['brute', 'kdtree']:
+            corpus = Corpus(self.first, index=index, cache=False)
+            corpus.add_sources(self.second)
+            full = Corpus([self.first, self.second], index=index, cache=False)
+            self.assertEqual(grain_keys(corpus), grain_keys(full))
+            self.assertEqual(len(corpus.soundfiles), len(full.soundfiles))
+            self.assertAlmostEqual(corpus.total_duration, full.total_duration)
+
+    def test_add_existing_sources(self):
+        corpus = Corpus(self.first, cache=False)
+        keys = grain_keys(corpus)
+        corpus.add_sources(self.first)
+        self.assertEqual(grain_keys(corpus), keys)
+
+    def test_remove_sources(self):
+        for index in ['brute', 'kdtree']:
+            corpus = Corpus([self.first, self.second], index=index, cache=False)
+            corpus.remove_sources(self.second)
+            reference = Corpus(self.first, index=index, cache=False)
+            self.assertEqual(grain_keys(corpus), grain_keys(reference))
+            self.assertTrue(np.all(corpus.tree.sources < len(corpus.soundfiles)))
+            self.assertAlmostEqual(corpus.total_duration, reference.total_duration)
+
+    def test_remove_single_file(self):
+        corpus = Corpus([self.first, self.second], cache=False)
+        corpus.remove_sources(join(self.second, 'extra0.wav'))
+        self.assertNotIn('extra0.wav', [name for name, _ in grain_keys(corpus)])
+        self.assertIn('extra1.wav', [name for name, _ in grain_keys(corpus)])
+
+    def test_remove_all_sources(self):
+        corpus = Corpus(self.first, cache=False)
+        with self.assertRaises(ValueError):
+            corpus.remove_sources([self.first, AUDIO_DIR])
+
+    def test_update_after_read(self):
+        corpus = Corpus(self.first, cache=False)
+        file = join(self.temp.name, 'corpus.gamut')
+        corpus.write(file)
+        loaded = Corpus(cache=False)
+        loaded.read(file)
+        loaded.add_sources(self.second)
+        self.assertEqual(grain_keys(loaded), grain_keys(Corpus([self.first, self.second], cache=False)))
+
+
+class ParallelAnalysisTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        write_sources(self.temp.name, [220, 330, 440, 550, 660])
+
+    def test_matches_serial_analysis(self):
+        serial = Corpus(self.temp.name, features=['timbre', 'pitch'], cache=False)
+        parallel = Corpus(self.temp.name, features=['timbre', 'pitch'], cache=False, n_jobs=2)
+        self.assertEqual([sf['file'] for sf in parallel.soundfiles], [sf['file'] for sf in serial.soundfiles])
+        self.assertEqual(grain_keys(parallel), grain_keys(serial))
+        np.testing.assert_allclose(parallel.tree.features, serial.tree.features, rtol=1e-5, atol=1e-6)
+
+
+class StreamedCorpusTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        write_sources(self.temp.name, [220, 440], duration=2.0)
+
+    def test_matches_whole_files(self):
+        corpus = Corpus(self.temp.name, cache=False)
+        streamed = Corpus(self.temp.name, cache=False, block_size=4096)
+        self.assertEqual(grain_keys(streamed), grain_keys(corpus))
+        np.testing.assert_allclose(streamed.tree.features, corpus.tree.features, rtol=1e-3, atol=1e-3)
+        for sf, streamed_sf in zip(corpus.soundfiles, streamed.soundfiles):
+            np.testing.assert_allclose(streamed_sf['y'], sf['y'], atol=1e-6)
+
+
+class LazyCorpusTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        write_sources(join(self.temp.name, 'sources'), [220, 440])
+        write_tone(join(self.temp.name, 'target.wav'), 330, duration=1.5, seed=9)
+
+    def test_matches_eager_corpus(self):
+        corpus = Corpus(join(self.temp.name, 'sources'), cache=False)
+        lazy = Corpus(join(self.temp.name, 'sources'), cache=False, lazy=True)
+        self.assertEqual(grain_keys(lazy), grain_keys(corpus))
+        for sf, lazy_sf in zip(corpus.soundfiles, lazy.soundfiles):
+            if sf['file'].endswith('.wav'):
+                self.assertIsInstance(lazy_sf['y'], AudioFile)
+            self.assertEqual(len(lazy_sf['y']), len(sf['y']))
+            np.testing.assert_allclose(lazy_sf['y'][1000:2000], sf['y'][1000:2000], atol=1e-6)
+
+    def test_mosaic_from_lazy_corpus(self):
+        lazy = Corpus(join(self.temp.name, 'sources'), cache=False, lazy=True)
+        file = join(self.temp.name, 'lazy.gamut')
+        lazy.write(file)
+        loaded = Corpus().read(file)
+        self.assertTrue(all(isinstance(sf['y'], AudioFile) for sf in loaded.soundfiles if sf['file'].endswith('.wav')))
+        mosaic = Mosaic(join(self.temp.name, 'target.wav'), loaded)
+        audio = mosaic.to_audio()
+        self.assertGreater(audio.samps, 0)
+        self.assertTrue(np.all(np.isfinite(audio.y)))
+
+
+class TargetCacheTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.corpus = Corpus(write_sources(join(self.temp.name, 'sources'), [220, 440]), cache=False)
+        self.target = write_tone(join(self.temp.name, 'target.wav'), 330, duration=2.0, seed=9)
+
+    def test_target_is_loaded_once(self):
+        y, sr = load_target(self.target)
+        self.assertIs(load_target(self.target)[0], y)
+        self.assertFalse(y.flags.writeable)
+        # editing the target invalidates it
+        write_tone(self.target, 660, duration=2.5)
+        self.assertEqual(len(load_target(self.target)[0]), int(2.5 * sr))
+
+    def test_target_analysis_is_reused(self):
+        mosaic = Mosaic(self.target, self.corpus, beat_unit=0.5)
+        with mock.patch.object(Mosaic, '_analyze_audio_file', side_effect=AssertionError('analyzed a cached target')), \
+                mock.patch('gamut.features.tempo', side_effect=AssertionError('estimated a cached tempo')):
+            rebuilt = Mosaic(self.target, self.corpus, beat_unit=0.5)
+        np.testing.assert_array_equal(rebuilt.frames, mosaic.frames)
+        self.assertEqual(rebuilt.hop_length, mosaic.hop_length)
+
+    def test_without_cache(self):
+        Mosaic(self.target, self.corpus)
+        with mock.patch.object(Mosaic, '_analyze_audio_file', autospec=True, side_effect=Mosaic._analyze_audio_file) as analyze:
+            Mosaic(self.target, self.corpus, cache=False)
+        analyze.assert_called_once()
+
+
+class MultiCorpusMosaicTest(SharedTempDirTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.first = write_sources(join(cls.temp.name, 'first'), [220, 330])
+        cls.second = write_sources(join(cls.temp.name, 'second'), [440, 660, 880])
+        cls.target = write_tone(join(cls.temp.name, 'target.wav'), 275, seed=5)
+
+    def build(self, corpora: list, **kwargs) -> tuple:
+        """ builds a mosaic of ``corpora``, along with the number of rows of every search made for it """
+        with mock.patch.object(BruteForce, 'knn_batch', autospec=True, side_effect=BruteForce.knn_batch) as search:
+            mosaic = Mosaic(self.target, corpora, cache=False, **kwargs)
+        return mosaic, [len(call.args[1] if len(call.args) > 1 else call.kwargs['X']) for call in search.call_args_list]
+
+    def test_separate_indices(self):
+        # each corpus is searched once, and keeps its own leaf_size matches per target frame
+        corpora = [Corpus(self.first, leaf_size=4, cache=False), Corpus(self.second, leaf_size=9, cache=False)]
+        mosaic, rows = self.build(corpora)
+        self.assertEqual(rows, [len(mosaic.frames)] * len(corpora))
+        self.assertEqual(mosaic.frames.shape[1], 4 + 9)
+        for corpus_id, corpus in enumerate(corpora):
+            np.testing.assert_array_equal(np.sum(mosaic.frames['corpus'] == corpus_id, axis=1), corpus.leaf_size)
+            self.assertEqual(set(mosaic.soundfiles[corpus_id]['sources']),
+                             set(np.unique(mosaic.frames['source'][mosaic.frames['corpus'] == corpus_id]).tolist()))
+
+    def test_merged_index(self):
+        corpora = [Corpus(self.first, leaf_size=4, cache=False), Corpus(self.second, leaf_size=9, cache=False)]
+        mosaic, rows = self.build(corpora, merge_corpora=True)
+        # all corpora are searched at once, for a single ranking of their matches
+        self.assertEqual(rows, [len(mosaic.frames)])
+        self.assertEqual(mosaic.frames.shape[1], 4 + 9)
+        self.assertEqual(set(np.unique(mosaic.frames['corpus'])), {0, 1})
+        separate = self.build(corpora)[0]
+        self.assertFalse(np.array_equal(np.sort(mosaic.frames['corpus'], axis=1), np.sort(separate.frames['corpus'], axis=1)))
+        # frames without candidates of the weighted corpus fall back to those of the others
+        for weights in [[0, 1, 1], [0, 0, 1], [0, 1, 0]]:
+            self.assertGreater(mosaic.to_audio(corpus_weights=weights).samps, 0)
+
+    def test_unmergeable_indices(self):
+        corpora = [Corpus(self.first, leaf_size=4, cache=False, projection='random', n_components=4),
+                   Corpus(self.second, leaf_size=9, cache=False)]
+        self.assertFalse(corpora[0].tree.mergeable)
+        mosaic = self.build(corpora, merge_corpora=True)[0]
+        for corpus_id, corpus in enumerate(corpora):
+            np.testing.assert_array_equal(np.sum(mosaic.frames['corpus'] == corpus_id, axis=1), corpus.leaf_size)
+
+
+class SearchBudgetTest(SharedTempDirTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.corpus = Corpus(write_sources(join(cls.temp.name, 'sources'), [220, 330, 440]), index='kdtree', leaf_size=5, cache=False)
+        cls.target = write_tone(join(cls.temp.name, 'target.wav'), 275, seed=5)
+
+    def test_max_checks_alone(self):
+        with mock.patch.object(KDTree, '_search', autospec=True, side_effect=KDTree._search) as search:
+            Mosaic(self.target, self.corpus, cache=False)
+            search.assert_not_called()
+            mosaic = Mosaic(self.target, self.corpus, max_checks=100, cache=False)
+        self.assertGreater(search.call_count, 0)
+        self.assertEqual((mosaic.max_leaves, mosaic.max_checks), (None, 100))
+
+
+class QuantizedCorpusTest(TempDirTestCase):
+
+    def test_memory_mapped_features(self):
+        sources = write_sources(join(self.temp.name, 'sources'), [220, 330, 440])
+        with mock.patch.object(IVFPQ, 'fit', autospec=True, side_effect=IVFPQ.fit) as fit:
+            corpus = Corpus(sources, index='ivfpq', index_options={'nlist': 4}, projection='pca', cache=False)
+        # grains are fitted from a file, which is removed once the index is built
+        features = fit.call_args.args[1]
+        self.assertIsInstance(features.base, np.memmap)
+        self.assertFalse(os.path.exists(features.base.filename))
+        self.assertEqual(len(corpus.tree), len(features))
+        self.assertIsNone(corpus.projection_report)
+        self.assertGreater(Mosaic(write_tone(join(self.temp.name, 'target.wav'), 275, seed=5), corpus, cache=False).to_audio().samps, 0)
+
+
+class OnsetMosaicTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        sources = write_sources(join(self.temp.name, 'sources'), [220, 440])
+        self.corpus = Corpus(sources, cache=False, segmentation='onset')
+        self.frame_corpus = Corpus(sources, cache=False)
+        # decaying noise bursts every quarter of a second
+        rng = np.random.default_rng(4)
+        t = np.arange(22050 // 4) / 22050
+        y = np.concatenate([np.exp(-30 * t) * rng.uniform(-0.5, 0.5, len(t)) for _ in range(8)])
+        self.target = join(self.temp.name, 'target.wav')
+        soundfile.write(self.target, y.astype('float32'), 22050)
+
+    def test_onset_corpus(self):
+        self.assertLess(len(self.corpus.tree), len(self.frame_corpus.tree))
+        self.assertEqual(self.corpus.segmentation, 'onset')
+
+    def test_onset_mosaic(self):
+        mosaic = Mosaic(self.target, self.frame_corpus, segmentation='onset', cache=False)
+        frame_mosaic = Mosaic(self.target, self.frame_corpus, cache=False)
+        self.assertLess(len(mosaic.frames), len(frame_mosaic.frames) // 4)
+        # segments span the whole target
+        self.assertEqual(len(mosaic.segments), len(mosaic.frames) + 1)
+        self.assertEqual(mosaic.segments[0], 0)
+        self.assertEqual(mosaic.segments[-1], 8 * (22050 // 4))
+        self.assertTrue(np.all(np.diff(mosaic.segments) > 0))
+        audio = mosaic.to_audio()
+        self.assertGreater(audio.samps, 0)
+
+    def test_invalid_segmentation(self):
+        with self.assertRaises(ValueError):
+            Corpus(self.target, cache=False, segmentation='beat')
+        with self.assertRaises(ValueError):
+            Mosaic(self.target, self.corpus, segmentation='beat')
+
+
+class Float32MosaicTest(SharedTempDirTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.corpus_files = write_sources(join(cls.temp.name, 'sources'), [220, 330, 440])
+        cls.corpus = Corpus(cls.corpus_files, cache=False)
+        target = write_tone(join(cls.temp.name, 'target.wav'), 275, seed=5)
+        cls.mosaic = Mosaic(target, cls.corpus, cache=False)
+
+    def render(self, **params) -> np.ndarray:
+        np.random.seed(0)
+        random.seed(0)
+        return self.mosaic.to_audio(grain_dur=0.2, **params).y
+
+    def test_analysis_is_float32(self):
+        for y, sr, analysis, markers in load_and_analyze(self.corpus_files, ['timbre', 'pitch']):
+            self.assertEqual(analysis.dtype, np.float32)
+
+    def test_matches_float64_output(self):
+        expected = self.render(dtype='float64')
+        y = self.render(dtype='float32')
+        self.assertEqual((expected.dtype, y.dtype), (np.float64, np.float32))
+        np.testing.assert_allclose(y, expected, atol=1e-5)
+        # resampled sources are interpolated in float32 too
+        self.assertEqual(self.render(dtype='float32', sr=16000).dtype, np.float32)
+
+    def test_invalid_dtype(self):
+        with self.assertRaises(ValueError):
+            self.mosaic.to_audio(dtype='int16')
+
+    def test_global_dtype(self):
+        # the global setting is read by every call, after gamut.features has been imported
+        with mock.patch('gamut.config.AUDIO_DTYPE', 'float32'):
+            self.assertEqual(self.render().dtype, np.float32)
+            self.assertEqual(self.render(dtype='float64').dtype, np.float64)
+        self.assertEqual(self.render().dtype, np.float64)
+
+
+class SerializationTest(SharedTempDirTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.corpus = Corpus(write_sources(join(cls.temp.name, 'sources'), [220, 330, 440]), cache=False)
+        target = write_tone(join(cls.temp.name, 'target.wav'), 275, seed=5)
+        cls.mosaic = Mosaic(target, cls.corpus, cache=False)
+
+    def test_arrays_are_shared(self):
+        for portable in [False, True]:
+            self.corpus.portable = portable
+            serialized = self.corpus._serialize()
+            self.assertIs(serialized['tree']['features'], self.corpus.tree.features)
+            for sf, serialized_sf in zip(self.corpus.soundfiles, serialized['soundfiles']):
+                self.assertEqual('y' in serialized_sf, portable)
+                if portable:
+                    self.assertIs(serialized_sf['y'], sf['y'])
+            self.assertIs(self.mosaic._serialize()['frames'], self.mosaic.frames)
+        self.corpus.portable = False
+        # writing does not remove the audio samples of the object itself
+        self.corpus.write(join(self.temp.name, 'corpus'))
+        self.assertTrue(all('y' in sf for sf in self.corpus.soundfiles))
+
+    def test_corpus_round_trip(self):
+        queries = self.corpus.tree.features[:20]
+        for portable in [False, True]:
+            file = join(self.temp.name, f'corpus_{portable}')
+            self.corpus.write(file, portable=portable)
+            corpus = Corpus().read(file + '.gamut')
+            self.assertEqual(grain_keys(corpus), grain_keys(self.corpus))
+            for found, expected in zip(corpus.tree.knn_batch(queries, 5), self.corpus.tree.knn_batch(queries, 5)):
+                np.testing.assert_array_equal(found, expected)
+            for sf, expected in zip(corpus.soundfiles, self.corpus.soundfiles):
+                np.testing.assert_array_equal(sf['y'][:], expected['y'][:])
+
+    def test_mosaic_round_trip(self):
+        for portable in [False, True]:
+            file = join(self.temp.name, f'mosaic_{portable}')
+            self.mosaic.write(file, portable=portable)
+            mosaic = Mosaic().read(file + '.gamut')
+            np.testing.assert_array_equal(mosaic.frames, self.mosaic.frames)
+            expected = []
+            for m in [self.mosaic, mosaic]:
+                np.random.seed(0)
+                random.seed(0)
+                expected.append(m.to_audio(grain_dur=0.2).y)
+            np.testing.assert_array_equal(*expected)
+
+    def test_audio_codecs(self):
+        file = join(self.temp.name, 'uncompressed')
+        self.corpus.write(file, portable=True)
+        for codec, atol in [('pcm16', 2**-15), ('flac', 2**-23)]:
+            encoded_file = join(self.temp.name, codec)
+            self.corpus.write(encoded_file, portable=True, audio_codec=codec)
+            self.assertLess(os.path.getsize(encoded_file + '.gamut'), os.path.getsize(file + '.gamut'))
+            corpus = Corpus().read(encoded_file + '.gamut')
+            for sf, expected in zip(corpus.soundfiles, self.corpus.soundfiles):
+                self.assertIsInstance(sf['y'], EncodedAudio)
+                self.assertEqual(sf['y'].codec, codec)
+                np.testing.assert_allclose(sf['y'][:], np.clip(expected['y'][:], -1.0, 1.0), atol=atol)
+        # codecs only apply to portable files
+        self.corpus.write(file, audio_codec='pcm16')
+        self.assertIsNone(self.corpus.audio_codec)
+        with self.assertRaises(ValueError):
+            self.corpus.write(file, portable=True, audio_codec='mp3')
+
+    def test_read_metadata(self):
+        for obj in [self.corpus, self.mosaic]:
+            file = join(self.temp.name, f'{obj.type}_metadata.gamut')
+            obj.write(file)
+            with mock.patch('gamut.features.read_container', side_effect=AssertionError('read the whole file')):
+                metadata = read_metadata(file)
+            self.assertEqual((metadata['type'], metadata['name']), (obj.type, f'{obj.type}_metadata'))
+            self.assertEqual(json.loads(json.dumps(obj.metadata()['summary'], default=str)), metadata['summary'])
+
+    def test_projection_seed(self):
+        sources = join(self.temp.name, 'sources')
+        corpus = Corpus(sources, cache=False, projection='random', n_components=4)
+        file = join(self.temp.name, 'projected.gamut')
+        corpus.write(file)
+        # the drawn seed is stored with the corpus, and reproduces its projection and recall report
+        read = Corpus().read(file)
+        self.assertEqual((read.seed, read.tree.seed), (corpus.seed, corpus.seed))
+        rebuilt = Corpus(sources, cache=False, projection='random', n_components=4, seed=read.seed)
+        np.testing.assert_array_equal(rebuilt.tree.components, read.tree.components)
+        self.assertEqual(rebuilt.projection_report['exact search recall'], corpus.projection_report['exact search recall'])
+        self.assertIn('with exact search', rebuilt.metadata()['summary']['projection recall@15'])
+
+    def test_read_metadata_without_header(self):
+        # files written before metadata was stored in headers are read in full
+        file = join(self.temp.name, 'legacy.gamut')
+        with mock.patch('gamut.features.write_container', side_effect=lambda f, obj, metadata: write_container(f, obj)):
+            self.corpus.write(file)
+        self.assertIsNone(read_header(file)[1]['metadata'])
+        self.assertEqual(read_metadata(file)['summary'], Corpus().read(file).metadata()['summary'])
+        with self.assertRaises(ValueError):
+            read_metadata(join(self.temp.name, 'legacy.npy'))
+
+
+if __name__ == '__main__':
+    unittest.main()
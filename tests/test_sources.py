@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+import soundfile
+from os.path import basename, join
+from gamut.sources import scan_sources, sniff_audio_file
+from helpers import TempDirTestCase, write_tone
+
+
+class ScanSourcesTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        root = self.temp.name
+        self.files = [
+            write_tone(join(root, 'a.wav'), 220),
+            write_tone(join(root, 'nested', 'deeper', 'b.wav'), 330, duration=0.5),
+            write_tone(join(root, 'nested', 'c.wav'), 440, sr=44100),
+        ]
+        soundfile.write(join(root, 'stereo.aiff'), np.zeros((2205, 2), dtype='float32'), 22050, format='AIFF')
+        # duplicate name, unsupported extension, and a file that is not audio despite its extension
+        write_tone(join(root, 'nested', 'a.wav'), 550)
+        write_tone(join(root, 'ignored.flac'), 220)
+        with open(join(root, 'fake.wav'), 'w') as f:
+            f.write('not audio')
+
+    def test_manifest(self):
+        manifest = scan_sources(self.temp.name)
+        names = sorted(basename(entry['file']) for entry in manifest)
+        self.assertEqual(names, ['a.wav', 'b.wav', 'c.wav', 'stereo.aiff'])
+        entries = {basename(entry['file']): entry for entry in manifest}
+        self.assertEqual((entries['c.wav']['sr'], entries['c.wav']['channels']), (44100, 1))
+        self.assertAlmostEqual(entries['b.wav']['duration'], 0.5, places=3)
+        self.assertEqual(entries['stereo.aiff']['channels'], 2)
+        self.assertGreater(entries['a.wav']['size'], 0)
+
+    def test_excluded_files(self):
+        manifest = scan_sources([self.temp.name], excluded_files=['b', 'stereo'])
+        self.assertEqual(sorted(basename(entry['file']) for entry in manifest), ['a.wav', 'c.wav'])
+
+    def test_explicit_files(self):
+        manifest = scan_sources([self.files[1], join(self.temp.name, 'fake.wav'), join(self.temp.name, 'missing.wav')], num_workers=2)
+        self.assertEqual([entry['file'] for entry in manifest], [self.files[1]])
+        self.assertIsNone(sniff_audio_file(join(self.temp.name, 'fake.wav')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import gc
+import os
+import unittest
+from unittest import mock
+from weakref import WeakValueDictionary
+import numpy as np
+from os.path import join
+from gamut.sys import set_vebosity
+from gamut.audio import EncodedAudio
+from gamut.features import Corpus, Mosaic, _load_target
+from gamut.store import AudioStore
+from helpers import TempDirTestCase, isolate_gamut_dirs, write_sources, write_tone
+
+set_vebosity(False)
+
+
+def setUpModule():
+    isolate_gamut_dirs()
+
+
+class StoreTestCase(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.store = AudioStore()
+        # samples in use are tracked by class, so each test starts with none
+        for name in ['_blobs', '_files']:
+            patcher = mock.patch.object(AudioStore, name, WeakValueDictionary())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if os.path.isdir(self.store.directory):
+            for name in os.listdir(self.store.directory):
+                os.remove(join(self.store.directory, name))
+
+    def stored_keys(self) -> list:
+        return sorted(os.listdir(self.store.directory)) if os.path.isdir(self.store.directory) else []
+
+
+class AudioStoreTest(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.y = np.random.default_rng(0).uniform(-0.5, 0.5, 5000).astype('float32')
+
+    def test_deduplication(self):
+        key = self.store.put(self.y)
+        self.assertEqual(self.store.put(self.y.copy()), key)
+        self.assertEqual(self.stored_keys(), [key])
+        self.assertNotEqual(self.store.put(self.y[:-1]), key)
+        self.assertEqual(len(self.stored_keys()), 2)
+
+    def test_shared_samples(self):
+        key = self.store.put(self.y)
+        self.assertIs(self.store.get(key), self.y)
+        del self.y
+        gc.collect()
+        # once released, samples are memory-mapped from the store, and shared again
+        y = self.store.get(key)
+        self.assertIs(AudioStore().get(key), y)
+        np.testing.assert_array_equal(y, np.random.default_rng(0).uniform(-0.5, 0.5, 5000).astype('float32'))
+
+    def test_encoded_samples(self):
+        encoded = EncodedAudio.encode(self.y, 'pcm16')
+        key = self.store.put(encoded)
+        self.assertNotEqual(key, self.store.hash(self.y))
+        del encoded
+        gc.collect()
+        y = self.store.get(key)
+        self.assertIsInstance(y, EncodedAudio)
+        np.testing.assert_allclose(y[:], self.y, atol=2**-15)
+
+    def test_missing_samples(self):
+        with self.assertRaises(FileNotFoundError):
+            self.store.get('0' * 40)
+
+    def test_shared_audio_files(self):
+        file = write_tone(join(self.temp.name, 'tone.wav'), 440)
+        y = self.store.load(file, sr=None)
+        self.assertIs(AudioStore().load(file, sr=None), y)
+        self.assertIsNot(self.store.load(file, sr=16000), y)
+        # edited files are loaded again
+        write_tone(file, 220, duration=0.5)
+        self.assertEqual(len(self.store.load(file, sr=None)), 11025)
+
+
+class StoreBackedFileTest(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.corpus = Corpus(write_sources(join(self.temp.name, 'sources'), [220, 330]), cache=False)
+        self.mosaic = Mosaic(write_tone(join(self.temp.name, 'target.wav'), 275, seed=5), self.corpus, cache=False)
+        os.makedirs(join(self.temp.name, 'files'))
+        self.corpus_file = join(self.temp.name, 'files', 'corpus.gamut')
+        self.mosaic_file = join(self.temp.name, 'files', 'mosaic.gamut')
+        self.corpus.write(self.corpus_file, audio_store=True)
+        self.mosaic.write(self.mosaic_file, audio_store=True)
+
+    def test_shared_between_files(self):
+        # the mosaic references the samples of the corpus sources it uses, plus those of its target
+        corpus_keys = self.store.references(self.corpus_file)
+        mosaic_keys = self.store.references(self.mosaic_file)
+        self.assertEqual(len(corpus_keys), len(self.corpus.soundfiles))
+        self.assertEqual(len(corpus_keys & mosaic_keys), len(self.mosaic.soundfiles[0]['sources']))
+        self.assertEqual(len(mosaic_keys - corpus_keys), 1)
+        self.assertEqual(set(self.stored_keys()), corpus_keys | mosaic_keys)
+
+    def test_round_trip(self):
+        corpus = Corpus().read(self.corpus_file)
+        mosaic = Mosaic().read(self.mosaic_file)
+        for sf, expected in zip(corpus.soundfiles, self.corpus.soundfiles):
+            np.testing.assert_array_equal(sf['y'], expected['y'])
+        # samples are shared by the objects read from both files
+        self.assertIs(mosaic.soundfiles[0]['sources'][0]['y'], corpus.soundfiles[0]['y'])
+        self.assertGreater(mosaic.to_audio().samps, 0)
+        self.assertEqual(corpus.metadata()['summary']['audio store'], self.store.directory)
+
+    def test_not_portable(self):
+        with self.assertRaises(ValueError):
+            self.corpus.write(self.corpus_file, portable=True, audio_store=True)
+
+    def test_prune(self):
+        extra = self.store.put(np.ones(100, dtype='float32'))
+        # samples in use in this process are never deleted, including cached targets
+        del self.corpus, self.mosaic
+        _load_target.cache_clear()
+        gc.collect()
+        corpus_keys = self.store.references(self.corpus_file)
+        mosaic_keys = self.store.references(self.mosaic_file)
+        self.assertEqual(self.store.prune([join(self.temp.name, 'files')]), [extra])
+        self.assertEqual(set(self.stored_keys()), corpus_keys | mosaic_keys)
+        # the samples of the mosaic target are only kept for the mosaic
+        self.assertEqual(set(self.store.prune(self.corpus_file)), mosaic_keys - corpus_keys)
+        Corpus().read(self.corpus_file)
+        with self.assertRaises(FileNotFoundError):
+            Mosaic().read(self.mosaic_file)
+
+
+if __name__ == '__main__':
+    unittest.main()